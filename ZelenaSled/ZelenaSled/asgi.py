@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ZelenaSled.settings')
 
 application = get_asgi_application()
+
+# Start loading the prepared graphs when the server starts, in the background (see /api/ready/)
+from routing.views import load_graphs  # noqa: E402
+
+load_graphs()
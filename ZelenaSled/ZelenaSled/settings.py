@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -93,6 +94,22 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Route cache shared by all workers, enable it with ROUTING_CACHE['BACKEND'] = 'routes'
+    'routes': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'route_cache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -133,3 +150,164 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Routing
+
+# Directory of the GraphML, noise and H3 files (routing/data by default), e.g.
+# the synthetic city written by the load_test command
+ROUTING_DATA_DIR = os.environ.get('ROUTING_DATA_DIR')
+
+# Number of candidate paths generated before picking the best 3
+ROUTING_CANDIDATE_PATHS = 25
+
+# Alternative routes engine ('yen', 'penalty' or 'via'), looked up by
+# '<commute_mode>/<routing_mode>', '<commute_mode>', '<routing_mode>' and 'default'
+ROUTING_ALTERNATIVES_ENGINE = {
+    'default': 'penalty',
+}
+
+# Snap origin and destination onto the nearest edge (split at the projected
+# point) instead of the nearest node
+ROUTING_SNAP_TO_EDGES = False
+
+# In-process LRU/TTL cache of computed routes, BACKEND is an alias in CACHES
+# shared by all workers (None to cache in-process only)
+ROUTING_CACHE = {
+    'MAX_ENTRIES': 1024,
+    'TTL': 3600,
+    'BACKEND': None,
+}
+
+# Processes used by the batch routing endpoint (0 to route in the request's
+# own process) and the maximum number of pairs per batch
+ROUTING_BATCH_WORKERS = 4
+ROUTING_BATCH_MAX_PAIRS = 1000
+
+# Asynchronous routing endpoint (ASGI): concurrent searches, requests admitted
+# before answering 503, and seconds before answering 504
+ROUTING_ASYNC = {
+    'WORKERS': 4,
+    'MAX_QUEUE': 32,
+    'DEADLINE': 10,
+}
+
+# Commute modes this server serves (e.g. ['bike'] for bike-only instances)
+# and how their graphs are loaded: in the background when a server process
+# starts (WARM_UP), before it serves if WAIT, with outdated snapshots built by
+# WORKERS processes at once. /api/ready/ answers 200 once they are loaded
+ROUTING_GRAPHS = {
+    'COMMUTE_MODES': ['walk', 'bike'],
+    'WARM_UP': True,
+    'WAIT': False,
+    'WORKERS': 2,
+}
+
+# Memory-map the prepared graph snapshots read-only, so all workers share one
+# copy of the graphs. ROUTING_SNAPSHOT_DIR can place the snapshots in shared
+# memory (e.g. '/dev/shm/zelenasled'), by default they are in routing/data/snapshots
+ROUTING_SHARED_GRAPHS = True
+ROUTING_SNAPSHOT_DIR = None
+
+# Picking the most different paths out of the candidates: number of paths
+# returned, vegetation/heat candidates considered, and the minimum quality
+# (shortest candidate length / path length) of a returned path
+ROUTING_DIVERSITY = {
+    'K': 3,
+    'TOP': 10,
+    'MIN_QUALITY': 0.0,
+}
+
+# Multi-criteria searches (requests with "weights"): steps of every weight
+# explored in Pareto mode and the most Pareto-optimal paths returned
+ROUTING_MULTI_CRITERIA = {
+    'PARETO_STEPS': 3,
+    'MAX_PARETO_PATHS': 5,
+}
+
+# Point-to-point searches with bidirectional A* on landmark (ALT) bounds,
+# precomputed per graph and cost column in the snapshots
+ROUTING_ALT = {
+    'ENABLED': True,
+    'LANDMARKS': 16,
+    'ACTIVE': 4,
+}
+
+# Search a corridor (ellipse around origin and destination) instead of the
+# whole graph: allowed detour, extra meters around the endpoints, how much the
+# corridor grows when it has no path, and corridors tried before the whole
+# graph is searched (also when a corridor would hold MAX_SHARE of the nodes)
+ROUTING_CORRIDOR = {
+    'ENABLED': True,
+    'STRETCH': 1.6,
+    'MARGIN_M': 300,
+    'WIDEN': 2.0,
+    'ATTEMPTS': 2,
+    'MAX_SHARE': 0.5,
+}
+
+# Route responses: decimals of the coordinates (6 is about 0.1 m), the
+# geometry format, 'geojson' or 'polyline' (encoded polylines in the
+# properties), and the Douglas-Peucker tolerance in meters the geometries are
+# simplified with (None keeps every point of the streets' shapes). All can be
+# overridden per request with "precision"/"format"/"simplify", or "zoom" for
+# a tolerance of one pixel at that map zoom
+ROUTING_GEOJSON = {
+    'PRECISION': 6,
+    'FORMAT': 'geojson',
+    'SIMPLIFY': None,
+}
+
+# Per-stage timings in the Server-Timing header of routing responses and
+# request metrics at /metrics (Prometheus format, per worker process),
+# readable from ALLOWED_IPS only
+ROUTING_METRICS = {
+    'ENABLED': True,
+    'ALLOWED_IPS': ['127.0.0.1', '::1'],
+}
+
+# Data layers (noise, NDVI, heat) are reloaded without a restart: every worker
+# checks the layer files every INTERVAL seconds and applies changed ones to
+# the affected edges only
+ROUTING_LAYERS = {
+    'WATCH': True,
+    'INTERVAL': 60,
+}
+
+# Time-of-day heat and noise: layer files with the hour before the extension
+# (e.g. heat_h3.h14.zip, ...areas.h0730.geojson) are prepared as time slices
+# and requests with a "departure_time" use the slices around that hour. Hours
+# are in TIME_ZONE, departure times are rounded to ROUND_MINUTES and each
+# worker keeps the graph views of CACHED_VIEWS departure times
+ROUTING_TIME_SLICES = {
+    'TIME_ZONE': 'Europe/Ljubljana',
+    'ROUND_MINUTES': 15,
+    'CACHED_VIEWS': 4,
+}
+
+# Reachable area endpoint (/api/isochrone/): travel speeds in km/h, longest
+# travel time in minutes, H3 resolution of the returned cells (a request may
+# pick one between MIN_RESOLUTION and MAX_RESOLUTION) and the default format,
+# 'h3' for a feature per cell or 'polygon' for the outline of the area
+ROUTING_ISOCHRONE = {
+    'SPEEDS': {'walk': 4.8, 'bike': 15.0},
+    'MAX_MINUTES': 30,
+    'RESOLUTION': 10,
+    'MIN_RESOLUTION': 7,
+    'MAX_RESOLUTION': 12,
+    'FORMAT': 'h3',
+}
+
+# Map tiles of the NDVI, heat and noise layers (/api/tiles/<layer>/<z>/<x>/<y>.png):
+# tiles are rendered on first request and kept in CACHE_DIR (routing/data/tiles
+# by default), served between MIN_ZOOM and MAX_ZOOM and cached by browsers for
+# MAX_AGE seconds. The seed_tiles command renders the zooms up to SEED_MAX_ZOOM
+# ahead; noise is drawn from its hexagons from NOISE_POLYGON_ZOOM on
+ROUTING_TILES = {
+    'CACHE_DIR': None,
+    'MIN_ZOOM': 10,
+    'MAX_ZOOM': 18,
+    'SEED_MAX_ZOOM': 15,
+    'MAX_AGE': 3600,
+    'NOISE_POLYGON_ZOOM': 14,
+}
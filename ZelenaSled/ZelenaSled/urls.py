@@ -21,6 +21,14 @@ from routing import views
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/get_paths/', views.get_paths, name='get_paths'),
+    path('api/get_paths/async/', views.get_paths_async, name='get_paths_async'),
+    path('api/get_paths/batch/', views.get_paths_batch, name='get_paths_batch'),
+    path('api/isochrone/', views.get_isochrone, name='get_isochrone'),
+    path('api/cache_stats/', views.route_cache_stats, name='route_cache_stats'),
+    path('api/layers/', views.layer_status, name='layer_status'),
+    path('api/ready/', views.readiness, name='readiness'),
+    path('api/tiles/<str:layer>/<int:z>/<int:x>/<int:y>.png', views.layer_tile, name='layer_tile'),
+    path('metrics', views.metrics, name='metrics'),
     path('', views.home, name='home'),
 
 ]
\ No newline at end of file
@@ -0,0 +1,200 @@
+import networkx as nx
+import numpy as np
+from scipy.sparse.csgraph import dijkstra, yen
+
+from django.conf import settings
+
+from .async_executor import check_deadline
+from .csr_graph import predecessors_to_path
+from .landmarks import point_to_point
+
+
+def _overlap(path1, path2):
+    set1, set2 = set(path1), set(path2)
+    return len(set1 & set2) / len(set1 | set2)
+
+
+def _no_path(orig_node, dest_node):
+    return nx.NetworkXNoPath(f"No path between {orig_node} and {dest_node}.")
+
+
+def yen_alternatives(G, orig_node, dest_node, weight, k):
+    """
+    Returns the k shortest simple paths (Yen's algorithm).
+
+    Exact but slow, as it runs a shortest path search for every spur node of
+    every path found. Kept as the reference engine for comparison.
+    """
+
+    check_deadline()
+    _, predecessors = yen(G.matrix(weight), orig_node, dest_node, k, return_predecessors=True)
+    if len(predecessors) == 0:
+        raise _no_path(orig_node, dest_node)
+
+    return [predecessors_to_path(row, orig_node, dest_node) for row in predecessors]
+
+
+def penalty_alternatives(G, orig_node, dest_node, weight, k, penalty=1.4, max_stretch=1.5, max_iterations=None):
+    """
+    Returns up to k diverse paths with the penalty method.
+
+    After each search the edges of the found path (and their reverse edges)
+    get their weight multiplied by ``penalty``, so the next search is pushed
+    onto a different route. Paths longer than ``max_stretch`` times the
+    shortest path (measured with the original weight) are dropped.
+
+    Args:
+        G (CSRGraph): Graph to search.
+        orig_node (int): Start node index.
+        dest_node (int): End node index.
+        weight (str): Weight column to minimise.
+        k (int): Number of paths to return.
+        penalty (float): Factor applied to the weight of used edges.
+        max_stretch (float): Maximum cost of a path relative to the shortest one.
+        max_iterations (int): Maximum number of searches, 2 * k by default.
+
+    Returns:
+        list: List of paths (arrays of node indices), shortest first.
+    """
+
+    base_weights = G.cost(weight)
+    factors = np.ones(G.n_edges)
+
+    paths = []
+    costs = []
+    seen = set()
+    best_cost = None
+
+    for _ in range(max_iterations or 2 * k):
+        check_deadline()
+        # Penalties only raise costs, so the landmark bounds of the base weight stay valid
+        _, path, _ = point_to_point(G, orig_node, dest_node, weight, base_weights * factors)
+        if path is None:
+            break
+
+        edge_ids = G.edge_ids(path)
+        cost = float(base_weights[edge_ids].sum())
+        if best_cost is None:
+            best_cost = cost
+
+        if tuple(path) not in seen and cost <= max_stretch * best_cost:
+            seen.add(tuple(path))
+            paths.append(path)
+            costs.append(cost)
+            if len(paths) == k:
+                break
+
+        factors[edge_ids] *= penalty
+        reverse_ids = np.array([G.edge_id(v, u) for u, v in zip(path[:-1], path[1:])])
+        factors[reverse_ids[reverse_ids >= 0]] *= penalty
+
+    if not paths:
+        raise _no_path(orig_node, dest_node)
+
+    return [paths[i] for i in np.argsort(costs, kind='stable')]
+
+
+def via_node_alternatives(G, orig_node, dest_node, weight, k, max_stretch=1.3, max_overlap=0.8):
+    """
+    Returns up to k diverse paths through via nodes.
+
+    One Dijkstra search is run from the start and one towards the end (on the
+    reversed graph), both bounded by ``max_stretch`` times the shortest path.
+    Every settled node v then gives the candidate path start -> v -> end of
+    cost d(start, v) + d(v, end). Candidates are taken from the cheapest up,
+    skipping paths with loops and paths overlapping more than ``max_overlap``
+    with an already chosen path.
+
+    Args:
+        G (CSRGraph): Graph to search.
+        orig_node (int): Start node index.
+        dest_node (int): End node index.
+        weight (str): Weight column to minimise.
+        k (int): Number of paths to return.
+        max_stretch (float): Maximum cost of a path relative to the shortest one.
+        max_overlap (float): Maximum Jaccard similarity to an already chosen path.
+
+    Returns:
+        list: List of paths (arrays of node indices), shortest first.
+    """
+
+    check_deadline()
+    matrix = G.matrix(weight)
+    dist_from, pred_from = dijkstra(matrix, indices=orig_node, return_predecessors=True)
+    best_cost = dist_from[dest_node]
+    if np.isinf(best_cost):
+        raise _no_path(orig_node, dest_node)
+
+    cutoff = max_stretch * best_cost
+    dist_to, pred_to = dijkstra(G.reverse_matrix(weight), indices=dest_node, limit=cutoff, return_predecessors=True)
+
+    total = dist_from + dist_to
+    via_nodes = np.flatnonzero(total <= cutoff)
+    via_nodes = via_nodes[np.argsort(total[via_nodes], kind='stable')]
+
+    paths = [predecessors_to_path(pred_from, orig_node, dest_node)]
+    for v in via_nodes:
+        if len(paths) == k:
+            break
+
+        to_via = predecessors_to_path(pred_from, orig_node, v)
+        # The search on the reversed graph gives the path from the end back to v
+        from_via = predecessors_to_path(pred_to, dest_node, v)
+        path = np.concatenate((to_via, from_via[::-1][1:]))
+
+        if len(np.unique(path)) != len(path):
+            continue
+        if any(_overlap(path, chosen) > max_overlap for chosen in paths):
+            continue
+        paths.append(path)
+
+    return paths
+
+
+ALTERNATIVE_ENGINES = {
+    'yen': yen_alternatives,
+    'penalty': penalty_alternatives,
+    'via': via_node_alternatives,
+}
+
+
+def get_engine_name(commute_mode, routing_mode):
+    """
+    Returns the name of the engine configured for a commute and routing mode.
+
+    ``settings.ROUTING_ALTERNATIVES_ENGINE`` is looked up with the keys
+    '<commute_mode>/<routing_mode>', '<commute_mode>', '<routing_mode>' and
+    'default', in this order.
+    """
+
+    engines = getattr(settings, 'ROUTING_ALTERNATIVES_ENGINE', {})
+    for key in (f'{commute_mode}/{routing_mode}', commute_mode, routing_mode, 'default'):
+        if key in engines:
+            return engines[key]
+    return 'yen'
+
+
+def alternative_paths(G, orig_node, dest_node, weight, commute_mode, routing_mode, k=None, engine=None):
+    """
+    Returns up to k candidate paths using the engine configured for the mode.
+
+    Args:
+        G (CSRGraph): Graph to search.
+        orig_node (int): Start node index.
+        dest_node (int): End node index.
+        weight (str): Weight column to minimise.
+        commute_mode (str): 'walk' or 'bike'.
+        routing_mode (str): 'noise', 'vegetation', 'heat' or None.
+        k (int): Number of candidates, ``settings.ROUTING_CANDIDATE_PATHS`` by default.
+        engine (str): Name of the engine, overrides the setting.
+
+    Returns:
+        list: List of paths (arrays of node indices).
+    """
+
+    engine = engine or get_engine_name(commute_mode, routing_mode)
+    if engine not in ALTERNATIVE_ENGINES:
+        raise ValueError(f"Unknown alternative routes engine: {engine}")
+
+    k = k or getattr(settings, 'ROUTING_CANDIDATE_PATHS', 25)
+    return ALTERNATIVE_ENGINES[engine](G, orig_node, dest_node, weight, k)
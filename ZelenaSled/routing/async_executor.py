@@ -0,0 +1,151 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+DEFAULTS = {
+    # Routing searches running at the same time
+    'WORKERS': 4,
+    # Requests running or waiting for a worker before new ones are rejected
+    'MAX_QUEUE': 32,
+    # Seconds a request waits for its result before the search is abandoned
+    'DEADLINE': 10,
+}
+
+
+class ExecutorSaturated(Exception):
+    """Raised when the queue of an executor is full."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a job doesn't finish before its deadline."""
+
+
+# Deadline (time.monotonic()) of the executor job running in this context, None outside of jobs
+_deadline = contextvars.ContextVar('routing_deadline', default=None)
+
+
+def check_deadline():
+    """
+    Raises DeadlineExceeded if the executor job running in this context is past its deadline.
+
+    Searches call it between their steps, so a job its caller stopped waiting
+    for ends soon after and gives back its worker and admission slot.
+    """
+
+    deadline = _deadline.get()
+    if deadline is not None and time.monotonic() > deadline:
+        raise DeadlineExceeded("Deadline passed during the search")
+
+
+def time_left(limit):
+    """Returns ``limit`` seconds, or less if the deadline of the executor job running in this context is closer."""
+
+    deadline = _deadline.get()
+    if deadline is None:
+        return limit
+    return max(min(limit, deadline - time.monotonic()), 0.0)
+
+
+class BoundedExecutor:
+    """
+    Runs blocking routing work off the event loop with bounded concurrency.
+
+    At most ``workers`` jobs run at once and at most ``max_queue`` jobs are
+    admitted (running or waiting); anything beyond that is rejected straight
+    away so callers can answer 503 instead of piling up requests. A job that
+    is still waiting for a worker when its deadline passes is dropped without
+    running; a running job is abandoned at its next ``check_deadline``, so
+    slow searches don't hold their slots after their callers gave up.
+    """
+
+    def __init__(self, workers=4, max_queue=32):
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='routing')
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self.stats = {'completed': 0, 'rejected': 0, 'timed_out': 0, 'dropped': 0, 'abandoned': 0}
+
+    @property
+    def queue_depth(self):
+        return self._admitted
+
+    def _admit(self):
+        with self._lock:
+            if self._admitted >= self.max_queue:
+                self.stats['rejected'] += 1
+                raise ExecutorSaturated(f"{self._admitted} routing requests are already queued")
+            self._admitted += 1
+
+    def _release(self, future=None):
+        with self._lock:
+            self._admitted -= 1
+
+    def _run(self, deadline, function, args):
+        if time.monotonic() > deadline:
+            with self._lock:
+                self.stats['dropped'] += 1
+            raise DeadlineExceeded("Deadline passed before the search started")
+
+        # Runs in a copy of the caller's context, the deadline is only seen by this job
+        _deadline.set(deadline)
+        try:
+            return function(*args)
+        except DeadlineExceeded:
+            with self._lock:
+                self.stats['abandoned'] += 1
+            raise
+
+    async def run(self, function, *args, timeout):
+        """
+        Runs ``function(*args)`` in a worker thread and awaits its result.
+
+        Raises:
+            ExecutorSaturated: If the queue is full.
+            DeadlineExceeded: If the result isn't ready within ``timeout`` seconds.
+        """
+
+        self._admit()
+        deadline = time.monotonic() + timeout
+        try:
+            # Run in a copy of the caller's context, so request-scoped state (e.g. timings) follows the job
+            future = self._executor.submit(contextvars.copy_context().run, self._run, deadline, function, args)
+        except BaseException:
+            self._release()
+            raise
+        # The slot is freed when the job finishes, even if its caller stopped waiting
+        future.add_done_callback(self._release)
+
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            # Drops a job still waiting for a worker, a running one stops at its next check_deadline
+            future.cancel()
+            with self._lock:
+                self.stats['timed_out'] += 1
+            raise DeadlineExceeded(f"No result within {timeout} s")
+
+        with self._lock:
+            self.stats['completed'] += 1
+        return result
+
+
+_executor = None
+
+
+def get_routing_executor():
+    """Returns the BoundedExecutor configured by ``settings.ROUTING_ASYNC``."""
+
+    global _executor
+    if _executor is None:
+        config = {**DEFAULTS, **getattr(settings, 'ROUTING_ASYNC', {})}
+        _executor = BoundedExecutor(workers=config['WORKERS'], max_queue=config['MAX_QUEUE'])
+    return _executor
+
+
+def get_deadline():
+    return {**DEFAULTS, **getattr(settings, 'ROUTING_ASYNC', {})}['DEADLINE']
@@ -0,0 +1,212 @@
+import multiprocessing
+import os
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from scipy.sparse.csgraph import dijkstra
+
+from django.conf import settings
+
+from .csr_graph import predecessors_to_path
+from .exposure import path_average, path_exposure
+from .layers import get_graph_registry
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_batch_pool():
+    """
+    Returns the process pool used for batch routing, or None to run in-process.
+
+    Workers are spawned rather than forked, as the server process runs other
+    threads (graph warm-up, layer watcher, requests) whose locks could be
+    left held in a forked child. Every worker loads the graphs on first use;
+    snapshots are memory-mapped, so they share the pages of the server's
+    graphs (see ``ROUTING_SHARED_GRAPHS``).
+    """
+
+    global _pool
+    workers = getattr(settings, 'ROUTING_BATCH_WORKERS', os.cpu_count())
+    if not workers:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+            )
+        return _pool
+
+
+def _discard_pool(pool):
+    # A worker died: the pool can't run tasks anymore, the next batch starts a new one
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _init_worker():
+    django.setup()
+    # Changed layer files are applied before each task (see ``_run_task``), no watcher thread per worker
+    get_graph_registry().watch_enabled = False
+
+
+def _run_task(function, *args):
+    registry = get_graph_registry()
+    if registry.loaded():
+        registry.reload()
+    return function(*args)
+
+
+def route_pair(index, pair, commute_mode, routing_mode, weights=None, pareto=False, precision=None,
+               geometry_format=None, departure_time=None, simplify=None, zoom=None):
+    """
+    Plans the route of one origin-destination pair of a batch.
+
+    Returns:
+        dict: The pair index and its GeoJSON, or an error message and status.
+    """
+
+    from .views import RouteRequestError, plan_route
+
+    try:
+        geojson = plan_route(
+            pair.get('origin_coords'),
+            pair.get('destination_coords'),
+            pair.get('commute_mode', commute_mode),
+            pair.get('routing_mode', routing_mode),
+            pair.get('weights', weights),
+            pair.get('pareto', pareto),
+            pair.get('precision', precision),
+            pair.get('format', geometry_format),
+            pair.get('departure_time', departure_time),
+            pair.get('simplify', simplify),
+            pair.get('zoom', zoom),
+        )
+        return {'index': index, 'geojson': geojson}
+    except RouteRequestError as e:
+        return {'index': index, 'error': str(e), 'status': e.status}
+    except Exception as e:
+        traceback.print_exc()
+        return {'index': index, 'error': str(e), 'status': 500}
+
+
+def matrix_row(index, origin_coords, destinations_coords, commute_mode):
+    """
+    Returns the shortest path length and exposure from one origin to many destinations.
+
+    A single Dijkstra search from the origin settles all destinations; NDVI,
+    heat and noise are length-weighted averages along each shortest path.
+    """
+
+    from .views import RouteRequestError, get_graph, is_within_bbox
+
+    try:
+        G_graph = get_graph(commute_mode)
+        points = [origin_coords, *destinations_coords]
+        if not all(point and is_within_bbox(point) for point in points):
+            raise RouteRequestError("Coordinates are outside the allowed area (Ljubljana)")
+
+        nodes, _ = G_graph.spatial_index.nearest_nodes([p[1] for p in points], [p[0] for p in points])
+        source, targets = nodes[0], nodes[1:]
+        dist, predecessors = dijkstra(G_graph.matrix('length'), indices=source, return_predecessors=True)
+
+        row = {'index': index, 'length_m': [], 'average_ndvi': [], 'average_heat': [], 'average_noise': []}
+        for target in targets:
+            path = predecessors_to_path(predecessors, source, target)
+            if path is None:
+                for values in row.values():
+                    if isinstance(values, list):
+                        values.append(None)
+                continue
+
+            row['length_m'].append(float(dist[target]))
+            row['average_ndvi'].append(path_exposure(G_graph, path, 'ndvi'))
+            row['average_heat'].append(path_exposure(G_graph, path, 'heat'))
+            row['average_noise'].append(path_average(G_graph, path, 'noise'))
+        return row
+
+    except RouteRequestError as e:
+        return {'index': index, 'error': str(e), 'status': e.status}
+    except Exception as e:
+        traceback.print_exc()
+        return {'index': index, 'error': str(e), 'status': 500}
+
+
+def run_batch(tasks):
+    """
+    Runs batch tasks and yields their results as they complete.
+
+    Args:
+        tasks (list): List of (function, args) tuples.
+
+    Yields:
+        dict: Result of each task, in completion order.
+    """
+
+    pool = get_batch_pool()
+    if pool is None:
+        for function, args in tasks:
+            yield function(*args)
+        return
+
+    # Tasks take their index as the first argument
+    futures = {pool.submit(_run_task, function, *args): args[0] for function, args in tasks}
+    for future in as_completed(futures):
+        try:
+            yield future.result()
+        except BrokenProcessPool as e:
+            _discard_pool(pool)
+            yield {'index': futures[future], 'error': f"Batch worker failed: {e}", 'status': 500}
+
+
+def batch_tasks(data):
+    """
+    Turns a batch request into tasks.
+
+    Pairs mode: {"pairs": [{"origin_coords", "destination_coords"}, ...]},
+    with optional per-pair "commute_mode", "routing_mode", "weights",
+    "pareto", "precision", "format", "departure_time", "simplify" and
+    "zoom" overriding the top-level ones. Matrix mode: {"mode": "matrix", "origins": [...],
+    "destinations": [...]}, one task per origin, with at most
+    ``ROUTING_BATCH_MAX_PAIRS`` origins.
+
+    Raises:
+        ValueError: If the request is malformed or too large.
+    """
+
+    max_pairs = getattr(settings, 'ROUTING_BATCH_MAX_PAIRS', 1000)
+    commute_mode = data.get('commute_mode')
+
+    if data.get('mode') == 'matrix':
+        origins = data.get('origins') or []
+        destinations = data.get('destinations') or []
+        if not origins or not destinations:
+            raise ValueError("Origins and destinations are required")
+        # Every origin is a search of the whole graph, like a pair, destinations only cost a lookup each
+        if len(origins) > max_pairs:
+            raise ValueError(f"At most {max_pairs} origins can be routed in one batch")
+        if len(origins) * len(destinations) > max_pairs * 100:
+            raise ValueError("Too many origin-destination pairs")
+        return [(matrix_row, (i, origin, destinations, commute_mode)) for i, origin in enumerate(origins)]
+
+    pairs = data.get('pairs') or []
+    if not pairs:
+        raise ValueError("Origin-destination pairs are required")
+    if len(pairs) > max_pairs:
+        raise ValueError(f"At most {max_pairs} pairs can be routed in one batch")
+    return [
+        (route_pair, (
+            i, pair, commute_mode, data.get('routing_mode'), data.get('weights'), data.get('pareto', False),
+            data.get('precision'), data.get('format'), data.get('departure_time'),
+            data.get('simplify'), data.get('zoom'),
+        ))
+        for i, pair in enumerate(pairs)
+    ]
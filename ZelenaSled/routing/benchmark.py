@@ -0,0 +1,481 @@
+import json
+import os
+import platform
+import shutil
+import time
+import zipfile
+from collections import defaultdict
+
+import geopandas as gpd
+import h3
+import networkx as nx
+import numpy as np
+import osmnx as ox
+import shapely
+from pyproj import Transformer
+from shapely.geometry import LineString
+
+from .alternatives import penalty_alternatives, via_node_alternatives, yen_alternatives
+from .corridor import corridor_search
+from .diversity import get_diversity_settings, select_diverse
+from .exposure import path_exposure
+from .h3_store import H3_LAYERS, H3_RESOLUTION, H3LayerStore
+from .metrics import collect_timings
+from .noise import NOISE_FILE, NoiseIndex
+from .preprocessing import GRAPH_FILES, process_graph
+from .serialize import feature_collection, to_json
+from .spatial_index import METRIC_CRS
+
+
+# Side of the synthetic street grid in nodes; 'ljubljana' is about the size
+# of the walking graph of the city (48k nodes, 160k edges)
+CITY_SIZES = {
+    'small': 60,
+    'medium': 120,
+    'ljubljana': 220,
+}
+
+# Centre of the synthetic city (lat, lon), inside the Ljubljana bounding box
+CITY_CENTER = (46.0511, 14.5051)
+
+# Distance between neighbouring grid nodes in meters
+BLOCK_M = 80
+
+# Straight-line origin-destination distances of the benchmarked trips
+TRIP_LENGTHS_M = {
+    'short': 1000,
+    'medium': 3000,
+    'long': 7000,
+}
+
+# Routing modes run end to end; 'weighted' is a multi-criteria search
+END_TO_END_MODES = (None, 'vegetation', 'heat', 'noise', 'weighted')
+
+WEIGHTS = {'length': 1, 'noise': 0.5, 'vegetation': 1, 'heat': 0.5}
+
+# Radius of the synthetic noise hexagons in meters, as in the Noise-Planet data
+NOISE_HEXAGON_M = 15
+
+# Rings of H3 cells around every node covered by the synthetic layers
+H3_RINGS = 6
+
+# Candidate paths searched per query, as ROUTING_CANDIDATE_PATHS
+CANDIDATE_PATHS = 25
+
+
+def synthetic_city(side, seed=0, block_m=BLOCK_M):
+    """
+    Generates a street graph shaped like a city, without an OSM download.
+
+    Nodes sit on a jittered grid around CITY_CENTER. Some links are removed
+    so blocks have irregular sizes, some edges are curved (they get a
+    'geometry' like OSMnx edges) and some node pairs have a second, longer
+    parallel edge, so every preprocessing step has real work to do.
+
+    Args:
+        side (int): Nodes along each side of the grid.
+        seed (int): Seed of the random generator.
+        block_m (float): Distance between neighbouring nodes in meters.
+
+    Returns:
+        nx.MultiDiGraph: Street graph in EPSG:4326 with both directions of every street.
+    """
+
+    rng = np.random.default_rng(seed)
+    to_metric = Transformer.from_crs("EPSG:4326", METRIC_CRS, always_xy=True)
+    to_lonlat = Transformer.from_crs(METRIC_CRS, "EPSG:4326", always_xy=True)
+
+    center_x, center_y = to_metric.transform(CITY_CENTER[1], CITY_CENTER[0])
+    rows, cols = np.divmod(np.arange(side * side), side)
+    x = center_x + (cols - side / 2) * block_m + rng.uniform(-0.2, 0.2, side * side) * block_m
+    y = center_y + (rows - side / 2) * block_m + rng.uniform(-0.2, 0.2, side * side) * block_m
+    lon, lat = to_lonlat.transform(x, y)
+
+    G = nx.MultiDiGraph(crs="EPSG:4326")
+    node_ids = np.arange(side * side, dtype=np.int64) + 1000
+    for node, node_lon, node_lat in zip(node_ids.tolist(), lon.tolist(), lat.tolist()):
+        G.add_node(node, x=node_lon, y=node_lat, street_count=4)
+
+    # Horizontal and vertical links of the grid, 15% of them removed
+    index = np.arange(side * side).reshape(side, side)
+    links = np.concatenate((
+        np.column_stack((index[:, :-1].ravel(), index[:, 1:].ravel())),
+        np.column_stack((index[:-1, :].ravel(), index[1:, :].ravel())),
+    ))
+    links = links[rng.random(len(links)) >= 0.15]
+
+    straight = np.hypot(x[links[:, 1]] - x[links[:, 0]], y[links[:, 1]] - y[links[:, 0]])
+    curved = rng.random(len(links)) < 0.2
+    parallel = rng.random(len(links)) < 0.05
+    bend = rng.uniform(-0.25, 0.25, len(links)) * block_m
+
+    for i, (a, b) in enumerate(links.tolist()):
+        u, v = int(node_ids[a]), int(node_ids[b])
+        attrs = {'length': float(straight[i]), 'highway': 'residential', 'oneway': False}
+
+        if curved[i]:
+            # Bend the street sideways through a midpoint
+            mx = (x[a] + x[b]) / 2 - (y[b] - y[a]) / straight[i] * bend[i]
+            my = (y[a] + y[b]) / 2 + (x[b] - x[a]) / straight[i] * bend[i]
+            mid_lon, mid_lat = to_lonlat.transform(mx, my)
+            coords = [(lon[a], lat[a]), (mid_lon, mid_lat), (lon[b], lat[b])]
+            attrs['length'] = float(np.hypot(mx - x[a], my - y[a]) + np.hypot(x[b] - mx, y[b] - my))
+            attrs['geometry'] = LineString(coords)
+
+        G.add_edge(u, v, **attrs)
+        reverse = dict(attrs)
+        if curved[i]:
+            reverse['geometry'] = LineString(coords[::-1])
+        G.add_edge(v, u, **reverse)
+
+        if parallel[i]:
+            detour = {**attrs, 'length': attrs['length'] * 1.3}
+            G.add_edge(u, v, **detour)
+            G.add_edge(v, u, **{**reverse, 'length': detour['length']})
+
+    return G
+
+
+def _smooth_field(x, y, rng, low, high):
+    # Values varying over a few kilometres plus local noise, scaled to low-high
+    phase = rng.uniform(0, 2 * np.pi, 4)
+    field = (np.sin(x / 1500 + phase[0]) + np.sin(y / 2100 + phase[1])
+             + 0.5 * np.sin((x + y) / 700 + phase[2]) + 0.5 * rng.standard_normal(len(x)))
+    field = (field - field.min()) / max(field.max() - field.min(), 1e-9)
+    return low + field * (high - low)
+
+
+def synthetic_noise(G, seed=0, share=0.4):
+    """
+    Generates Noise-Planet style measurements: hexagons along the streets.
+
+    Args:
+        G (nx.MultiDiGraph): Street graph from ``synthetic_city``.
+        seed (int): Seed of the random generator.
+        share (float): Share of the edges with a measurement near their middle.
+
+    Returns:
+        NoiseIndex: Hexagons with LA50 values between 40 and 75 dB.
+    """
+
+    rng = np.random.default_rng(seed + 1)
+    to_metric = Transformer.from_crs("EPSG:4326", METRIC_CRS, always_xy=True)
+
+    edges = np.array([(u, v) for u, v, _ in G.edges(keys=True)])
+    edges = edges[rng.random(len(edges)) < share]
+    lon = np.array([(G.nodes[u]['x'] + G.nodes[v]['x']) / 2 for u, v in edges])
+    lat = np.array([(G.nodes[u]['y'] + G.nodes[v]['y']) / 2 for u, v in edges])
+    x, y = to_metric.transform(lon, lat)
+    x, y = x + rng.normal(0, 5, len(x)), y + rng.normal(0, 5, len(y))
+
+    angles = np.linspace(0, 2 * np.pi, 7)
+    rings = np.stack((
+        x[:, None] + NOISE_HEXAGON_M * np.cos(angles),
+        y[:, None] + NOISE_HEXAGON_M * np.sin(angles),
+    ), axis=-1)
+    return NoiseIndex(shapely.polygons(rings), _smooth_field(x, y, rng, 40, 75))
+
+
+def synthetic_h3_layer(G, low, high, seed=0, share=0.9):
+    """
+    Generates an H3 layer covering the streets around most nodes.
+
+    Every kept node covers the cells within H3_RINGS rings of its own cell
+    with one value of a smooth random field, so neighbouring edges get
+    similar values and some parts of the city have no data.
+
+    Returns:
+        H3LayerStore: The layer, with values between low and high.
+    """
+
+    rng = np.random.default_rng(seed + 2)
+    to_metric = Transformer.from_crs("EPSG:4326", METRIC_CRS, always_xy=True)
+
+    nodes = [node for node in G.nodes if rng.random() < share]
+    lon = np.array([G.nodes[node]['x'] for node in nodes])
+    lat = np.array([G.nodes[node]['y'] for node in nodes])
+    node_values = _smooth_field(*to_metric.transform(lon, lat), rng, low, high)
+
+    cells, values = [], []
+    for node_lat, node_lon, value in zip(lat.tolist(), lon.tolist(), node_values.tolist()):
+        disk = h3.grid_disk(h3.latlng_to_cell(node_lat, node_lon, H3_RESOLUTION), H3_RINGS)
+        cells.extend(h3.str_to_int(cell) for cell in disk)
+        values.extend([value] * len(disk))
+
+    cells, first = np.unique(np.array(cells, dtype=np.uint64), return_index=True)
+    return H3LayerStore(cells, np.array(values, dtype=np.float32)[first])
+
+
+# Written into a directory of synthetic data files, with the size and seed they were generated with
+SYNTHETIC_MARKER = 'synthetic.json'
+
+# Value ranges of the synthetic H3 layers
+H3_LAYER_RANGES = {
+    'ndvi': (-0.1, 0.9),
+    'heat': (25, 45),
+}
+
+
+def write_synthetic_data(data_dir, size='medium', seed=0):
+    """
+    Writes the data files of a synthetic city, so the server runs without the real ones.
+
+    The walk and bike GraphML graphs, the noise GeoJSON and the zipped H3
+    layers are written in the formats of the real files; point
+    ``ROUTING_DATA_DIR`` to the directory to serve them. Files written
+    before with the same size and seed are reused.
+
+    Returns:
+        tuple: (min_lon, min_lat, max_lon, max_lat) of the city.
+
+    Raises:
+        ValueError: If the directory holds other files than synthetic data.
+    """
+
+    marker = os.path.join(data_dir, SYNTHETIC_MARKER)
+    config = {'size': size, 'seed': seed}
+    if os.path.exists(marker):
+        with open(marker) as f:
+            written = json.load(f)
+        if {key: written.get(key) for key in config} == config:
+            return tuple(written['bounds'])
+        # Generated with other options: remove it with the stores and snapshots built from it
+        shutil.rmtree(data_dir)
+    elif os.path.isdir(data_dir) and os.listdir(data_dir):
+        raise ValueError(f"{data_dir} is not empty and holds no synthetic data")
+
+    os.makedirs(data_dir, exist_ok=True)
+    G = synthetic_city(CITY_SIZES[size], seed)
+    for graph_file in GRAPH_FILES.values():
+        ox.save_graphml(G, os.path.join(data_dir, graph_file))
+
+    noise_index = synthetic_noise(G, seed)
+    gpd.GeoDataFrame(
+        {'la50': noise_index.values}, geometry=noise_index.polygons, crs=noise_index.crs,
+    ).to_crs("EPSG:4326").to_file(os.path.join(data_dir, NOISE_FILE), driver='GeoJSON')
+
+    for i, (layer, name) in enumerate(H3_LAYERS.items()):
+        store = synthetic_h3_layer(G, *H3_LAYER_RANGES[layer], seed + 10 * i)
+        layer_h3 = dict(zip(map(h3.int_to_str, store.cells.tolist()), store.values.tolist()))
+        with zipfile.ZipFile(os.path.join(data_dir, f'{name}.zip'), 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+            zip_ref.writestr(f'{name}.json', json.dumps(layer_h3))
+
+    lon = [x for _, x in G.nodes(data='x')]
+    lat = [y for _, y in G.nodes(data='y')]
+    bounds = (min(lon), min(lat), max(lon), max(lat))
+    with open(marker, 'w') as f:
+        json.dump({**config, 'bounds': bounds}, f)
+    return bounds
+
+
+def trip_pairs(G, length_m, count, seed=0, tolerance=0.15):
+    """
+    Picks origin-destination node pairs about ``length_m`` apart in a straight line.
+
+    Returns:
+        list: (orig_node, dest_node) index pairs, fewer than ``count`` if the
+        city is too small for the trip length.
+    """
+
+    rng = np.random.default_rng(seed + int(length_m))
+    node_xy = G.spatial_index.node_xy
+    pairs = []
+    for _ in range(count * 50):
+        if len(pairs) == count:
+            break
+        orig_node = int(rng.integers(G.n_nodes))
+        distance = np.hypot(*(node_xy - node_xy[orig_node]).T)
+        candidates = np.flatnonzero(np.abs(distance - length_m) <= tolerance * length_m)
+        if len(candidates):
+            pairs.append((orig_node, int(rng.choice(candidates))))
+    return pairs
+
+
+class BenchmarkResults:
+    """Durations of benchmark stages, keyed by '<trip>/<stage>'."""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+
+    def add(self, key, seconds):
+        self.durations[key].append(seconds)
+
+    def timed(self, key, function, *args, **kwargs):
+        """Calls a function and records its duration, returns its result."""
+
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.add(key, time.perf_counter() - start)
+        return result
+
+    def add_stages(self, prefix, timings):
+        for name, seconds in timings.stages.items():
+            self.add(f'{prefix}/{name}', seconds)
+
+    def summary(self):
+        """Returns {key: {'median_ms', 'p95_ms', 'runs'}}."""
+
+        return {
+            key: {
+                'median_ms': round(float(np.median(values)) * 1000, 3),
+                'p95_ms': round(float(np.percentile(values, 95)) * 1000, 3),
+                'runs': len(values),
+            }
+            for key, values in sorted(self.durations.items())
+        }
+
+
+def benchmark_queries(G, noise_index, results, trip, pairs, yen=True):
+    """Times every stage of the route search for some origin-destination pairs and then the whole search."""
+
+    from .views import build_path_data, compute_paths, get_top_3_ndvi, get_top_3_quietest_paths
+
+    engines = {'penalty': penalty_alternatives, 'via': via_node_alternatives}
+    if yen:
+        engines['yen'] = yen_alternatives
+
+    spatial_index = G.spatial_index
+    for orig_node, dest_node in pairs:
+        lon, lat = G.x[[orig_node, dest_node]], G.y[[orig_node, dest_node]]
+        origin_coords, destination_coords = (lat[0], lon[0]), (lat[1], lon[1])
+
+        results.timed(f'{trip}/snap', spatial_index.nearest_nodes, lon, lat)
+
+        candidates = {}
+        for name, engine in engines.items():
+            candidates[name] = results.timed(
+                f'{trip}/search_{name}', corridor_search, G, orig_node, dest_node,
+                lambda G_search, o, d, engine=engine: engine(G_search, o, d, 'length', CANDIDATE_PATHS),
+            )
+
+        paths = candidates['yen' if yen else 'penalty']
+        results.timed(f'{trip}/select_diverse', select_diverse, paths, get_diversity_settings()['K'])
+
+        path_data = results.timed(
+            f'{trip}/path_geometry', build_path_data, G, paths, origin_coords, destination_coords,
+        )
+        for path, path_info in zip(paths, path_data):
+            path_info['average_ndvi'] = path_exposure(G, path, 'ndvi')
+        selected = results.timed(f'{trip}/get_top_3_ndvi', get_top_3_ndvi, path_data, paths)
+
+        results.timed(f'{trip}/get_top_3_quietest_paths', get_top_3_quietest_paths,
+                      [dict(path_info) for path_info in path_data], paths, noise_index)
+        results.timed(f'{trip}/serialize', lambda: to_json(feature_collection(selected)))
+
+        for routing_mode in END_TO_END_MODES:
+            weights = WEIGHTS if routing_mode == 'weighted' else None
+            key = f'{trip}/end_to_end_{routing_mode or "shortest"}'
+            with collect_timings() as timings:
+                results.timed(
+                    key, compute_paths, G, orig_node, dest_node, None, 'walk',
+                    None if weights else routing_mode, origin_coords, destination_coords,
+                    weights, False, noise_index,
+                )
+            results.add_stages(key, timings)
+
+
+def run_benchmarks(size='ljubljana', seed=0, queries=5, trips=None, yen=True, log=print):
+    """
+    Builds a synthetic city and times the preprocessing and route search stages.
+
+    Args:
+        size (str): Key of CITY_SIZES.
+        seed (int): Seed of the synthetic data and the trips.
+        queries (int): Origin-destination pairs per trip length.
+        trips (list): Keys of TRIP_LENGTHS_M, all by default.
+        yen (bool): Also time Yen's k shortest paths, the slowest engine.
+        log (callable): Receives progress messages.
+
+    Returns:
+        dict: Benchmark metadata and {'<trip>/<stage>': {'median_ms', 'p95_ms', 'runs'}}.
+    """
+
+    results = BenchmarkResults()
+
+    log(f"Generating a {size} synthetic city")
+    G_multi = results.timed('data/city', synthetic_city, CITY_SIZES[size], seed)
+    noise_index = results.timed('data/noise', synthetic_noise, G_multi, seed)
+    h3_stores = {
+        layer: results.timed(f'data/h3_{layer}', synthetic_h3_layer, G_multi, *H3_LAYER_RANGES[layer], seed + 10 * i)
+        for i, layer in enumerate(H3_LAYERS)
+    }
+
+    log(f"Preparing the graph ({G_multi.number_of_nodes()} nodes, {G_multi.number_of_edges()} edges)")
+    with collect_timings() as timings:
+        G = results.timed('build/total', process_graph, G_multi, noise_index, h3_stores)
+    results.add_stages('build', timings)
+    results.timed('build/spatial_index', lambda: G.spatial_index)
+    results.timed('build/search_arrays', G.prepare_search_arrays)
+
+    for trip in trips or TRIP_LENGTHS_M:
+        pairs = trip_pairs(G, TRIP_LENGTHS_M[trip], queries + 1, seed)
+        if len(pairs) < 2:
+            log(f"Skipping {trip} trips, the city is too small")
+            continue
+
+        log(f"Routing {len(pairs) - 1} {trip} trips")
+        # The first pair warms up the caches of the graph and is not recorded
+        benchmark_queries(G, noise_index, BenchmarkResults(), trip, pairs[:1], yen)
+        benchmark_queries(G, noise_index, results, trip, pairs[1:], yen)
+
+    return {
+        'meta': {
+            'size': size,
+            'nodes': G.n_nodes,
+            'edges': G.n_edges,
+            'seed': seed,
+            'queries': queries,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results.summary(),
+    }
+
+
+def compare(results, baseline, threshold=0.25, min_ms=1.0):
+    """
+    Compares benchmark results with a baseline.
+
+    A stage regressed if its median is more than ``threshold`` (a share)
+    slower than in the baseline and also at least ``min_ms`` slower, so
+    stages of a few microseconds don't flag timer noise. Generating the
+    synthetic data ('data/...') is reported but never flagged.
+
+    Returns:
+        tuple: (rows of (key, baseline ms, current ms, ratio, status), keys of the regressed stages).
+    """
+
+    rows, regressions = [], []
+    current, previous = results['results'], baseline['results']
+    for key in sorted(set(current) | set(previous)):
+        if key not in previous or key not in current:
+            rows.append((key, previous.get(key, {}).get('median_ms'), current.get(key, {}).get('median_ms'),
+                         None, 'new' if key in current else 'missing'))
+            continue
+
+        before, after = previous[key]['median_ms'], current[key]['median_ms']
+        ratio = after / before if before > 0 else float('inf')
+        if key.startswith('data/'):
+            status = 'info'
+        elif ratio > 1 + threshold and after - before >= min_ms:
+            status = 'REGRESSION'
+            regressions.append(key)
+        elif ratio < 1 - threshold and before - after >= min_ms:
+            status = 'faster'
+        else:
+            status = 'ok'
+        rows.append((key, before, after, ratio, status))
+    return rows, regressions
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write('\n')
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
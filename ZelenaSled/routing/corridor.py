@@ -0,0 +1,147 @@
+import networkx as nx
+import numpy as np
+
+from django.conf import settings
+
+from .async_executor import check_deadline
+from .csr_graph import CSRGraph
+from .landmarks import Landmarks
+
+
+DEFAULTS = {
+    # Search in a corridor around origin and destination instead of the whole graph
+    'ENABLED': True,
+    # Longest detour allowed by the corridor, as a multiple of the straight-line distance
+    'STRETCH': 1.6,
+    # Extra meters around origin and destination, so short trips still get some room
+    'MARGIN_M': 300,
+    # Factor the detour and margin grow by when no path is found in the corridor
+    'WIDEN': 2.0,
+    # Corridors tried before falling back to the whole graph
+    'ATTEMPTS': 2,
+    # Corridors holding more than this share of the nodes are skipped for the whole graph
+    'MAX_SHARE': 0.5,
+}
+
+
+def get_corridor_settings():
+    return {**DEFAULTS, **getattr(settings, 'ROUTING_CORRIDOR', {})}
+
+
+def corridor_nodes(G, orig_node, dest_node, stretch, margin_m):
+    """
+    Returns the nodes inside an ellipse with the origin and destination as foci.
+
+    A node p is inside if |p - origin| + |p - destination| is at most
+    ``stretch`` times the straight-line distance plus twice ``margin_m``, so
+    the ellipse holds every path up to that detour. Candidates come from the
+    grid cells of the ellipse's bounding box.
+
+    Returns:
+        np.ndarray: Sorted node indices.
+    """
+
+    index = G.spatial_index
+    origin, destination = index.node_xy[orig_node], index.node_xy[dest_node]
+    reach = stretch * np.hypot(*(destination - origin)) + 2 * margin_m
+
+    # Half of the major axis bounds the ellipse around its centre
+    center, half = (origin + destination) / 2, reach / 2
+    candidates = index.nodes_in_box(center[0] - half, center[1] - half, center[0] + half, center[1] + half)
+
+    xy = index.node_xy[candidates]
+    inside = np.hypot(*(xy - origin).T) + np.hypot(*(xy - destination).T) <= reach
+    return np.sort(candidates[inside])
+
+
+def extract_subgraph(G, nodes):
+    """
+    Returns the subgraph induced by some nodes as a CSRGraph.
+
+    Node i of the subgraph is ``nodes[i]`` of G. All weight columns are
+    carried over, so every search runs on the subgraph unchanged. The
+    landmark tables are sliced to the kept nodes: distances in the subgraph
+    are never shorter than in G, so the bounds stay valid and the subgraph
+    is searched with A* like G.
+
+    Args:
+        G (CSRGraph): Full graph.
+        nodes (np.ndarray): Sorted node indices to keep.
+
+    Returns:
+        CSRGraph: The subgraph.
+    """
+
+    local = np.full(G.n_nodes, -1, dtype=np.int64)
+    local[nodes] = np.arange(len(nodes))
+
+    # CSR positions of all edges leaving the kept nodes
+    starts, counts = G.indptr[nodes], np.diff(G.indptr)[nodes]
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    edge_ids = np.repeat(starts, counts) + np.arange(counts.sum()) - offsets
+    sources = np.repeat(np.arange(len(nodes)), counts)
+
+    targets = local[G.indices[edge_ids]]
+    keep = targets >= 0
+    edge_ids, sources, targets = edge_ids[keep], sources[keep], targets[keep]
+
+    # Kept edges are still sorted by source and target, as local indices keep the order
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=len(nodes)), out=indptr[1:])
+
+    sub = CSRGraph(
+        G.node_ids[nodes], G.x[nodes], G.y[nodes], indptr, targets.astype(np.int32),
+        {column: values[edge_ids] for column, values in G.weights.items()},
+        crs=G.crs, version=G.version,
+        costs={column: values[edge_ids] for column, values in G.costs.items()},
+        landmarks={
+            column: Landmarks(landmarks.nodes, landmarks.from_dist[:, nodes], landmarks.to_dist[:, nodes])
+            for column, landmarks in G.landmarks.items()
+        },
+        layer_versions=G.layer_versions,
+    )
+    sub.time_of_day = G.time_of_day
+    sub.sliced_layers = G.sliced_layers
+    return sub
+
+
+def corridor_search(G, orig_node, dest_node, search):
+    """
+    Runs a path search in a corridor around the origin and destination.
+
+    The search runs on the subgraph of the corridor first, so a short trip
+    only touches the few nodes around it. If it finds no path, the corridor
+    is widened, and after ``ROUTING_CORRIDOR['ATTEMPTS']`` corridors (or
+    once one would hold most of the graph) the whole graph is searched.
+
+    Args:
+        G (CSRGraph): Full graph.
+        orig_node (int): Start node index.
+        dest_node (int): End node index.
+        search (callable): search(G, orig_node, dest_node) returning a list
+            of paths as node indices; it may raise nx.NetworkXNoPath.
+
+    Returns:
+        list: Paths as node indices of G.
+    """
+
+    config = get_corridor_settings()
+    if config['ENABLED']:
+        stretch, margin_m = config['STRETCH'], config['MARGIN_M']
+        for _ in range(config['ATTEMPTS']):
+            check_deadline()
+            nodes = corridor_nodes(G, orig_node, dest_node, stretch, margin_m)
+            if len(nodes) > config['MAX_SHARE'] * G.n_nodes:
+                break
+
+            sub = extract_subgraph(G, nodes)
+            try:
+                paths = search(sub, int(np.searchsorted(nodes, orig_node)), int(np.searchsorted(nodes, dest_node)))
+            except nx.NetworkXNoPath:
+                paths = []
+            if paths:
+                return [nodes[path] for path in paths]
+
+            stretch, margin_m = stretch * config['WIDEN'], margin_m * config['WIDEN']
+
+    return search(G, orig_node, dest_node)
@@ -0,0 +1,344 @@
+import copy
+from collections import OrderedDict
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .exposure import edge_coordinates
+
+
+# Edge attributes kept as weight columns when converting a NetworkX graph
+EDGE_COLUMNS = ('length', 'combined', 'noise', 'noise_coverage')
+
+# Weight columns used as search costs, prepared ahead as float64 arrays
+COST_COLUMNS = ('length', 'combined')
+
+# scipy.sparse drops zero weights, so searches use this instead
+MIN_WEIGHT = 1e-6
+
+NO_PREDECESSOR = -9999
+
+
+class CSRGraph:
+    """
+    Compact, array-backed directed graph.
+
+    Nodes are remapped to contiguous int32 indices (sorted by OSM id), edges
+    are stored in CSR form (``indptr``/``indices``, targets sorted within a
+    row) and every edge attribute is a float32 column in edge order. Node
+    coordinates are kept in ``x``/``y`` arrays, so shortest paths are computed
+    by ``scipy.sparse.csgraph`` and path coordinates are a single gather.
+
+    Searches use float64 ``costs`` and a reverse CSR (``rev_indptr``,
+    ``rev_indices`` and ``rev_edges``, the forward position of every reverse
+    edge). They are computed on first use, or prepared once with
+    ``prepare_search_arrays`` and stored with the graph, so workers that
+    memory-map a snapshot share them without copying.
+
+    Edge geometries are ragged arrays: the (lon, lat) points of edge i are
+    ``edge_coords[edge_offsets[i]:edge_offsets[i + 1]]``.
+    """
+
+    def __init__(self, node_ids, x, y, indptr, indices, weights, crs="EPSG:4326", version=None,
+                 costs=None, rev_indptr=None, rev_indices=None, rev_edges=None, reverse_costs=None,
+                 landmarks=None, edge_offsets=None, edge_coords=None, h3_index=None, layer_versions=None,
+                 time_slices=None):
+        self.node_ids = node_ids
+        self.x = x
+        self.y = y
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.crs = crs
+        # Identifies the data the graph was prepared from, e.g. the snapshot name
+        self.version = version
+        self.costs = costs if costs is not None else {}
+        self.rev_indptr = rev_indptr
+        self.rev_indices = rev_indices
+        self.rev_edges = rev_edges
+        self.reverse_costs = reverse_costs if reverse_costs is not None else {}
+        # {cost column: Landmarks} for A* searches, see landmarks.py
+        self.landmarks = landmarks if landmarks is not None else {}
+        self.edge_offsets = edge_offsets
+        self.edge_coords = edge_coords
+        # H3EdgeIndex of the cells every edge passes through, see exposure.py
+        self.h3_index = h3_index
+        # {data layer: version} of the layers in the weight columns, see layers.py
+        self.layer_versions = layer_versions if layer_versions is not None else {}
+        # {layer: TimeSlices} of time-of-day columns, see time_slices.py
+        self.time_slices = time_slices if time_slices is not None else {}
+        # Hour and layers of the time slices in the weight columns of a view made by ``graph_at``
+        self.time_of_day = None
+        self.sliced_layers = ()
+        self._time_views = OrderedDict()
+        self._matrices = {}
+        self._reverse_matrices = {}
+        self._spatial_index = None
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    @classmethod
+    def from_digraph(cls, G, columns=EDGE_COLUMNS):
+        """
+        Builds a CSRGraph from a NetworkX DiGraph.
+
+        Args:
+            G (nx.DiGraph): Graph with 'x'/'y' node attributes.
+            columns (tuple): Edge attributes to keep, missing values become NaN.
+
+        Returns:
+            CSRGraph: The converted graph.
+        """
+
+        node_ids = np.array(sorted(G.nodes), dtype=np.int64)
+        x = np.array([G.nodes[n]['x'] for n in node_ids], dtype=np.float64)
+        y = np.array([G.nodes[n]['y'] for n in node_ids], dtype=np.float64)
+
+        n_edges = G.number_of_edges()
+        sources = np.empty(n_edges, dtype=np.int64)
+        targets = np.empty(n_edges, dtype=np.int64)
+        values = {column: np.full(n_edges, np.nan, dtype=np.float32) for column in columns}
+        geometries = []
+
+        for i, (u, v, data) in enumerate(G.edges(data=True)):
+            sources[i] = u
+            targets[i] = v
+            geometries.append(edge_coordinates(G, u, v, data))
+            for column in columns:
+                if column in data:
+                    values[column][i] = data[column]
+
+        sources = np.searchsorted(node_ids, sources).astype(np.int32)
+        targets = np.searchsorted(node_ids, targets).astype(np.int32)
+
+        # Sort edges by source and then target, which gives the CSR layout
+        order = np.lexsort((targets, sources))
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(sources, minlength=len(node_ids)), out=indptr[1:])
+
+        edge_offsets = np.zeros(n_edges + 1, dtype=np.int64)
+        np.cumsum([len(geometries[i]) for i in order], out=edge_offsets[1:])
+        edge_coords = np.concatenate([geometries[i] for i in order]) if n_edges else np.empty((0, 2))
+
+        return cls(
+            node_ids, x, y, indptr, targets[order],
+            {column: value[order] for column, value in values.items()},
+            crs=G.graph.get('crs', "EPSG:4326"),
+            edge_offsets=edge_offsets, edge_coords=edge_coords,
+        )
+
+    def replace(self, weights=None, costs=None, landmarks=None, layer_versions=None):
+        """
+        Returns a graph sharing this graph's arrays, with some columns replaced.
+
+        Only the given columns are new, every other array (including the
+        memory-mapped ones) and the spatial index are shared, so this graph
+        stays valid for the searches still running on it.
+
+        Args:
+            weights (dict): {column: array} of replaced weight columns.
+            costs (dict): {column: float64 array} of replaced search costs, the
+                reverse costs of these columns are derived from them.
+            landmarks (dict): {column: Landmarks} of replaced landmarks. Cost
+                columns replaced without new landmarks are searched with Dijkstra.
+            layer_versions (dict): {data layer: version} of replaced layers.
+
+        Returns:
+            CSRGraph: The new graph.
+        """
+
+        weights, costs, landmarks = weights or {}, costs or {}, landmarks or {}
+        # Costs and landmarks of replaced weight columns are stale unless given
+        stale = set(weights) | set(costs)
+
+        G = copy.copy(self)
+        G.weights = {**self.weights, **weights}
+        G.costs = {**{column: values for column, values in self.costs.items() if column not in stale}, **costs}
+        G.reverse_costs = {column: values for column, values in self.reverse_costs.items() if column not in stale}
+        if self.rev_edges is not None:
+            G.reverse_costs.update({column: values[self.rev_edges] for column, values in costs.items()})
+        G.landmarks = {
+            **{column: values for column, values in self.landmarks.items() if column not in stale}, **landmarks,
+        }
+        G.layer_versions = {**self.layer_versions, **(layer_versions or {})}
+        G._matrices = {}
+        G._reverse_matrices = {}
+        G._time_views = OrderedDict()
+        return G
+
+    def node_index(self, node_id):
+        """Returns the contiguous index of an OSM node id."""
+
+        return int(np.searchsorted(self.node_ids, node_id))
+
+    def cost(self, weight):
+        """Returns the float64 search cost of a weight column."""
+
+        if weight not in self.costs:
+            self.costs[weight] = search_cost(self.weights[weight])
+        return self.costs[weight]
+
+    def matrix(self, weight):
+        """Returns (and caches) a scipy CSR matrix of a weight column for searches."""
+
+        if weight not in self._matrices:
+            self._matrices[weight] = self.weighted_matrix(self.cost(weight))
+        return self._matrices[weight]
+
+    def weighted_matrix(self, data):
+        """Returns a scipy CSR matrix with the given weight per edge."""
+
+        data = np.asarray(data)
+        if data.dtype != np.float64 or np.isnan(data).any() or data.min(initial=MIN_WEIGHT) < MIN_WEIGHT:
+            data = search_cost(data)
+        return csr_matrix((data, self.indices, self.indptr), shape=(self.n_nodes, self.n_nodes), copy=False)
+
+    def _build_reverse(self):
+        sources = np.repeat(np.arange(self.n_nodes, dtype=np.int32), np.diff(self.indptr))
+        order = np.lexsort((sources, self.indices))
+        self.rev_edges = order.astype(np.int64)
+        self.rev_indices = sources[order]
+        self.rev_indptr = np.zeros(self.n_nodes + 1, dtype=np.int32)
+        np.cumsum(np.bincount(self.indices, minlength=self.n_nodes), out=self.rev_indptr[1:])
+
+    def reverse_matrix(self, weight):
+        """Returns (and caches) a scipy CSR matrix of the reversed graph for backward searches."""
+
+        if weight not in self._reverse_matrices:
+            if self.rev_edges is None:
+                self._build_reverse()
+            if weight not in self.reverse_costs:
+                self.reverse_costs[weight] = self.cost(weight)[self.rev_edges]
+            self._reverse_matrices[weight] = csr_matrix(
+                (self.reverse_costs[weight], self.rev_indices, self.rev_indptr),
+                shape=(self.n_nodes, self.n_nodes), copy=False,
+            )
+        return self._reverse_matrices[weight]
+
+    def prepare_search_arrays(self, columns=COST_COLUMNS):
+        """Computes the costs and the reverse CSR of the given columns ahead of searches."""
+
+        for weight in columns:
+            self.reverse_matrix(weight)
+        return self
+
+    def edge_ids(self, path):
+        """Returns the CSR positions of the edges along a path of node indices."""
+
+        path = np.asarray(path)
+        ids = np.empty(max(len(path) - 1, 0), dtype=np.int64)
+        for i, (u, v) in enumerate(zip(path[:-1], path[1:])):
+            start, end = self.indptr[u], self.indptr[u + 1]
+            ids[i] = start + np.searchsorted(self.indices[start:end], v)
+        return ids
+
+    def edge_id(self, u, v):
+        """Returns the CSR position of edge (u, v), or -1 if there is no such edge."""
+
+        start, end = self.indptr[u], self.indptr[u + 1]
+        i = start + np.searchsorted(self.indices[start:end], v)
+        if i < end and self.indices[i] == v:
+            return int(i)
+        return -1
+
+    def edge_geometry(self, edge_id):
+        """Returns the (lon, lat) coordinates of an edge, the straight line between its nodes without geometries."""
+
+        if self.edge_coords is None:
+            u = np.searchsorted(self.indptr, edge_id, side='right') - 1
+            return self.path_coordinates([u, self.indices[edge_id]])
+        return self.edge_coords[self.edge_offsets[edge_id]:self.edge_offsets[edge_id + 1]]
+
+    def edge_geometries(self, edge_ids=None):
+        """Returns a list of the (lon, lat) coordinate arrays of edges, all edges by default."""
+
+        if edge_ids is None:
+            edge_ids = range(self.n_edges)
+        return [self.edge_geometry(edge_id) for edge_id in edge_ids]
+
+    def path_weight(self, path, weight):
+        """Returns the sum of a weight column along a path."""
+
+        return float(self.weights[weight][self.edge_ids(path)].sum(dtype=np.float64))
+
+    def path_coordinates(self, path):
+        """
+        Returns an (n, 2) array of (lon, lat) coordinates of a path.
+
+        The geometries of the path's edges are sliced out of the flat
+        coordinate buffer in one gather, the shared point between two edges
+        kept once, so curved streets are followed instead of cut between
+        their nodes. Graphs without edge geometries give the node coordinates.
+        """
+
+        path = np.asarray(path)
+        if self.edge_coords is None or len(path) < 2:
+            return np.column_stack((self.x[path], self.y[path]))
+
+        edge_ids = self.edge_ids(path)
+        starts = self.edge_offsets[edge_ids]
+        # Every edge without its last point, which is the first point of the next edge
+        counts = self.edge_offsets[edge_ids + 1] - starts - 1
+        positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return self.edge_coords[np.append(positions, self.edge_offsets[edge_ids[-1] + 1] - 1)]
+
+    @property
+    def spatial_index(self):
+        """KD-tree index of the nodes and edges, built on first use."""
+
+        if self._spatial_index is None:
+            from .spatial_index import SpatialIndex
+            self._spatial_index = SpatialIndex(self)
+        return self._spatial_index
+
+    def nearest_node(self, lon, lat):
+        """Returns the index of the node closest to a point."""
+
+        return self.spatial_index.nearest_node(lon, lat)
+
+    def shortest_path(self, source, target, weight):
+        """
+        Returns the shortest path between two node indices.
+
+        Searched with bidirectional A* if the graph has landmarks for the
+        weight, with Dijkstra otherwise.
+
+        Args:
+            source (int): Start node index.
+            target (int): End node index.
+            weight (str): Weight column to minimise.
+
+        Returns:
+            tuple: (cost, path as an array of node indices), path is None if unreachable.
+        """
+
+        from .landmarks import point_to_point
+
+        cost, path, _ = point_to_point(self, source, target, weight)
+        return cost, path
+
+
+def search_cost(values):
+    """Returns weights as float64 search costs, with NaN and zero weights raised to MIN_WEIGHT."""
+
+    data = np.nan_to_num(np.asarray(values, dtype=np.float64), nan=MIN_WEIGHT)
+    np.maximum(data, MIN_WEIGHT, out=data)
+    return data
+
+
+def predecessors_to_path(predecessors, source, target):
+    """Walks a scipy predecessor array back from target to source."""
+
+    path = [target]
+    while path[-1] != source:
+        node = predecessors[path[-1]]
+        if node == NO_PREDECESSOR:
+            return None
+        path.append(node)
+    return np.array(path[::-1], dtype=np.int32)
@@ -0,0 +1,122 @@
+from itertools import chain, combinations
+from math import comb
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from django.conf import settings
+
+
+DEFAULTS = {
+    # Number of paths returned to the user
+    'K': 3,
+    # Candidates ranked by vegetation or heat that diversity is picked from
+    'TOP': 10,
+    # Minimum shortest length / path length of a candidate, 0 keeps all of them
+    'MIN_QUALITY': 0.0,
+}
+
+# Largest number of k-subsets scored exactly, above it the greedy method is used
+EXACT_LIMIT = 200000
+
+
+def get_diversity_settings():
+    return {**DEFAULTS, **getattr(settings, 'ROUTING_DIVERSITY', {})}
+
+
+def incidence_matrix(paths):
+    """
+    Returns a sparse binary path x item incidence matrix.
+
+    Args:
+        paths (list): Paths as sequences of node indices (or edge ids).
+
+    Returns:
+        csr_matrix: Matrix with a 1 where a path contains an item.
+    """
+
+    items = [np.unique(np.asarray(path, dtype=np.int64)) for path in paths]
+    indices = np.concatenate(items) if items else np.empty(0, dtype=np.int64)
+    indptr = np.concatenate(([0], np.cumsum([len(i) for i in items])))
+    data = np.ones(len(indices), dtype=np.float64)
+    n_items = int(indices.max()) + 1 if len(indices) else 0
+    return csr_matrix((data, indices, indptr), shape=(len(paths), n_items))
+
+
+def jaccard_dissimilarity(paths):
+    """
+    Returns the pairwise Jaccard dissimilarity (1 - |A & B| / |A | B|) of paths.
+
+    All intersections come from one sparse product of the incidence matrix
+    with its transpose.
+    """
+
+    incidence = incidence_matrix(paths)
+    intersection = (incidence @ incidence.T).toarray()
+    sizes = np.diag(intersection)
+    union = sizes[:, None] + sizes[None, :] - intersection
+    return 1 - np.divide(intersection, union, out=np.ones_like(intersection), where=union > 0)
+
+
+def _best_subset_exact(dissimilarity, k):
+    # Score every k-subset at once, ties go to the first subset like max() over combinations()
+    n_subsets = comb(len(dissimilarity), k)
+    subsets = np.fromiter(
+        chain.from_iterable(combinations(range(len(dissimilarity)), k)), dtype=np.int32, count=n_subsets * k
+    ).reshape(n_subsets, k)
+    scores = np.zeros(len(subsets))
+    for a, b in combinations(range(k), 2):
+        scores += dissimilarity[subsets[:, a], subsets[:, b]]
+    return subsets[np.argmax(scores)].tolist()
+
+
+def _best_subset_greedy(dissimilarity, k):
+    # Start from the most different pair and keep adding the path furthest from the chosen ones
+    first, second = np.unravel_index(np.argmax(dissimilarity), dissimilarity.shape)
+    chosen = [int(min(first, second)), int(max(first, second))]
+    total = dissimilarity[chosen].sum(axis=0)
+    while len(chosen) < k:
+        total[chosen] = -np.inf
+        best = int(np.argmax(total))
+        chosen.append(best)
+        total = total + dissimilarity[best]
+    return sorted(chosen)
+
+
+def select_diverse(paths, k=3, quality=None, min_quality=None):
+    """
+    Returns the indices of the k paths with the highest total dissimilarity.
+
+    Subsets are scored exactly when there are at most EXACT_LIMIT of them and
+    picked greedily (max-sum) otherwise, so 50-100 candidates stay cheap.
+
+    Args:
+        paths (list): Paths as sequences of node indices (or edge ids).
+        k (int): Number of paths to select.
+        quality (array_like): Quality of each path, higher is better.
+        min_quality (float): Paths with a lower quality are not selected.
+
+    Returns:
+        list: Indices into ``paths`` of the selected paths, in their original order.
+    """
+
+    candidates = np.arange(len(paths))
+    if quality is not None and min_quality is not None:
+        candidates = candidates[np.asarray(quality, dtype=float) >= min_quality]
+
+    if len(candidates) <= k or k < 2:
+        return candidates[:k].tolist()
+
+    dissimilarity = jaccard_dissimilarity([paths[i] for i in candidates])
+    if comb(len(candidates), k) <= EXACT_LIMIT:
+        selected = _best_subset_exact(dissimilarity, k)
+    else:
+        selected = _best_subset_greedy(dissimilarity, k)
+    return candidates[selected].tolist()
+
+
+def length_quality(lengths):
+    """Returns the shortest length divided by each length, 1 for the shortest path."""
+
+    lengths = np.asarray(lengths, dtype=float)
+    return lengths.min() / np.maximum(lengths, 1e-9)
@@ -0,0 +1,250 @@
+import os
+
+import numpy as np
+
+from .h3_store import H3_RESOLUTION, latlng_to_cells
+
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def edge_coordinates(G, u, v, data):
+    """
+    Returns the (lon, lat) coordinates of an edge as an array.
+
+    Uses the geometry stored by OSMnx on curved edges and falls back to the
+    straight line between the two nodes.
+    """
+
+    geometry = data.get('geometry')
+    if geometry is not None:
+        return np.asarray(geometry.coords, dtype=float)
+
+    return np.array([
+        (G.nodes[u]['x'], G.nodes[u]['y']),
+        (G.nodes[v]['x'], G.nodes[v]['y']),
+    ], dtype=float)
+
+
+def segment_lengths_m(coords):
+    """Approximate lengths in meters of the segments of a (lon, lat) polyline."""
+
+    lon = np.radians(coords[:, 0])
+    lat = np.radians(coords[:, 1])
+    mean_lat = (lat[1:] + lat[:-1]) / 2
+    dx = np.diff(lon) * np.cos(mean_lat)
+    dy = np.diff(lat)
+    return EARTH_RADIUS_M * np.hypot(dx, dy)
+
+
+def sample_polyline(coords, spacing_m):
+    """
+    Splits a polyline into pieces of roughly equal length and returns their midpoints.
+
+    Args:
+        coords (np.ndarray): Array of (lon, lat) coordinates.
+        spacing_m (float): Target length of a single piece in meters.
+
+    Returns:
+        tuple: (lon, lat) arrays of the midpoints and the share of the
+        polyline length that each midpoint represents.
+    """
+
+    seg_lengths = segment_lengths_m(coords)
+    cumulative = np.concatenate(([0.0], np.cumsum(seg_lengths)))
+    total = cumulative[-1]
+
+    n_samples = max(1, int(np.ceil(total / spacing_m)))
+    positions = (np.arange(n_samples) + 0.5) * (total / n_samples)
+
+    lon = np.interp(positions, cumulative, coords[:, 0])
+    lat = np.interp(positions, cumulative, coords[:, 1])
+    return lon, lat, np.full(n_samples, 1.0 / n_samples)
+
+
+class H3EdgeIndex:
+    """
+    Reverse index of the H3 cells every edge of a CSRGraph passes through.
+
+    Every edge geometry is walked once and sampled every ``spacing_m``
+    meters. Each sample is weighted by the edge length it represents, and
+    the samples are summed per (cell, edge) pair, sorted by cell. Exposure to
+    any layer of the same resolution is then a lookup of the cells and a
+    weighted sum per edge, and the edges affected by changed cells are found
+    without walking the geometries again.
+    """
+
+    def __init__(self, cells, edges, meters, resolution=H3_RESOLUTION):
+        self.cells = cells
+        self.edges = edges
+        self.meters = meters
+        self.resolution = resolution
+
+    def __len__(self):
+        return len(self.cells)
+
+    @classmethod
+    def build(cls, G, resolution=H3_RESOLUTION, spacing_m=3.0):
+        """
+        Samples the edges of a CSRGraph and indexes the cells of the samples.
+
+        Args:
+            G (CSRGraph): Graph with edge geometries and a 'length' column.
+            resolution (int): H3 resolution of the layers.
+            spacing_m (float): Distance between samples along an edge in meters.
+
+        Returns:
+            H3EdgeIndex: The index.
+        """
+
+        lengths = G.weights['length'].astype(np.float64)
+        lons, lats, meters = [], [], []
+        for edge_id, coords in enumerate(G.edge_geometries()):
+            lon, lat, shares = sample_polyline(coords, spacing_m)
+            lons.append(lon)
+            lats.append(lat)
+            meters.append(shares * lengths[edge_id])
+
+        if not lons:
+            return cls(np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64),
+                       resolution)
+
+        edges = np.repeat(np.arange(G.n_edges, dtype=np.int32), [len(lon) for lon in lons])
+        cells = latlng_to_cells(np.concatenate(lats), np.concatenate(lons), resolution)
+        meters = np.concatenate(meters)
+
+        # One entry per (cell, edge) pair, sorted by cell
+        order = np.lexsort((edges, cells))
+        cells, edges, meters = cells[order], edges[order], meters[order]
+        starts = np.flatnonzero(np.concatenate(([True], (cells[1:] != cells[:-1]) | (edges[1:] != edges[:-1]))))
+        return cls(cells[starts], edges[starts], np.add.reduceat(meters, starts), resolution)
+
+    @staticmethod
+    def paths(directory):
+        return tuple(os.path.join(directory, f'h3_{part}.npy') for part in ('cells', 'edges', 'meters'))
+
+    def save(self, directory):
+        for path, array in zip(self.paths(directory), (self.cells, self.edges, self.meters)):
+            np.save(path, array)
+
+    @classmethod
+    def load(cls, directory, mmap_mode=None, resolution=H3_RESOLUTION):
+        return cls(*(np.load(path, mmap_mode=mmap_mode) for path in cls.paths(directory)), resolution)
+
+    def exposure(self, store, n_edges, edge_ids=None):
+        """
+        Returns length-weighted exposure of edges to an H3 layer.
+
+        Args:
+            store (H3LayerStore): H3 layer with the values.
+            n_edges (int): Number of edges of the graph.
+            edge_ids (np.ndarray): Edges to compute, all edges by default.
+
+        Returns:
+            tuple: float32 arrays of length ``n_edges``, zero for edges not computed:
+
+            - sum of value * meters over the covered part of each edge
+            - meters of each edge covered by the layer
+        """
+
+        cells, edges, meters = self.cells, self.edges, self.meters
+        if edge_ids is not None:
+            selected = np.isin(edges, edge_ids)
+            cells, edges, meters = cells[selected], edges[selected], meters[selected]
+
+        values = store.lookup(cells).astype(np.float64)
+        covered = ~np.isnan(values)
+        meters = meters[covered]
+
+        weighted_sum = np.bincount(edges[covered], weights=values[covered] * meters, minlength=n_edges)
+        covered_len = np.bincount(edges[covered], weights=meters, minlength=n_edges)
+        return weighted_sum.astype(np.float32), covered_len.astype(np.float32)
+
+    def changed_edges(self, old_store, new_store):
+        """Returns the sorted ids of the edges passing through cells whose value differs between two layer stores."""
+
+        cells = self.cells[np.concatenate(([True], self.cells[1:] != self.cells[:-1]))] if len(self) else self.cells
+        old, new = old_store.lookup(cells), new_store.lookup(cells)
+        changed = cells[(old != new) & ~(np.isnan(old) & np.isnan(new))]
+        return np.unique(self.edges[np.isin(self.cells, changed)])
+
+
+def add_h3_exposure(G, h3_stores, spacing_m=3.0):
+    """
+    Stores length-weighted exposure to H3 layers as weight columns of a CSRGraph.
+
+    Long edges through parks or over hot asphalt count in proportion to their
+    length. The cells of the edges are kept in ``G.h3_index``, so changed
+    layers can be applied later to the affected edges only (see layers.py).
+    Two columns are written per layer:
+
+    - ``<layer>_sum``: sum of value * meters over the covered part of the edge
+    - ``<layer>_len``: meters of the edge covered by the layer
+
+    Args:
+        G (CSRGraph): Graph with edge geometries, annotated in place.
+        h3_stores (dict): {layer: H3LayerStore}, e.g. 'ndvi' and 'heat'.
+        spacing_m (float): Distance between samples along an edge in meters.
+
+    Returns:
+        CSRGraph: The annotated graph.
+    """
+
+    if G.h3_index is None:
+        G.h3_index = H3EdgeIndex.build(G, spacing_m=spacing_m)
+
+    for layer, store in h3_stores.items():
+        G.weights[f'{layer}_sum'], G.weights[f'{layer}_len'] = G.h3_index.exposure(store, G.n_edges)
+    return G
+
+
+def path_exposure(G, path, layer):
+    """
+    Returns the length-weighted average of a layer along a path.
+
+    Args:
+        G (CSRGraph): Graph with the '<layer>_sum' and '<layer>_len' weight
+            columns written by ``add_h3_exposure``.
+        path (np.ndarray): Path as node indices.
+        layer (str): Name of the layer, e.g. 'ndvi' or 'heat'.
+
+    Returns:
+        float: Average value of the layer, or None if the path is not covered.
+    """
+
+    edge_ids = G.edge_ids(path)
+    covered = G.weights[f'{layer}_len'][edge_ids].sum(dtype=np.float64)
+    if covered <= 0:
+        return None
+
+    return float(G.weights[f'{layer}_sum'][edge_ids].sum(dtype=np.float64) / covered)
+
+
+def path_average(G, path, column):
+    """Returns the length-weighted average of a weight column (e.g. 'noise') along a path."""
+
+    edge_ids = G.edge_ids(path)
+    lengths = G.weights['length'][edge_ids].astype(np.float64)
+    if lengths.sum() <= 0:
+        return None
+
+    return float((G.weights[column][edge_ids] * lengths).sum() / lengths.sum())
+
+
+def path_measured_average(G, path, column, coverage):
+    """
+    Returns the average of a weight column over the measured part of a path.
+
+    Every edge is weighted by its measured meters, its length times the
+    measured share in the ``coverage`` column (e.g. 'noise' and 'noise_coverage').
+
+    Returns:
+        float: Average value, or None if no part of the path is measured.
+    """
+
+    edge_ids = G.edge_ids(path)
+    measured = G.weights['length'][edge_ids].astype(np.float64) * G.weights[coverage][edge_ids]
+    if measured.sum() <= 0:
+        return None
+
+    return float((G.weights[column][edge_ids] * measured).sum() / measured.sum())
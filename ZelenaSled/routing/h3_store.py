@@ -0,0 +1,174 @@
+import json
+import os
+import zipfile
+
+import h3
+import numpy as np
+
+
+# H3 layers shipped in routing/data as zipped JSON files, {layer: file name without extension}
+H3_LAYERS = {
+    'ndvi': 'avg_ndvi_h3_13',
+    'heat': 'heat_h3',
+}
+
+H3_RESOLUTION = 13
+
+
+class H3LayerStore:
+    """
+    Read-only H3 layer: a sorted uint64 array of cells and a float32 array of values.
+
+    The arrays are memory-mapped from .npy files, so every worker process
+    shares the same pages through the OS page cache instead of holding its
+    own copy of a parsed JSON dict.
+    """
+
+    def __init__(self, cells, values, resolution=H3_RESOLUTION):
+        self.cells = cells
+        self.values = values
+        self.resolution = resolution
+
+    def __len__(self):
+        return len(self.cells)
+
+    @classmethod
+    def load(cls, data_dir, name, resolution=H3_RESOLUTION):
+        """Memory-maps a store previously written by ``build_h3_store``."""
+
+        cells_path, values_path = store_paths(data_dir, name)
+        return cls(
+            np.load(cells_path, mmap_mode='r'),
+            np.load(values_path, mmap_mode='r'),
+            resolution,
+        )
+
+    def lookup(self, cells):
+        """
+        Looks up many cells at once.
+
+        Args:
+            cells (np.ndarray): Array of H3 cells as uint64.
+
+        Returns:
+            np.ndarray: float32 array of values, NaN where a cell is not in the layer.
+        """
+
+        cells = np.asarray(cells, dtype=np.uint64)
+        result = np.full(cells.shape, np.nan, dtype=np.float32)
+        if len(self.cells) == 0:
+            return result
+
+        idx = np.searchsorted(self.cells, cells)
+        idx[idx == len(self.cells)] = 0
+        found = self.cells[idx] == cells
+        result[found] = self.values[idx[found]]
+        return result
+
+    def lookup_latlng(self, lat, lon):
+        """Looks up the cells containing many (lat, lon) points at once."""
+
+        return self.lookup(latlng_to_cells(lat, lon, self.resolution))
+
+    def get(self, cell, default=None):
+        """Returns the value of a single cell given as an H3 string or int."""
+
+        if isinstance(cell, str):
+            cell = h3.str_to_int(cell)
+        value = self.lookup(np.array([cell], dtype=np.uint64))[0]
+        return default if np.isnan(value) else float(value)
+
+
+def latlng_to_cells(lat, lon, resolution=H3_RESOLUTION):
+    """Converts arrays of latitudes and longitudes to an array of uint64 H3 cells."""
+
+    return np.fromiter(
+        (h3.str_to_int(h3.latlng_to_cell(y, x, resolution)) for y, x in zip(lat, lon)),
+        dtype=np.uint64,
+        count=len(lat),
+    )
+
+
+def cell_parents(cells, resolution):
+    """
+    Returns the parents of uint64 H3 cells at a coarser resolution.
+
+    Computed on the bits of the index: the resolution field (bits 52-55) is
+    set and the digits of the finer resolutions (3 bits each) are set to 7,
+    which is what ``h3.cell_to_parent`` does for a single cell.
+    """
+
+    cells = np.asarray(cells, dtype=np.uint64)
+    unused_digits = np.uint64((1 << (3 * (15 - resolution))) - 1)
+    return (cells & ~np.uint64(0xF << 52)) | np.uint64(resolution << 52) | unused_digits
+
+
+def store_paths(data_dir, name):
+    return (
+        os.path.join(data_dir, f'{name}.cells.npy'),
+        os.path.join(data_dir, f'{name}.values.npy'),
+    )
+
+
+def _save_atomic(path, array):
+    # Write next to the target and rename, so concurrently starting workers never see half a file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def build_h3_store(data_dir, name):
+    """
+    Builds the binary store of an H3 layer from its zipped JSON file.
+
+    The JSON is streamed out of the zip archive, so it is never extracted to disk.
+
+    Args:
+        data_dir (str): Directory with the '<name>.zip' file.
+        name (str): Name of the layer file without extension.
+    """
+
+    with zipfile.ZipFile(os.path.join(data_dir, f'{name}.zip'), 'r') as zip_ref:
+        with zip_ref.open(f'{name}.json') as f:
+            layer_h3 = json.load(f)
+
+    cells = np.fromiter((h3.str_to_int(cell) for cell in layer_h3), dtype=np.uint64, count=len(layer_h3))
+    values = np.fromiter(layer_h3.values(), dtype=np.float32, count=len(layer_h3))
+    del layer_h3
+
+    order = np.argsort(cells)
+    cells_path, values_path = store_paths(data_dir, name)
+    _save_atomic(values_path, values[order])
+    _save_atomic(cells_path, cells[order])
+
+
+def ensure_h3_store(data_dir, name):
+    """Builds the binary store of an H3 layer file if it is missing or older than the file."""
+
+    source = os.path.join(data_dir, f'{name}.zip')
+    paths = store_paths(data_dir, name)
+    if all(os.path.exists(path) for path in paths) and (
+        not os.path.exists(source) or all(os.path.getmtime(path) >= os.path.getmtime(source) for path in paths)
+    ):
+        print(f"H3 layer store already built: {name}")
+        return
+    if not os.path.exists(source):
+        print(f"H3 layer file not found, store not built: {name}")
+        return
+
+    build_h3_store(data_dir, name)
+    print(f"Built H3 layer store: {name}")
+
+
+def ensure_h3_stores(data_dir):
+    """Builds the binary stores of all H3 layers that are missing or older than their file in the data directory."""
+
+    for name in H3_LAYERS.values():
+        ensure_h3_store(data_dir, name)
+
+
+def load_h3_stores(data_dir):
+    """Returns {layer: H3LayerStore} for all H3 layers."""
+
+    return {layer: H3LayerStore.load(data_dir, name) for layer, name in H3_LAYERS.items()}
@@ -0,0 +1,239 @@
+import math
+
+import h3
+import numpy as np
+import shapely
+from scipy.sparse.csgraph import dijkstra
+
+from django.conf import settings
+
+from .exposure import H3EdgeIndex
+from .h3_store import cell_parents
+from .metrics import count
+from .route_cache import ALL_LAYERS, layer_token
+
+
+DEFAULTS = {
+    # Travel speed of every commute mode in km/h
+    'SPEEDS': {'walk': 4.8, 'bike': 15.0},
+    # Longest travel time a request may ask for, in minutes
+    'MAX_MINUTES': 30,
+    # H3 resolution of the returned cells, 10 cells are about 0.015 km2
+    'RESOLUTION': 10,
+    # Coarsest and finest resolution a request may ask for
+    'MIN_RESOLUTION': 7,
+    'MAX_RESOLUTION': 12,
+    # 'h3' for one feature per cell, 'polygon' for the outline of the region
+    'FORMAT': 'h3',
+}
+
+FORMATS = ('h3', 'polygon')
+
+
+def get_isochrone_settings():
+    return {**DEFAULTS, **getattr(settings, 'ROUTING_ISOCHRONE', {})}
+
+
+def parse_isochrone_options(commute_mode, minutes, resolution=None, region_format=None):
+    """
+    Validates the options of an isochrone request.
+
+    Returns:
+        tuple: (cutoff in meters, resolution, format), defaults from ``ROUTING_ISOCHRONE``.
+
+    Raises:
+        ValueError: If an option is not valid.
+    """
+
+    config = get_isochrone_settings()
+    if resolution is None:
+        resolution = config['RESOLUTION']
+    if region_format is None:
+        region_format = config['FORMAT']
+
+    if isinstance(minutes, bool) or not isinstance(minutes, (int, float)) or not 0 < minutes <= config['MAX_MINUTES']:
+        raise ValueError(f"Minutes must be a number between 0 and {config['MAX_MINUTES']}")
+    if commute_mode not in config['SPEEDS']:
+        raise ValueError(f"No travel speed for commute mode: {commute_mode}")
+    if (isinstance(resolution, bool) or not isinstance(resolution, int)
+            or not config['MIN_RESOLUTION'] <= resolution <= min(config['MAX_RESOLUTION'], 13)):
+        raise ValueError(
+            f"Resolution must be an integer between {config['MIN_RESOLUTION']} and {config['MAX_RESOLUTION']}"
+        )
+    if region_format not in FORMATS:
+        raise ValueError(f"Unknown format: {region_format} (use {', '.join(FORMATS)})")
+
+    cutoff_m = minutes * 60 * config['SPEEDS'][commute_mode] / 3.6
+    return cutoff_m, resolution, region_format
+
+
+def reached_edges(G, orig_node, cutoff_m):
+    """
+    Runs one length search from a node, stopped at a cutoff.
+
+    Args:
+        G (CSRGraph): Graph to search.
+        orig_node (int): Start node index.
+        cutoff_m (float): Longest distance in meters.
+
+    Returns:
+        tuple: (distance of every node in meters, inf beyond the cutoff;
+        reached share of every edge between 0 and 1). An edge is reached
+        from its start node up to the cutoff.
+    """
+
+    dist = dijkstra(G.matrix('length'), indices=orig_node, limit=cutoff_m)
+    count('settled_nodes', int(np.isfinite(dist).sum()))
+
+    start = np.repeat(dist, np.diff(G.indptr))
+    lengths = np.maximum(G.weights['length'].astype(np.float64), 1e-9)
+    with np.errstate(invalid='ignore'):
+        share = np.clip((cutoff_m - start) / lengths, 0, 1)
+    share[~np.isfinite(start)] = 0
+    return dist, share
+
+
+def _ratio(numerator, denominator):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(denominator > 0, numerator / denominator, np.nan)
+
+
+def _exposure_terms(G, edge_ids, meters):
+    # (value sum, measured meters) of every layer over some meters of edges,
+    # weighted like path averages: H3 layers by their covered share, noise by its measured share
+    lengths = np.maximum(G.weights['length'][edge_ids].astype(np.float64), 1e-9)
+    terms = {}
+    for layer in ('ndvi', 'heat'):
+        if f'{layer}_sum' in G.weights:
+            terms[layer] = (
+                meters * G.weights[f'{layer}_sum'][edge_ids] / lengths,
+                meters * G.weights[f'{layer}_len'][edge_ids] / lengths,
+            )
+    measured = meters * np.nan_to_num(G.weights['noise_coverage'][edge_ids])
+    terms['noise'] = (measured * np.nan_to_num(G.weights['noise'][edge_ids]), measured)
+    return terms
+
+
+def reachable_region(G, orig_node, cutoff_m, minutes, resolution):
+    """
+    Returns the H3 cells reachable from a node within a distance and their environment.
+
+    All reached edges are aggregated at once: the meters every edge has in
+    each resolution 13 cell (the graph's H3 cell index) are scaled by the
+    reached share of the edge and weight the NDVI, heat and noise of the edge
+    in the parent cell. Partly reached edges count in proportion, wherever
+    their cells lie along the edge.
+
+    Args:
+        G (CSRGraph): Graph to search.
+        orig_node (int): Start node index.
+        cutoff_m (float): Longest distance in meters.
+        minutes (float): Travel time of the cutoff, for the travel times of the cells.
+        resolution (int): H3 resolution of the cells.
+
+    Returns:
+        dict: 'summary' with the averages over all reached edges and 'cells',
+        a list of [cell, minutes to the cell, ndvi, heat, noise].
+    """
+
+    dist, share = reached_edges(G, orig_node, cutoff_m)
+    edge_ids = np.flatnonzero(share > 0)
+    lengths = G.weights['length'][edge_ids].astype(np.float64)
+    reached_m = lengths * share[edge_ids]
+
+    summary = {'reached_nodes': int(np.isfinite(dist).sum())}
+    for layer, (value_sum, measured) in _exposure_terms(G, edge_ids, reached_m).items():
+        summary[layer] = float(_ratio(value_sum.sum(), measured.sum()))
+
+    if G.h3_index is None:
+        G.h3_index = H3EdgeIndex.build(G)
+    index = G.h3_index
+    entries = np.flatnonzero(share[index.edges] > 0)
+    entry_edges = index.edges[entries]
+    meters = index.meters[entries] * share[entry_edges]
+
+    cells, groups = np.unique(cell_parents(index.cells[entries], resolution), return_inverse=True)
+    columns = {}
+    for layer, (value_sum, measured) in _exposure_terms(G, entry_edges, meters).items():
+        columns[layer] = _ratio(np.bincount(groups, value_sum, len(cells)), np.bincount(groups, measured, len(cells)))
+
+    # A cell is reached when the first edge into it starts
+    start = np.repeat(dist, np.diff(G.indptr))[entry_edges]
+    cell_minutes = np.full(len(cells), np.inf)
+    np.minimum.at(cell_minutes, groups, start / cutoff_m * minutes)
+
+    summary['area_km2'] = round(sum(h3.cell_area(h3.int_to_str(int(cell)), 'km^2') for cell in cells), 3)
+    return {
+        'summary': summary,
+        'cells': [
+            [int(cell), round(float(cell_minutes[i]), 1),
+             *(columns[layer][i] if layer in columns else np.nan for layer in ('ndvi', 'heat', 'noise'))]
+            for i, cell in enumerate(cells)
+        ],
+    }
+
+
+def _round(value, decimals=3):
+    # NaN isn't valid JSON, unmeasured values are written as null
+    return None if value is None or not math.isfinite(value) else round(float(value), decimals)
+
+
+def cell_polygon(cell, precision):
+    """Returns the (lon, lat) ring of an H3 cell as a closed list."""
+
+    ring = [[round(lng, precision), round(lat, precision)] for lat, lng in h3.cell_to_boundary(h3.int_to_str(cell))]
+    return ring + ring[:1]
+
+
+def isochrone_geojson(region, origin_coords, properties, region_format, precision):
+    """
+    Returns a reachable region as a GeoJSON FeatureCollection dict.
+
+    Args:
+        region (dict): Result of ``reachable_region``.
+        origin_coords (tuple): Requested (lat, lon) of the origin.
+        properties (dict): Request options added to the summary, e.g. the minutes.
+        region_format (str): 'h3' for a Polygon feature per cell with its
+            travel time and environment, 'polygon' for a single (Multi)Polygon
+            of the whole region.
+        precision (int): Decimals of the coordinates.
+
+    Returns:
+        dict: The FeatureCollection, with the averages over the whole region in its 'properties'.
+    """
+
+    summary = {
+        'origin_coords': list(origin_coords), **properties,
+        **{key: _round(value) if isinstance(value, float) else value for key, value in region['summary'].items()},
+    }
+
+    if region_format == 'polygon':
+        outline = shapely.union_all([
+            shapely.Polygon(cell_polygon(cell[0], 10)) for cell in region['cells']
+        ]) if region['cells'] else shapely.Polygon()
+        geometry = shapely.set_precision(outline, 10 ** -precision).__geo_interface__ if not outline.is_empty else None
+        features = [{'id': '0', 'type': 'Feature', 'properties': summary, 'geometry': geometry}]
+    else:
+        features = [
+            {
+                'id': h3.int_to_str(cell),
+                'type': 'Feature',
+                'properties': {
+                    'minutes': minutes,
+                    'ndvi': _round(ndvi), 'heat': _round(heat), 'noise': _round(noise, 1),
+                },
+                'geometry': {'type': 'Polygon', 'coordinates': [cell_polygon(cell, precision)]},
+            }
+            for cell, minutes, ndvi, heat, noise in region['cells']
+        ]
+
+    return {'type': 'FeatureCollection', 'properties': summary, 'features': features}
+
+
+def isochrone_cache_key(G, commute_mode, origin, cutoff_m, resolution):
+    """Returns the route cache key of a reachable region, with the versions of every data layer."""
+
+    layers = ','.join(layer_token(layer, G.layer_versions.get(layer)) for layer in ALL_LAYERS)
+    return ':'.join((
+        'isochrone', str(G.version), str(commute_mode), f'{cutoff_m:.0f}', str(resolution), layers, str(origin),
+    ))
@@ -0,0 +1,259 @@
+import heapq
+import os
+
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+from django.conf import settings
+
+from .async_executor import check_deadline
+from .csr_graph import predecessors_to_path, search_cost
+from .metrics import count
+
+
+DEFAULTS = {
+    # Use bidirectional A* with landmarks for point-to-point searches
+    'ENABLED': True,
+    # Landmarks selected per graph and cost column
+    'LANDMARKS': 16,
+    # Landmarks giving the best bounds for a query, used for its potentials
+    'ACTIVE': 4,
+}
+
+# Potentials are scaled down a little, so float32 rounding of the distance
+# tables can never make a reduced edge cost negative
+POTENTIAL_SLACK = 0.999
+
+# Queue pops between two deadline checks of a search
+DEADLINE_CHECK_POPS = 1024
+
+
+def get_alt_settings():
+    return {**DEFAULTS, **getattr(settings, 'ROUTING_ALT', {})}
+
+
+class Landmarks:
+    """
+    Landmark distance tables of one cost column (ALT preprocessing).
+
+    ``from_dist[i, v]`` is the distance from landmark i to node v and
+    ``to_dist[i, v]`` the distance from v to landmark i. By the triangle
+    inequality they give lower bounds on the distance between any two nodes,
+    which steer A* towards the target.
+    """
+
+    def __init__(self, nodes, from_dist, to_dist):
+        self.nodes = nodes
+        self.from_dist = from_dist
+        self.to_dist = to_dist
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @classmethod
+    def select(cls, G, weight, count=16):
+        """
+        Picks landmarks far from each other (farthest selection) and computes their distance tables.
+
+        The first landmark is the node farthest from node 0, every next one
+        the node farthest from all landmarks chosen so far; nodes that can't
+        reach or be reached from a landmark are never picked.
+        """
+
+        forward, backward = G.matrix(weight), G.reverse_matrix(weight)
+        count = min(count, G.n_nodes)
+
+        dist = dijkstra(forward, indices=0) + dijkstra(backward, indices=0)
+        node = int(np.argmax(np.where(np.isfinite(dist), dist, -1)))
+
+        nodes, from_rows, to_rows = [], [], []
+        closest = np.full(G.n_nodes, np.inf)
+        for _ in range(count):
+            nodes.append(node)
+            from_rows.append(dijkstra(forward, indices=node))
+            to_rows.append(dijkstra(backward, indices=node))
+
+            round_trip = from_rows[-1] + to_rows[-1]
+            closest = np.minimum(closest, np.where(np.isfinite(round_trip), round_trip, -1))
+            node = int(np.argmax(closest))
+            if closest[node] <= 0:
+                break
+
+        return cls(
+            np.array(nodes, dtype=np.int32),
+            np.array(from_rows, dtype=np.float32),
+            np.array(to_rows, dtype=np.float32),
+        )
+
+    @staticmethod
+    def paths(directory, weight):
+        return tuple(os.path.join(directory, f'alt_{weight}_{part}.npy') for part in ('nodes', 'from', 'to'))
+
+    def save(self, directory, weight):
+        for path, array in zip(self.paths(directory, weight), (self.nodes, self.from_dist, self.to_dist)):
+            np.save(path, array)
+
+    @classmethod
+    def load(cls, directory, weight, mmap_mode=None):
+        return cls(*(np.load(path, mmap_mode=mmap_mode) for path in cls.paths(directory, weight)))
+
+    def active(self, source, target, count):
+        """Returns the landmarks giving the tightest lower bound from source to target."""
+
+        bounds = np.maximum(
+            self.from_dist[:, target] - self.from_dist[:, source],
+            self.to_dist[:, source] - self.to_dist[:, target],
+        )
+        bounds = np.nan_to_num(bounds, nan=0, posinf=0, neginf=0)
+        return np.sort(np.argsort(-bounds, kind='stable')[:count])
+
+    def bounds_to(self, target, active):
+        """Returns a lower bound on the distance from every node to target."""
+
+        from_dist, to_dist = self.from_dist[active], self.to_dist[active]
+        with np.errstate(invalid='ignore'):
+            bounds = np.maximum(
+                from_dist[:, target, None] - from_dist,
+                to_dist - to_dist[:, target, None],
+            ).max(axis=0)
+        return np.maximum(np.nan_to_num(bounds, nan=0, posinf=0, neginf=0), 0)
+
+    def bounds_from(self, source, active):
+        """Returns a lower bound on the distance from source to every node."""
+
+        from_dist, to_dist = self.from_dist[active], self.to_dist[active]
+        with np.errstate(invalid='ignore'):
+            bounds = np.maximum(
+                from_dist - from_dist[:, source, None],
+                to_dist[:, source, None] - to_dist,
+            ).max(axis=0)
+        return np.maximum(np.nan_to_num(bounds, nan=0, posinf=0, neginf=0), 0)
+
+
+def add_landmarks(G, columns, count=None):
+    """Selects landmarks for every cost column of a CSRGraph and stores them in ``G.landmarks``."""
+
+    count = count or get_alt_settings()['LANDMARKS']
+    for weight in columns:
+        G.landmarks[weight] = Landmarks.select(G, weight, count)
+    return G
+
+
+def bidirectional_astar(G, source, target, weight, data=None, active_count=None):
+    """
+    Bidirectional A* search between two nodes with landmark (ALT) potentials.
+
+    Both searches use the average of the forward and backward landmark
+    bounds as potential, which keeps the two consistent with each other, so
+    the search stops as soon as the smallest keys of both queues add up to
+    the best path found.
+
+    Args:
+        G (CSRGraph): Graph with landmarks for ``weight`` in ``G.landmarks``.
+        source (int): Start node index.
+        target (int): End node index.
+        weight (str): Cost column the landmarks were computed for.
+        data (np.ndarray): Edge costs to search with instead of the column,
+            e.g. penalized costs; they must not be lower than the column.
+        active_count (int): Landmarks used, ``ROUTING_ALT['ACTIVE']`` by default.
+
+    Returns:
+        tuple: (cost, path as an array of node indices or None, settled nodes).
+    """
+
+    if source == target:
+        return 0.0, np.array([source], dtype=np.int32), 0
+
+    landmarks = G.landmarks[weight]
+    active = landmarks.active(source, target, active_count or get_alt_settings()['ACTIVE'])
+    potential = ((landmarks.bounds_to(target, active) - landmarks.bounds_from(source, active))
+                 * (POTENTIAL_SLACK / 2)).tolist()
+
+    costs = G.cost(weight) if data is None else search_cost(data)
+    G.reverse_matrix(weight)
+    reverse_costs = G.reverse_costs[weight] if data is None else costs[G.rev_edges]
+
+    # (indptr, indices, costs, sign of the potential) of the forward and backward search
+    sides = (
+        (memoryview(G.indptr), memoryview(G.indices), memoryview(np.ascontiguousarray(costs)), 1.0),
+        (memoryview(G.rev_indptr), memoryview(G.rev_indices), memoryview(np.ascontiguousarray(reverse_costs)), -1.0),
+    )
+    dist = ({source: 0.0}, {target: 0.0})
+    parent = ({source: -1}, {target: -1})
+    heaps = ([(potential[source], source)], [(-potential[target], target)])
+    settled = (set(), set())
+
+    best, meeting, pops = np.inf, -1, 0
+    while heaps[0] and heaps[1]:
+        if heaps[0][0][0] + heaps[1][0][0] >= best:
+            break
+        pops += 1
+        if pops % DEADLINE_CHECK_POPS == 0:
+            check_deadline()
+
+        # Expand the side with the smaller queue
+        side = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+        _, u = heapq.heappop(heaps[side])
+        if u in settled[side]:
+            continue
+        settled[side].add(u)
+
+        indptr, indices, edge_costs, sign = sides[side]
+        own, other = dist[side], dist[1 - side]
+        du = own[u]
+        for e in range(indptr[u], indptr[u + 1]):
+            v = indices[e]
+            dv = du + edge_costs[e]
+            if dv < own.get(v, np.inf):
+                own[v] = dv
+                parent[side][v] = u
+                heapq.heappush(heaps[side], (dv + sign * potential[v], v))
+                if v in other and dv + other[v] < best:
+                    best, meeting = dv + other[v], v
+
+    n_settled = len(settled[0]) + len(settled[1])
+    if meeting < 0:
+        return np.inf, None, n_settled
+
+    path = [meeting]
+    while parent[0][path[-1]] >= 0:
+        path.append(parent[0][path[-1]])
+    path.reverse()
+    while parent[1][path[-1]] >= 0:
+        path.append(parent[1][path[-1]])
+    return float(best), np.array(path, dtype=np.int32), n_settled
+
+
+def point_to_point(G, source, target, weight, data=None):
+    """
+    Returns the shortest path between two nodes.
+
+    Uses bidirectional A* when the graph has landmarks for ``weight`` and
+    ``ROUTING_ALT['ENABLED']`` is set, and a plain Dijkstra search otherwise.
+
+    Args:
+        G (CSRGraph): Graph to search.
+        source (int): Start node index.
+        target (int): End node index.
+        weight (str): Cost column to minimise.
+        data (np.ndarray): Edge costs to search with instead of the column,
+            they must not be lower than the column.
+
+    Returns:
+        tuple: (cost, path as an array of node indices or None, settled nodes).
+    """
+
+    if weight in G.landmarks and get_alt_settings()['ENABLED']:
+        cost, path, settled = bidirectional_astar(G, source, target, weight, data)
+    else:
+        check_deadline()
+        matrix = G.matrix(weight) if data is None else G.weighted_matrix(data)
+        dist, predecessors = dijkstra(matrix, indices=source, return_predecessors=True)
+        settled = int(np.isfinite(dist).sum())
+        if np.isinf(dist[target]):
+            cost, path = np.inf, None
+        else:
+            cost, path = float(dist[target]), predecessors_to_path(predecessors, source, target)
+
+    count('settled_nodes', settled)
+    return cost, path, settled
@@ -0,0 +1,384 @@
+import os
+import re
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from shapely import STRtree
+
+from django.conf import settings
+
+from .csr_graph import search_cost
+from .exposure import H3EdgeIndex
+from .h3_store import H3_LAYERS, H3LayerStore, ensure_h3_store
+from .landmarks import Landmarks, get_alt_settings
+from .multi_criteria import criteria_columns
+from .noise import NoiseIndex, changed_polygons, ensure_noise_store, get_noise_index, set_noise_index
+from .preprocessing import GRAPH_FILES, LAYER_FILES, ensure_data_stores, get_data_dir, noise_columns
+from .route_cache import get_route_cache, layer_token
+from .snapshot import build_snapshots, file_checksum, layer_version, load_graph, snapshot_is_current, source_checksums
+
+
+DEFAULTS = {
+    # Check the data layer files in the background and apply changed ones without a restart
+    'WATCH': True,
+    # Seconds between two checks of the files
+    'INTERVAL': 60,
+}
+
+
+GRAPH_DEFAULTS = {
+    # Commute modes served, e.g. ['bike'] for bike-only instances; other modes are never loaded
+    'COMMUTE_MODES': tuple(GRAPH_FILES),
+    # Load the graphs of the commute modes when a server process starts, in the background
+    'WARM_UP': True,
+    # Wait for the warm-up before serving, e.g. with gunicorn --preload so forked workers share the graphs
+    'WAIT': False,
+    # Processes building outdated snapshots at once during the warm-up
+    'WORKERS': 2,
+}
+
+
+def get_layer_settings():
+    return {**DEFAULTS, **getattr(settings, 'ROUTING_LAYERS', {})}
+
+
+def get_graph_settings():
+    return {**GRAPH_DEFAULTS, **getattr(settings, 'ROUTING_GRAPHS', {})}
+
+
+def enabled_commute_modes():
+    """Returns the commute modes this server serves, in ``GRAPH_FILES`` order."""
+
+    enabled = get_graph_settings()['COMMUTE_MODES']
+    return tuple(commute_mode for commute_mode in GRAPH_FILES if commute_mode in enabled)
+
+
+def load_layer(data_dir, layer):
+    """Returns the NoiseIndex or H3LayerStore of a data layer, building its binary store if it is outdated."""
+
+    if layer == 'noise':
+        ensure_noise_store(data_dir)
+        return NoiseIndex.load(data_dir)
+
+    ensure_h3_store(data_dir, H3_LAYERS[layer])
+    return H3LayerStore.load(data_dir, H3_LAYERS[layer])
+
+
+class GraphRegistry:
+    """
+    Prepared graphs by commute mode, with the data layers applied to them.
+
+    Graphs are loaded on first use, every commute mode on its own, or all
+    enabled ones at once by ``warm_up`` when a server process starts.
+    Changed data layer files (noise, NDVI, heat) are applied in the
+    background: only the edges the change touches are recomputed, found
+    through the H3 cell index of the graph or by intersecting the changed
+    noise polygons with the edges, and a new graph sharing every unchanged
+    array replaces the current one in a single assignment. Requests that
+    already hold the old graph finish on it, so no request is dropped or
+    sees half an update.
+
+    Every worker applies a change on its own: the recomputed columns, their
+    search costs and, after a noise change, the landmarks of the combined
+    cost (two Dijkstra searches per landmark) are private to the worker
+    instead of shared through the memory-mapped snapshot, until a restart
+    loads a snapshot prepared with the new files.
+    """
+
+    def __init__(self):
+        self._graphs = {}
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        # One lock per commute mode, so different modes load at the same time
+        self._load_locks = {commute_mode: threading.Lock() for commute_mode in GRAPH_FILES}
+        # {commute mode: 'loading', 'ready' or 'failed'}
+        self._states = {}
+        self._warm_up_pid = None
+        self.warm_up_info = None
+        os.register_at_fork(after_in_child=self._after_fork)
+        # {layer: (version, H3LayerStore or NoiseIndex)} last applied, to find what changed
+        self._layers = {}
+        # {file name: checksum}, so unchanged files are not hashed again
+        self._checksums = {}
+        self._watcher_pid = None
+        # False in processes that apply changed layers themselves instead, e.g. batch workers
+        self.watch_enabled = True
+        self.last_reload = None
+
+    def get(self, commute_mode):
+        """Returns the graph of a commute mode, loading it on first use."""
+
+        G = self._graphs.get(commute_mode)
+        if G is None:
+            with self._load_locks[commute_mode]:
+                G = self._graphs.get(commute_mode)
+                if G is None:
+                    self._states[commute_mode] = 'loading'
+                    try:
+                        G = load_graph(commute_mode)
+                        checksums = source_checksums(commute_mode)
+                    except Exception:
+                        self._states[commute_mode] = 'failed'
+                        raise
+                    with self._lock:
+                        self._checksums.update(checksums)
+                        self._remember_layers(G)
+                        self._graphs[commute_mode] = G
+                    self._states[commute_mode] = 'ready'
+        self.watch()
+        return G
+
+    def loaded(self):
+        """Returns {commute mode: graph} of the loaded graphs."""
+
+        return dict(self._graphs)
+
+    def _after_fork(self):
+        # Locks held by threads of the parent (e.g. a warm-up) stay locked in a forked child without those threads
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._load_locks = {commute_mode: threading.Lock() for commute_mode in GRAPH_FILES}
+        self._states = {commute_mode: 'ready' for commute_mode in self._graphs}
+
+    def warm_up(self, wait=False):
+        """
+        Loads the graphs of the enabled commute modes, once per process.
+
+        The data stores are built first, then outdated snapshots are built in
+        parallel processes (see ``build_snapshots``) and the graphs are
+        loaded side by side. Requests arriving meanwhile load the graph they
+        need themselves, waiting for a warm-up of the same mode already
+        running; ``readiness`` tells when all graphs are loaded.
+
+        Args:
+            wait (bool): Return after the warm-up instead of running it in the background.
+        """
+
+        with self._lock:
+            if self._warm_up_pid == os.getpid():
+                return
+            self._warm_up_pid = os.getpid()
+            self.warm_up_info = {'started': time.time(), 'seconds': None, 'error': None}
+
+        if wait:
+            self._warm_up()
+        else:
+            threading.Thread(target=self._warm_up, name='graph-warm-up', daemon=True).start()
+
+    def _warm_up(self):
+        start = time.perf_counter()
+        commute_modes = [mode for mode in enabled_commute_modes() if mode not in self._graphs]
+        try:
+            if commute_modes:
+                ensure_data_stores(get_data_dir())
+                outdated = [mode for mode in commute_modes if not snapshot_is_current(mode)]
+                build_snapshots(outdated, get_graph_settings()['WORKERS'])
+                with ThreadPoolExecutor(max_workers=len(commute_modes)) as pool:
+                    list(pool.map(self.get, commute_modes))
+        except Exception as e:
+            traceback.print_exc()
+            self.warm_up_info['error'] = str(e)
+        finally:
+            self.warm_up_info['seconds'] = round(time.perf_counter() - start, 3)
+            print(f"Graph warm-up finished in {self.warm_up_info['seconds']} s")
+
+    def readiness(self):
+        """
+        Returns whether the graphs of all enabled commute modes are loaded.
+
+        Starts the warm-up of this process if it didn't start yet, e.g. in
+        workers forked while the server process was still warming up.
+        """
+
+        if get_graph_settings()['WARM_UP']:
+            self.warm_up()
+        commute_modes = enabled_commute_modes()
+        return {
+            'ready': all(mode in self._graphs for mode in commute_modes),
+            'commute_modes': {mode: self._states.get(mode, 'not loaded') for mode in commute_modes},
+            'warm_up': self.warm_up_info,
+        }
+
+    def _remember_layers(self, G):
+        # Keep the data the graph was prepared from, the files on disk may be replaced later
+        data_dir = get_data_dir()
+        for layer, version in G.layer_versions.items():
+            if layer in self._layers:
+                continue
+            if self.file_versions(data_dir, [layer]).get(layer) != version:
+                continue
+            try:
+                # Paths are scored with the noise index already in use, no need for a second copy
+                data = get_noise_index() if layer == 'noise' else load_layer(data_dir, layer)
+            except OSError:
+                continue
+            self._layers[layer] = (version, data)
+
+    def file_versions(self, data_dir, layers=LAYER_FILES):
+        """Returns {layer: version} of the layer files in a data directory, missing files are left out."""
+
+        versions = {}
+        for layer in layers:
+            name = LAYER_FILES[layer]
+            path = os.path.join(data_dir, name)
+            if not os.path.exists(path):
+                continue
+            self._checksums[name] = file_checksum(path, self._checksums.get(name))
+            versions[layer] = layer_version(self._checksums[name])
+        return versions
+
+    def reload(self):
+        """
+        Applies the layer files that changed since the loaded graphs were prepared.
+
+        Returns:
+            dict: {layer: new version} of the applied layers, empty if nothing changed.
+        """
+
+        with self._reload_lock:
+            data_dir = get_data_dir()
+            graphs = self.loaded()
+            versions = self.file_versions(data_dir)
+            changed = {
+                layer: version for layer, version in versions.items()
+                if any(G.layer_versions.get(layer) != version for G in graphs.values())
+            }
+            if not changed:
+                return {}
+
+            start = time.perf_counter()
+            layers = {layer: (version, load_layer(data_dir, layer)) for layer, version in changed.items()}
+            updated = {commute_mode: self.apply(G, layers) for commute_mode, G in graphs.items()}
+
+            old_tokens = {
+                layer_token(layer, G.layer_versions.get(layer)) for G in graphs.values() for layer in changed
+            }
+            with self._lock:
+                self._graphs.update(updated)
+            if 'noise' in layers:
+                set_noise_index(layers['noise'][1])
+            self._layers.update(layers)
+
+            invalidated = get_route_cache().invalidate(lambda key: not old_tokens.isdisjoint(re.split('[:,]', key)))
+            self.last_reload = {
+                'layers': changed,
+                'seconds': round(time.perf_counter() - start, 3),
+                'invalidated_routes': invalidated,
+                'time': time.time(),
+            }
+            print(f"Applied data layers {', '.join(f'{layer}={version}' for layer, version in changed.items())} "
+                  f"in {self.last_reload['seconds']} s, {invalidated} cached routes invalidated")
+            return changed
+
+    def apply(self, G, layers):
+        """
+        Returns a graph with new versions of some data layers applied.
+
+        Args:
+            G (CSRGraph): Graph prepared with the previous versions.
+            layers (dict): {layer: (version, H3LayerStore or NoiseIndex)} to apply.
+
+        Returns:
+            CSRGraph: A new graph sharing the unchanged arrays of ``G``.
+        """
+
+        weights, costs = {}, {}
+        for layer, (_, data) in layers.items():
+            if layer == 'noise':
+                weights.update(self._noise_columns(G, data))
+            else:
+                weights.update(self._h3_columns(G, layer, data))
+
+        weights.update(criteria_columns({**G.weights, **weights}))
+        if 'combined' in weights:
+            costs['combined'] = search_cost(weights['combined'])
+
+        G_new = G.replace(
+            weights=weights, costs=costs,
+            layer_versions={layer: version for layer, (version, _) in layers.items()},
+        )
+        # Landmark bounds of changed costs could overestimate distances, so they are selected again
+        if 'combined' in costs and 'combined' in G.landmarks:
+            G_new.landmarks['combined'] = Landmarks.select(G_new, 'combined', get_alt_settings()['LANDMARKS'])
+        return G_new
+
+    def _previous(self, G, layer):
+        version, data = self._layers.get(layer, (None, None))
+        return data if version is not None and version == G.layer_versions.get(layer) else None
+
+    def _h3_columns(self, G, layer, store):
+        index = G.h3_index if G.h3_index is not None else H3EdgeIndex.build(G)
+        previous = self._previous(G, layer)
+        edge_ids = index.changed_edges(previous, store) if previous is not None else None
+
+        weighted_sum, covered_len = index.exposure(store, G.n_edges, edge_ids)
+        if edge_ids is None:
+            return {f'{layer}_sum': weighted_sum, f'{layer}_len': covered_len}
+
+        columns = {}
+        for column, values in ((f'{layer}_sum', weighted_sum), (f'{layer}_len', covered_len)):
+            columns[column] = np.array(G.weights[column], dtype=np.float32)
+            columns[column][edge_ids] = values[edge_ids]
+        return columns
+
+    def _noise_columns(self, G, noise_index):
+        lines = noise_index.lines(G.edge_geometries())
+        previous = self._previous(G, 'noise')
+        edge_ids = None
+        if previous is not None:
+            # Edges crossing a removed, added or changed polygon
+            _, edge_ids = STRtree(lines).query(changed_polygons(previous, noise_index), predicate='intersects')
+            edge_ids = np.unique(edge_ids)
+
+        columns = noise_columns(G, noise_index, edge_ids, lines)
+        if np.array_equal(columns['combined'], G.weights['combined']):
+            del columns['combined']
+        return columns
+
+    def watch(self):
+        """Starts the thread applying changed layer files, once per process (also in forked workers)."""
+
+        config = get_layer_settings()
+        if not config['WATCH'] or not self.watch_enabled or self._watcher_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+        threading.Thread(target=self._watch, args=(config['INTERVAL'],), name='layer-watcher', daemon=True).start()
+
+    def _watch(self, interval):
+        # A failed reload keeps the current graphs and is tried again on the next check
+        while True:
+            time.sleep(interval)
+            try:
+                self.reload()
+            except Exception:
+                traceback.print_exc()
+
+    def info(self):
+        """Returns the layer versions of the loaded graphs and the last reload."""
+
+        return {
+            'graphs': {
+                commute_mode: {'version': G.version, 'layers': G.layer_versions}
+                for commute_mode, G in self.loaded().items()
+            },
+            'last_reload': self.last_reload,
+        }
+
+
+_graph_registry = None
+
+
+def get_graph_registry():
+    """Returns the GraphRegistry of this process."""
+
+    global _graph_registry
+    if _graph_registry is None:
+        _graph_registry = GraphRegistry()
+    return _graph_registry
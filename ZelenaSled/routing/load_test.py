@@ -0,0 +1,391 @@
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pyproj import Transformer
+
+from .spatial_index import METRIC_CRS
+from .views import LJUBLJANA_BBOX
+
+
+# Share of the requests per commute and routing mode (None for the shortest paths)
+COMMUTE_MIX = {'walk': 0.6, 'bike': 0.4}
+ROUTING_MIX = {None: 0.4, 'vegetation': 0.25, 'heat': 0.15, 'noise': 0.2}
+
+# Straight-line trip lengths are log-normal around this median, within the limits
+TRIP_MEDIAN_M = {'walk': 1200, 'bike': 3500}
+TRIP_LIMITS_M = (200, 12000)
+
+# Share of the requests repeating an earlier trip, e.g. popular destinations
+REPEAT_SHARE = 0.2
+
+# Endpoint of the routing requests per server type
+ENDPOINTS = {
+    'wsgi': '/api/get_paths/',
+    'asgi': '/api/get_paths/async/',
+}
+
+PERCENTILES = (50, 90, 95, 99)
+
+# Directory of manage.py, the working directory of the servers
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generate_trace(count, bbox=LJUBLJANA_BBOX, seed=0, commute_mix=None, routing_mix=None,
+                   repeat_share=REPEAT_SHARE):
+    """
+    Generates route requests with a realistic mix of modes and trip lengths.
+
+    Origins are uniform in the bounding box, destinations at a log-normal
+    straight-line distance in a random direction (walking trips are shorter
+    than cycling ones) and clipped to the box. Some requests repeat earlier
+    ones, as many users plan the same trips.
+
+    Args:
+        count (int): Number of requests.
+        bbox (tuple): (min_lon, min_lat, max_lon, max_lat) of the points.
+        seed (int): Seed of the random generator.
+        commute_mix (dict): Share of each commute mode, COMMUTE_MIX by default.
+        routing_mix (dict): Share of each routing mode, ROUTING_MIX by default.
+        repeat_share (float): Share of repeated requests.
+
+    Returns:
+        list: Request bodies of ``get_paths``.
+    """
+
+    rng = np.random.default_rng(seed)
+    commute_mix = commute_mix or COMMUTE_MIX
+    routing_mix = routing_mix or ROUTING_MIX
+    to_metric = Transformer.from_crs("EPSG:4326", METRIC_CRS, always_xy=True)
+    to_lonlat = Transformer.from_crs(METRIC_CRS, "EPSG:4326", always_xy=True)
+
+    min_x, min_y = to_metric.transform(bbox[0], bbox[1])
+    max_x, max_y = to_metric.transform(bbox[2], bbox[3])
+
+    commute_modes = rng.choice(list(commute_mix), count, p=_shares(commute_mix))
+    routing_modes = rng.choice(len(routing_mix), count, p=_shares(routing_mix))
+    medians = np.array([TRIP_MEDIAN_M[mode] for mode in commute_modes])
+    lengths = np.clip(medians * rng.lognormal(0, 0.6, count), *TRIP_LIMITS_M)
+    angles = rng.uniform(0, 2 * np.pi, count)
+
+    origin_x, origin_y = rng.uniform(min_x, max_x, count), rng.uniform(min_y, max_y, count)
+    destination_x = np.clip(origin_x + lengths * np.cos(angles), min_x, max_x)
+    destination_y = np.clip(origin_y + lengths * np.sin(angles), min_y, max_y)
+    origin_lon, origin_lat = to_lonlat.transform(origin_x, origin_y)
+    destination_lon, destination_lat = to_lonlat.transform(destination_x, destination_y)
+
+    routing_names = list(routing_mix)
+    trace = []
+    for i in range(count):
+        if trace and rng.random() < repeat_share:
+            trace.append(dict(trace[int(rng.integers(len(trace)))]))
+            continue
+        trace.append({
+            'origin_coords': [round(float(origin_lat[i]), 6), round(float(origin_lon[i]), 6)],
+            'destination_coords': [round(float(destination_lat[i]), 6), round(float(destination_lon[i]), 6)],
+            'commute_mode': str(commute_modes[i]),
+            'routing_mode': routing_names[routing_modes[i]],
+        })
+    return trace
+
+
+def _shares(mix):
+    shares = np.array(list(mix.values()), dtype=float)
+    return shares / shares.sum()
+
+
+def save_trace(trace, path):
+    with open(path, 'w') as f:
+        for request in trace:
+            f.write(json.dumps(request) + '\n')
+
+
+def load_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_command(server, port, workers, threads=1, preload=False):
+    """
+    Returns the command line starting the app with gunicorn (WSGI) or uvicorn (ASGI).
+
+    Raises:
+        RuntimeError: If the server is not installed.
+    """
+
+    if server == 'wsgi':
+        if shutil.which('gunicorn') is None:
+            raise RuntimeError("WSGI load tests need gunicorn (pip install gunicorn)")
+        command = [
+            'gunicorn', 'ZelenaSled.wsgi:application', '--bind', f'127.0.0.1:{port}',
+            '--workers', str(workers), '--threads', str(threads), '--timeout', '120',
+        ]
+        return command + ['--preload'] if preload else command
+
+    if shutil.which('uvicorn') is None:
+        raise RuntimeError("ASGI load tests need uvicorn (pip install uvicorn)")
+    return [
+        'uvicorn', 'ZelenaSled.asgi:application', '--host', '127.0.0.1', '--port', str(port),
+        '--workers', str(workers), '--no-access-log',
+    ]
+
+
+class Server:
+    """A server process of the app on the loopback interface, stopped on exit."""
+
+    def __init__(self, command, env=None):
+        self.command = command
+        self.env = env
+        self.process = None
+        self.log = None
+
+    def start(self, url, timeout=300):
+        """Starts the server and waits until it answers ``url`` with anything but 503 (e.g. /api/ready/)."""
+
+        # Logs go to a file, a pipe nobody reads would block the server once full
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            self.command, cwd=PROJECT_DIR, env=self.env, stdout=self.log, stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited during startup:\n{self.log_tail()}")
+            try:
+                urllib.request.urlopen(url, timeout=5).close()
+                return self
+            except urllib.error.HTTPError as e:
+                if e.code != 503:
+                    return self
+                time.sleep(0.5)
+            except OSError:
+                time.sleep(0.5)
+        self.stop()
+        raise RuntimeError(f"Server did not answer {url} within {timeout} s")
+
+    def log_tail(self, size=2000):
+        self.log.seek(0, os.SEEK_END)
+        self.log.seek(max(self.log.tell() - size, 0))
+        return self.log.read().decode(errors='replace')
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            try:
+                self.process.wait(30)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def child_pids(pid):
+    """Returns the processes started by a process (Linux, read from /proc)."""
+
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name can hold spaces, the fields after it can't
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(entry))
+    return children
+
+
+def process_role(pid, server_pid, pids):
+    """Returns 'master', 'worker' or 'helper' (e.g. the resource tracker of multiprocessing) for a server process."""
+
+    if pid == server_pid:
+        return 'master' if len(pids) > 1 else 'worker'
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            if b'resource_tracker' in f.read():
+                return 'helper'
+    except OSError:
+        pass
+    return 'worker'
+
+
+def process_memory(pid):
+    """
+    Returns the memory of a process in MB (Linux): resident set, proportional
+    set (shared pages divided among the processes sharing them, e.g. the
+    memory-mapped graph snapshots) and private memory.
+    """
+
+    memory = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                if name in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    memory[name] = int(value.split()[0]) / 1024
+    except OSError:
+        return None
+    return {
+        'rss_mb': memory.get('Rss', 0.0),
+        'pss_mb': memory.get('Pss', 0.0),
+        'private_mb': memory.get('Private_Clean', 0.0) + memory.get('Private_Dirty', 0.0),
+    }
+
+
+class MemorySampler(threading.Thread):
+    """Records the peak memory of a server process and its workers every ``interval`` seconds."""
+
+    def __init__(self, pid, interval=1.0):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peaks = {}
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        for pid in [self.pid, *child_pids(self.pid)]:
+            memory = process_memory(pid)
+            if memory is None:
+                continue
+            peak = self.peaks.setdefault(pid, dict(memory))
+            for name, value in memory.items():
+                peak[name] = max(peak[name], value)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+        return self.peaks
+
+
+def send_request(url, body, timeout):
+    """Posts one route request, returns (status, error message or None)."""
+
+    request = urllib.request.Request(
+        url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'}, method='POST',
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status, None
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code, None
+    except OSError as e:
+        return None, str(e) or type(e).__name__
+
+
+def run_load(url, trace, rate, concurrency=64, timeout=60, seed=0, poisson=True):
+    """
+    Sends the requests of a trace at a fixed average rate (open loop).
+
+    Requests are sent at their scheduled time whether earlier ones have
+    finished or not, with Poisson arrivals by default, so a slow server
+    builds up a queue like it would in production. Latency is measured
+    from the scheduled time; when all ``concurrency`` client threads are
+    busy the wait for a free one counts too, so client limits never hide
+    server queueing.
+
+    Returns:
+        list: (request, scheduled offset, latency, status, error) per request,
+        status is None if the request failed without an HTTP response.
+    """
+
+    rng = np.random.default_rng(seed)
+    gaps = rng.exponential(1 / rate, len(trace)) if poisson else np.full(len(trace), 1 / rate)
+    offsets = np.cumsum(gaps) - gaps[0]
+
+    records = [None] * len(trace)
+
+    def task(i, scheduled):
+        status, error = send_request(url, trace[i], timeout)
+        records[i] = (trace[i], float(offsets[i]), time.perf_counter() - scheduled, status, error)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i, offset in enumerate(offsets):
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(task, i, start + offset)
+    return records
+
+
+def summarize(records, elapsed):
+    """
+    Returns throughput, error rate and latency percentiles of a load test,
+    overall and by commute and routing mode.
+    """
+
+    def latency_stats(group):
+        latencies = np.array([latency for _, _, latency, _, _ in group]) * 1000
+        stats = {f'p{p}_ms': round(float(np.percentile(latencies, p)), 1) for p in PERCENTILES}
+        stats['max_ms'] = round(float(latencies.max()), 1)
+        stats['requests'] = len(group)
+        stats['error_rate'] = round(sum(1 for *_, status, _ in group if status is None or status >= 500) / len(group), 4)
+        return stats
+
+    by_mode = defaultdict(list)
+    for record in records:
+        request = record[0]
+        by_mode[f"{request.get('commute_mode')}/{request.get('routing_mode')}"].append(record)
+
+    statuses = Counter('error' if status is None else str(status) for *_, status, _ in records)
+    errors = Counter(error for *_, error in records if error)
+    return {
+        'requests': len(records),
+        'elapsed_s': round(elapsed, 2),
+        'throughput_rps': round(sum(1 for *_, status, _ in records if status == 200) / elapsed, 2),
+        'statuses': dict(sorted(statuses.items())),
+        'client_errors': dict(errors.most_common(5)),
+        'latency': latency_stats(records),
+        'by_mode': {mode: latency_stats(group) for mode, group in sorted(by_mode.items())},
+    }
+
+
+def python_path_env(extra=None):
+    """Returns the environment of a server subprocess, with this project importable."""
+
+    env = {**os.environ, **(extra or {})}
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (PROJECT_DIR, env.get('PYTHONPATH'))))
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'ZelenaSled.settings')
+    return env
+
+
+def prepare_snapshots(env):
+    """Builds the graph snapshots before the server starts, so its workers don't all build them at once."""
+
+    subprocess.run(
+        [sys.executable, os.path.join(PROJECT_DIR, 'manage.py'), 'build_graph_snapshots'],
+        cwd=PROJECT_DIR, env=env, check=True, stdout=subprocess.DEVNULL,
+    )
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from routing.benchmark import CITY_SIZES, TRIP_LENGTHS_M, compare, load_results, run_benchmarks, save_results
+
+
+class Command(BaseCommand):
+    help = ('Time the graph preparation and route search stages on a synthetic city, '
+            'save the results as a baseline or compare them with one')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', choices=sorted(CITY_SIZES), default='ljubljana',
+                            help='Size of the synthetic street grid')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed of the synthetic data and the trips')
+        parser.add_argument('--queries', type=int, default=5,
+                            help='Origin-destination pairs timed per trip length')
+        parser.add_argument('--trip', choices=sorted(TRIP_LENGTHS_M), action='append',
+                            help='Trip length to time, all lengths by default')
+        parser.add_argument('--no-yen', action='store_true',
+                            help="Skip Yen's k shortest paths, the slowest engine")
+        parser.add_argument('--output', metavar='FILE',
+                            help='Write the results to a JSON file, e.g. a new baseline')
+        parser.add_argument('--compare', metavar='FILE',
+                            help='Compare the results with a baseline and fail on regressions')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Slowdown of a median flagged as a regression, as a share (0.25 = 25%%)')
+        parser.add_argument('--min-ms', type=float, default=1.0,
+                            help='Smallest slowdown in milliseconds flagged as a regression')
+
+    def handle(self, *args, **options):
+        baseline = load_results(options['compare']) if options['compare'] else None
+
+        results = run_benchmarks(
+            options['size'], options['seed'], options['queries'], options['trip'],
+            yen=not options['no_yen'], log=self.stdout.write,
+        )
+
+        if options['output']:
+            save_results(results, options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+        if baseline is None:
+            self.stdout.write(f"\n{'stage':<48} {'median ms':>10} {'p95 ms':>10} {'runs':>5}")
+            for key, result in results['results'].items():
+                self.stdout.write(f"{key:<48} {result['median_ms']:>10.2f} {result['p95_ms']:>10.2f} {result['runs']:>5}")
+            return
+
+        for name in ('size', 'seed', 'queries'):
+            if baseline['meta'].get(name) != results['meta'][name]:
+                self.stdout.write(self.style.WARNING(
+                    f"Baseline {name} is {baseline['meta'].get(name)}, not {results['meta'][name]}"
+                ))
+
+        rows, regressions = compare(results, baseline, options['threshold'], options['min_ms'])
+        self.stdout.write(f"\n{'stage':<48} {'baseline':>10} {'current':>10} {'ratio':>6}")
+        for key, before, after, ratio, status in rows:
+            line = (f"{key:<48} {_ms(before):>10} {_ms(after):>10} "
+                    f"{'' if ratio is None else f'{ratio:.2f}':>6}  {status}")
+            if status == 'REGRESSION':
+                line = self.style.ERROR(line)
+            elif status == 'faster':
+                line = self.style.SUCCESS(line)
+            self.stdout.write(line)
+
+        if regressions:
+            raise CommandError(f"{len(regressions)} stages regressed: {', '.join(regressions)}")
+        self.stdout.write(self.style.SUCCESS("No regressions"))
+
+
+def _ms(value):
+    return '-' if value is None else f'{value:.2f}'
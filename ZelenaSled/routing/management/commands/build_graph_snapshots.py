@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from routing.layers import enabled_commute_modes, get_graph_settings
+from routing.preprocessing import GRAPH_FILES, ensure_data_stores, get_data_dir
+from routing.snapshot import build_snapshots
+
+
+class Command(BaseCommand):
+    help = 'Prepare the walk and bike routing graphs and write them to binary snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=sorted(GRAPH_FILES), action='append',
+                            help='Commute mode to build, the modes in ROUTING_GRAPHS by default')
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild snapshots even if they are up to date')
+        parser.add_argument('--workers', type=int, default=get_graph_settings()['WORKERS'],
+                            help='Commute modes built at once, each in its own process')
+
+    def handle(self, *args, **options):
+        ensure_data_stores(get_data_dir())
+
+        paths = build_snapshots(options['mode'] or enabled_commute_modes(), options['workers'], options['force'])
+        for commute_mode, path in paths.items():
+            self.stdout.write(self.style.SUCCESS(f'{commute_mode}: {path}'))
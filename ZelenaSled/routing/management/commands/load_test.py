@@ -0,0 +1,175 @@
+import json
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from routing.benchmark import CITY_SIZES, write_synthetic_data
+from routing.load_test import (
+    ENDPOINTS, LJUBLJANA_BBOX, REPEAT_SHARE, MemorySampler, Server, free_port, generate_trace, load_trace,
+    prepare_snapshots, process_role, python_path_env, run_load, save_trace, send_request, server_command, summarize,
+)
+
+
+class Command(BaseCommand):
+    help = ('Load test /api/get_paths/ over loopback: start the app with gunicorn (WSGI) or uvicorn (ASGI), '
+            'send a trace of route requests at a fixed rate and report latency, errors and memory per worker')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server', choices=[*ENDPOINTS, 'none'], action='append',
+                            help="Server to start, repeat to compare them (wsgi by default); "
+                                 "'none' tests the server at --url")
+        parser.add_argument('--workers', type=int, action='append',
+                            help='Worker processes, repeat to compare worker counts (1 by default)')
+        parser.add_argument('--threads', type=int, default=1,
+                            help='Threads per gunicorn worker')
+        parser.add_argument('--preload', action='store_true',
+                            help='Load the app in the gunicorn master before forking the workers')
+        parser.add_argument('--url', default='http://127.0.0.1:8000',
+                            help="Address of the running server tested with --server none")
+        parser.add_argument('--rate', type=float, default=5.0,
+                            help='Average requests per second (Poisson arrivals)')
+        parser.add_argument('--duration', type=float, default=30.0,
+                            help='Seconds of requests to send, unless --requests or --trace is given')
+        parser.add_argument('--requests', type=int,
+                            help='Number of requests to send')
+        parser.add_argument('--concurrency', type=int, default=64,
+                            help='Most requests in flight at once')
+        parser.add_argument('--timeout', type=float, default=60.0,
+                            help='Seconds before a request is counted as failed')
+        parser.add_argument('--warmup', type=int, default=10,
+                            help='Requests sent one by one before the measurement')
+        parser.add_argument('--trace', metavar='FILE',
+                            help='Replay the requests of a JSON lines trace instead of generating them')
+        parser.add_argument('--save-trace', metavar='FILE',
+                            help='Write the generated trace to a JSON lines file')
+        parser.add_argument('--repeat-share', type=float, default=REPEAT_SHARE,
+                            help='Share of generated requests repeating an earlier trip')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed of the generated trace and arrival times')
+        parser.add_argument('--synthetic', choices=sorted(CITY_SIZES),
+                            help='Serve a synthetic city of this size instead of the real data files')
+        parser.add_argument('--data-dir',
+                            help='Directory of the synthetic data files, a temporary directory by default')
+        parser.add_argument('--startup-timeout', type=float, default=300.0,
+                            help='Seconds to wait for a started server to answer')
+        parser.add_argument('--output', metavar='FILE',
+                            help='Write the results of every configuration to a JSON file')
+
+    def handle(self, *args, **options):
+        env, bbox = python_path_env(), LJUBLJANA_BBOX
+        if options['synthetic']:
+            data_dir = options['data_dir'] or os.path.join(
+                tempfile.gettempdir(), f"zelenasled-loadtest-{options['synthetic']}-{options['seed']}"
+            )
+            self.stdout.write(f"Writing a {options['synthetic']} synthetic city to {data_dir}")
+            try:
+                bbox = write_synthetic_data(data_dir, options['synthetic'], options['seed'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            env['ROUTING_DATA_DIR'] = data_dir
+
+        if options['trace']:
+            trace = load_trace(options['trace'])
+        else:
+            count = options['requests'] or max(int(options['rate'] * options['duration']), 1)
+            trace = generate_trace(count + options['warmup'], bbox, options['seed'],
+                                   repeat_share=options['repeat_share'])
+            if options['save_trace']:
+                save_trace(trace, options['save_trace'])
+        warmup, trace = trace[:options['warmup']], trace[options['warmup']:]
+        if not trace:
+            raise CommandError("The trace has no requests left after the warm-up")
+
+        servers = options['server'] or ['wsgi']
+        if any(server != 'none' for server in servers):
+            self.stdout.write("Building the graph snapshots")
+            prepare_snapshots(env)
+
+        results = []
+        for server in servers:
+            for workers in ([None] if server == 'none' else options['workers'] or [1]):
+                result = self.run_configuration(server, workers, env, warmup, trace, options)
+                results.append(result)
+                self.report(result)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+                f.write('\n')
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def run_configuration(self, server, workers, env, warmup, trace, options):
+        config = {'server': server, 'workers': workers, 'rate': options['rate']}
+        if server == 'wsgi':
+            config['threads'] = options['threads']
+
+        if server == 'none':
+            return {**config, **self.drive(options['url'] + ENDPOINTS['wsgi'], warmup, trace, options)}
+
+        port = free_port()
+        try:
+            command = server_command(server, port, workers, options['threads'], options['preload'])
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(f"\nStarting {' '.join(command)}")
+        base_url = f'http://127.0.0.1:{port}'
+        with Server(command, env) as process:
+            try:
+                process.start(base_url + '/api/ready/', options['startup_timeout'])
+            except RuntimeError as e:
+                raise CommandError(str(e))
+
+            sampler = MemorySampler(process.process.pid)
+            sampler.start()
+            result = self.drive(base_url + ENDPOINTS[server], warmup, trace, options)
+            peaks = sampler.stop()
+
+            # Roles are read while the processes still run
+            result['memory'] = [
+                {
+                    'pid': pid, 'role': process_role(pid, process.process.pid, peaks),
+                    **{name: round(value, 1) for name, value in peak.items()},
+                }
+                for pid, peak in sorted(peaks.items())
+            ]
+        return {**config, **result}
+
+    def drive(self, url, warmup, trace, options):
+        for request in warmup:
+            send_request(url, request, options['timeout'])
+
+        self.stdout.write(f"Sending {len(trace)} requests at {options['rate']:g}/s to {url}")
+        start = time.perf_counter()
+        records = run_load(url, trace, options['rate'], options['concurrency'], options['timeout'], options['seed'])
+        return summarize(records, time.perf_counter() - start)
+
+    def report(self, result):
+        latency = result['latency']
+        title = result['server']
+        if result['workers'] is not None:
+            title += f", {result['workers']} worker{'s' if result['workers'] != 1 else ''}"
+        self.stdout.write(self.style.MIGRATE_HEADING(f"\n{title}"))
+        self.stdout.write(
+            f"{result['requests']} requests in {result['elapsed_s']} s, {result['throughput_rps']} routes/s, "
+            f"error rate {latency['error_rate']:.2%}, statuses {result['statuses']}"
+        )
+        for error, count in result['client_errors'].items():
+            self.stdout.write(self.style.WARNING(f"  {count} x {error}"))
+
+        self.stdout.write(f"{'mode':<24} {'requests':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7}")
+        for mode, stats in [('all', latency), *result['by_mode'].items()]:
+            self.stdout.write(
+                f"{mode:<24} {stats['requests']:>8} {stats['p50_ms']:>8} {stats['p95_ms']:>8} "
+                f"{stats['p99_ms']:>8} {stats['max_ms']:>8} {stats['error_rate']:>7.2%}"
+            )
+
+        if result.get('memory'):
+            self.stdout.write(f"{'process':<24} {'rss MB':>8} {'pss MB':>8} {'private MB':>11}")
+            for memory in result['memory']:
+                self.stdout.write(
+                    f"{memory['role'] + ' ' + str(memory['pid']):<24} {memory['rss_mb']:>8} "
+                    f"{memory['pss_mb']:>8} {memory['private_mb']:>11}"
+                )
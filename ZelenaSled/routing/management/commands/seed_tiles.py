@@ -0,0 +1,46 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from routing.tiles import LAYER_STYLES, get_tile, get_tile_settings, tile_path, tile_version, tiles_in_bbox
+from routing.views import LJUBLJANA_BBOX
+
+
+class Command(BaseCommand):
+    help = 'Render the NDVI, heat and noise map tiles of the bounding box ahead, so the first map views are fast'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--layer', choices=sorted(LAYER_STYLES), action='append',
+                            help='Layer to render, all layers by default')
+        parser.add_argument('--min-zoom', type=int, default=get_tile_settings()['MIN_ZOOM'],
+                            help='Lowest zoom to render')
+        parser.add_argument('--max-zoom', type=int, default=get_tile_settings()['SEED_MAX_ZOOM'],
+                            help='Highest zoom to render')
+        parser.add_argument('--bbox', type=float, nargs=4, metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+                            default=LJUBLJANA_BBOX, help='Area to render, Ljubljana by default')
+        parser.add_argument('--force', action='store_true',
+                            help='Render tiles again even if they are cached')
+
+    def handle(self, *args, **options):
+        config = get_tile_settings()
+        if not config['MIN_ZOOM'] <= options['min_zoom'] <= options['max_zoom'] <= config['MAX_ZOOM']:
+            raise CommandError(f"Zooms must be between {config['MIN_ZOOM']} and {config['MAX_ZOOM']}")
+
+        for layer in options['layer'] or sorted(LAYER_STYLES):
+            version = tile_version(layer)
+            if version is None:
+                self.stdout.write(self.style.WARNING(f'{layer}: layer file not found, skipped'))
+                continue
+
+            for z in range(options['min_zoom'], options['max_zoom'] + 1):
+                start, rendered = time.perf_counter(), 0
+                tiles = tiles_in_bbox(options['bbox'], z)
+                for x, y in tiles:
+                    if options['force'] or not os.path.exists(tile_path(layer, version, z, x, y)):
+                        get_tile(layer, version, z, x, y, refresh=True)
+                        rendered += 1
+                self.stdout.write(
+                    f'{layer} zoom {z}: {rendered} of {len(tiles)} tiles rendered in {time.perf_counter() - start:.1f} s'
+                )
+            self.stdout.write(self.style.SUCCESS(f'{layer}: {version}'))
@@ -0,0 +1,239 @@
+import bisect
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+
+DEFAULTS = {
+    # Time request stages, send Server-Timing headers and collect metrics
+    'ENABLED': True,
+    # Client addresses allowed to read /metrics
+    'ALLOWED_IPS': ['127.0.0.1', '::1'],
+}
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRIC_PREFIX = 'zelenasled'
+
+
+def get_metrics_settings():
+    return {**DEFAULTS, **getattr(settings, 'ROUTING_METRICS', {})}
+
+
+class RequestTimings:
+    """Stage durations, counters and labels collected while one request is served."""
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.labels = {'commute_mode': 'none', 'routing_mode': 'none'}
+        self.descriptions = {}
+
+    def server_timing(self):
+        """Returns the value of the Server-Timing header, durations in milliseconds."""
+
+        entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items()]
+        entries += [f'{name};desc="{description}"' for name, description in self.descriptions.items()]
+        return ', '.join(entries)
+
+
+_current = ContextVar('routing_timings', default=None)
+
+
+@contextmanager
+def stage(name):
+    """Adds the time spent in the block to a stage of the current request."""
+
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.stages[name] = timings.stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def count(name, value=1):
+    """Adds to a counter of the current request, e.g. candidate paths or settled nodes."""
+
+    timings = _current.get()
+    if timings is not None:
+        timings.counters[name] = timings.counters.get(name, 0) + value
+
+
+def set_labels(**labels):
+    timings = _current.get()
+    if timings is not None:
+        timings.labels.update({key: 'none' if value is None else str(value) for key, value in labels.items()})
+
+
+def describe(name, description):
+    """Adds a description-only entry to the Server-Timing header, e.g. cache hit or miss."""
+
+    timings = _current.get()
+    if timings is not None:
+        timings.descriptions[name] = description
+
+
+@contextmanager
+def collect_timings():
+    """Collects the stages and counters of the block outside of a request, e.g. in benchmarks."""
+
+    timings = RequestTimings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+class Histogram:
+    """Cumulative histogram of durations in fixed buckets, Prometheus style."""
+
+    __slots__ = ('counts', 'total', 'n')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.n = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.n += 1
+
+
+class MetricsRegistry:
+    """
+    Request metrics of this process.
+
+    Every request adds a few histogram and counter updates under one lock,
+    so it's cheap enough to keep on in production. Each worker process has
+    its own registry; scrape every worker or aggregate the counters.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.stages = {}
+        self.counters = {}
+
+    def record(self, timings, status, seconds):
+        labels = (timings.labels['commute_mode'], timings.labels['routing_mode'])
+        with self._lock:
+            self.latency.setdefault(labels, Histogram()).observe(seconds)
+            for name, stage_seconds in timings.stages.items():
+                if name == 'total':
+                    continue
+                self.stages.setdefault((*labels, name), Histogram()).observe(stage_seconds)
+
+            key = ('requests', *labels, str(status))
+            self.counters[key] = self.counters.get(key, 0) + 1
+            for name, value in timings.counters.items():
+                key = (name, *labels, '')
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format."""
+
+        with self._lock:
+            latency = {labels: _copy(h) for labels, h in self.latency.items()}
+            stages = {labels: _copy(h) for labels, h in self.stages.items()}
+            counters = dict(self.counters)
+
+        lines = [f'# TYPE {METRIC_PREFIX}_request_seconds histogram']
+        for (commute_mode, routing_mode), histogram in sorted(latency.items()):
+            lines += _histogram_lines(
+                f'{METRIC_PREFIX}_request_seconds',
+                f'commute_mode="{commute_mode}",routing_mode="{routing_mode}"', histogram,
+            )
+
+        lines.append(f'# TYPE {METRIC_PREFIX}_stage_seconds histogram')
+        for (commute_mode, routing_mode, name), histogram in sorted(stages.items()):
+            lines += _histogram_lines(
+                f'{METRIC_PREFIX}_stage_seconds',
+                f'commute_mode="{commute_mode}",routing_mode="{routing_mode}",stage="{name}"', histogram,
+            )
+
+        for name in sorted({key[0] for key in counters}):
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name}_total counter')
+            for (counter, commute_mode, routing_mode, status), value in sorted(counters.items()):
+                if counter != name:
+                    continue
+                labels = f'commute_mode="{commute_mode}",routing_mode="{routing_mode}"'
+                if status:
+                    labels += f',status="{status}"'
+                lines.append(f'{METRIC_PREFIX}_{name}_total{{{labels}}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _copy(histogram):
+    copy = Histogram()
+    copy.counts, copy.total, copy.n = list(histogram.counts), histogram.total, histogram.n
+    return copy
+
+
+def _histogram_lines(name, labels, histogram):
+    lines, cumulative = [], 0
+    for bound, bucket_count in zip((*BUCKETS, '+Inf'), histogram.counts):
+        cumulative += bucket_count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram.total:.6f}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.n}')
+    return lines
+
+
+registry = MetricsRegistry()
+
+
+def _finish(timings, response, start):
+    seconds = time.perf_counter() - start
+    timings.stages['total'] = seconds
+    response['Server-Timing'] = timings.server_timing()
+    registry.record(timings, response.status_code, seconds)
+    return response
+
+
+def instrument(view):
+    """
+    Times a routing view: its response gets a Server-Timing header with the
+    durations of the stages and the request is recorded in the registry.
+
+    Works with sync and async views; the timings follow the request into
+    the worker threads of the async executor through its context.
+    """
+
+    if inspect.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if not get_metrics_settings()['ENABLED']:
+                return await view(request, *args, **kwargs)
+            timings, start = RequestTimings(), time.perf_counter()
+            token = _current.set(timings)
+            try:
+                return _finish(timings, await view(request, *args, **kwargs), start)
+            finally:
+                _current.reset(token)
+    else:
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not get_metrics_settings()['ENABLED']:
+                return view(request, *args, **kwargs)
+            timings, start = RequestTimings(), time.perf_counter()
+            token = _current.set(timings)
+            try:
+                return _finish(timings, view(request, *args, **kwargs), start)
+            finally:
+                _current.reset(token)
+
+    return wrapper
@@ -0,0 +1,240 @@
+from itertools import combinations
+
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+from django.conf import settings
+
+from .async_executor import check_deadline
+from .csr_graph import predecessors_to_path
+from .metrics import count
+
+
+# Criteria of a weighted search and the edge cost column of each
+CRITERIA = {
+    'length': 'length',
+    'noise': 'noise_cost',
+    'vegetation': 'green_cost',
+    'heat': 'heat_cost',
+}
+
+DEFAULTS = {
+    # Steps between 0 and 1 of every criterion weight explored in Pareto mode
+    'PARETO_STEPS': 3,
+    # Most Pareto-optimal paths returned, spread over the front by length
+    'MAX_PARETO_PATHS': 5,
+}
+
+# Share of the length always added to the cost, so paths through zero-cost
+# edges (quiet, green or cool) never take arbitrary detours
+LENGTH_EPSILON = 1e-3
+
+# Percentiles of the edge values mapped to 0 and 1 when normalizing a criterion
+NORMALIZATION_PERCENTILES = (5, 95)
+
+
+def get_multi_criteria_settings():
+    return {**DEFAULTS, **getattr(settings, 'ROUTING_MULTI_CRITERIA', {})}
+
+
+def normalize(values, covered=None):
+    """
+    Scales edge values to 0-1 between the 5th and 95th percentile of the covered edges.
+
+    Edges that are not covered get 0.5, so missing data neither attracts nor
+    repels a search.
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    if covered is None:
+        covered = ~np.isnan(values)
+    if not covered.any():
+        return np.full(len(values), 0.5)
+
+    low, high = np.percentile(values[covered], NORMALIZATION_PERCENTILES)
+    scaled = np.clip((values - low) / max(high - low, 1e-9), 0, 1)
+    return np.where(covered, scaled, 0.5)
+
+
+def add_criteria_columns(G):
+    """
+    Adds the edge cost columns of the multi-criteria search to a CSRGraph.
+
+    Returns:
+        CSRGraph: The graph, with the columns of ``criteria_columns`` added to ``G.weights``.
+    """
+
+    G.weights.update(criteria_columns(G.weights))
+    return G
+
+
+def criteria_columns(weights):
+    """
+    Returns the edge cost columns of the multi-criteria search.
+
+    Each criterion is normalized to 0-1 per meter and multiplied by the edge
+    length, so all columns are in "penalty meters" and user weights of
+    different criteria are comparable:
+
+    - ``noise_cost``: loud edges cost their full length, quiet ones nothing
+    - ``green_cost``: edges without vegetation cost their full length
+    - ``heat_cost``: hot edges cost their full length, cool ones nothing
+
+    Args:
+        weights (dict): Weight columns of a CSRGraph with 'length', 'noise'
+            and the '<layer>_sum'/'<layer>_len' columns of 'ndvi' and 'heat'.
+
+    Returns:
+        dict: {column: float32 array}.
+    """
+
+    length = weights['length'].astype(np.float64)
+
+    def layer_average(layer):
+        covered_len = weights[f'{layer}_len'].astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            average = weights[f'{layer}_sum'] / covered_len
+        return average, covered_len > 0
+
+    ndvi, ndvi_covered = layer_average('ndvi')
+    heat, heat_covered = layer_average('heat')
+
+    return {
+        'noise_cost': (length * normalize(weights['noise'])).astype(np.float32),
+        'green_cost': (length * (1 - normalize(ndvi, ndvi_covered))).astype(np.float32),
+        'heat_cost': (length * normalize(heat, heat_covered)).astype(np.float32),
+    }
+
+
+def parse_weights(weights):
+    """
+    Validates user weights of the criteria.
+
+    Args:
+        weights (dict): {criterion: weight}, missing criteria weigh 0.
+
+    Returns:
+        dict: Float weight of every criterion.
+
+    Raises:
+        ValueError: If a criterion is unknown or the weights are not valid.
+    """
+
+    if not isinstance(weights, dict):
+        raise ValueError("Weights must be an object of criteria and their weights")
+
+    unknown = set(weights) - set(CRITERIA)
+    if unknown:
+        raise ValueError(f"Unknown criteria: {', '.join(sorted(unknown))} (use {', '.join(CRITERIA)})")
+
+    try:
+        parsed = {criterion: float(weights.get(criterion, 0)) for criterion in CRITERIA}
+    except (TypeError, ValueError):
+        raise ValueError("Weights must be numbers")
+
+    if any(not np.isfinite(w) or w < 0 for w in parsed.values()) or not any(parsed.values()):
+        raise ValueError("Weights must be non-negative and at least one must be positive")
+    return parsed
+
+
+def weights_key(weights, pareto=False):
+    """Returns a short string identifying weights, e.g. for cache keys."""
+
+    key = ','.join(f'{criterion}={weights[criterion]:g}' for criterion in CRITERIA)
+    return f'pareto:{key}' if pareto else key
+
+
+def criteria_cost(G, weights):
+    """Returns the float64 edge cost of a weighted sum of the criteria."""
+
+    length = G.weights['length']
+    cost = LENGTH_EPSILON * length.astype(np.float64)
+    for criterion, column in CRITERIA.items():
+        if weights.get(criterion):
+            cost += weights[criterion] * G.weights[column]
+    return cost
+
+
+def path_criteria(G, path):
+    """Returns the cost of every criterion along a path, in CRITERIA order."""
+
+    edge_ids = G.edge_ids(path)
+    return np.array([G.weights[column][edge_ids].sum(dtype=np.float64) for column in CRITERIA.values()])
+
+
+def weighted_path(G, orig_node, dest_node, weights):
+    """
+    Returns the path minimising the weighted sum of the criteria, found with one search.
+
+    Returns:
+        np.ndarray: Path as node indices, or None if the destination is unreachable.
+    """
+
+    dist, predecessors = dijkstra(
+        G.weighted_matrix(criteria_cost(G, weights)), indices=orig_node, return_predecessors=True
+    )
+    count('settled_nodes', int(np.isfinite(dist).sum()))
+    return predecessors_to_path(predecessors, orig_node, dest_node)
+
+
+def simplex_weights(criteria, steps):
+    """Yields every weighting of the criteria with weights in multiples of 1/steps summing to 1."""
+
+    # Stars and bars: place len(criteria) - 1 bars among steps + len(criteria) - 1 slots
+    n = len(criteria)
+    for bars in combinations(range(steps + n - 1), n - 1):
+        parts = np.diff((-1, *bars, steps + n - 1)) - 1
+        yield {criterion: part / steps for criterion, part in zip(criteria, parts)}
+
+
+def pareto_front(objectives):
+    """Returns a boolean mask of the rows not dominated by any other row."""
+
+    objectives = np.asarray(objectives, dtype=float)
+    no_worse = (objectives[:, None, :] <= objectives[None, :, :]).all(axis=2)
+    better = (objectives[:, None, :] < objectives[None, :, :]).any(axis=2)
+    dominates = no_worse & better
+    return ~dominates.any(axis=0)
+
+
+def pareto_paths(G, orig_node, dest_node, weights, steps=None, max_paths=None):
+    """
+    Returns Pareto-optimal paths over the criteria with a positive weight.
+
+    One weighted search is run for every weighting on a simplex grid of the
+    selected criteria; the distinct paths found are filtered to the ones no
+    other path beats on all criteria. Weighted sums only reach the convex
+    part of the front, which is what users can tell apart anyway.
+
+    Returns:
+        list: Paths as node indices, sorted by length.
+    """
+
+    config = get_multi_criteria_settings()
+    steps = steps or config['PARETO_STEPS']
+    max_paths = max_paths or config['MAX_PARETO_PATHS']
+
+    criteria = [criterion for criterion in CRITERIA if weights.get(criterion)]
+    if 'length' not in criteria:
+        criteria.insert(0, 'length')
+
+    paths, seen = [], set()
+    for grid_weights in simplex_weights(criteria, steps):
+        check_deadline()
+        path = weighted_path(G, orig_node, dest_node, grid_weights)
+        if path is not None and tuple(path) not in seen:
+            seen.add(tuple(path))
+            paths.append(path)
+
+    if not paths:
+        return []
+
+    columns = [list(CRITERIA).index(criterion) for criterion in criteria]
+    objectives = np.array([path_criteria(G, path)[columns] for path in paths])
+    front = np.flatnonzero(pareto_front(objectives))
+    front = front[np.argsort(objectives[front, 0], kind='stable')]
+
+    # Spread the returned paths over the front, from the shortest to the longest
+    if len(front) > max_paths:
+        front = front[np.unique(np.linspace(0, len(front) - 1, max_paths).round().astype(int))]
+    return [paths[i] for i in front]
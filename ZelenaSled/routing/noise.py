@@ -0,0 +1,246 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import Transformer
+from shapely import GeometryType, STRtree
+
+from .exposure import edge_coordinates
+from .h3_store import _save_atomic
+from .spatial_index import METRIC_CRS
+
+
+NOISE_FILE = 'Slovenia_Osrednjeslovenska_Ljubljana.areas.geojson'
+
+# Name of the binary store of the noise hexagons in the data directory
+NOISE_STORE = 'noise_areas'
+
+# Noise-Planet columns used as the noise level, in order of preference
+NOISE_COLUMNS = ('la50', 'laeq')
+
+# A path needs a measurement at least every this many meters to be ranked by noise
+MAX_UNMEASURED_M = 500
+
+
+class NoiseIndex:
+    """
+    STRtree over the Noise-Planet hexagons in a metric CRS.
+
+    Lines are intersected only with the hexagons the tree returns for them,
+    so the exposure of all graph edges is computed in one vectorized pass
+    and a single path is scored in a few milliseconds.
+    """
+
+    def __init__(self, polygons, values, crs=METRIC_CRS):
+        self.polygons = np.asarray(polygons)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.crs = crs
+        self.tree = STRtree(self.polygons)
+        self.to_metric = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+
+    def __len__(self):
+        return len(self.polygons)
+
+    @classmethod
+    def from_geodataframe(cls, noise_data, crs=METRIC_CRS):
+        column = next(column for column in NOISE_COLUMNS if column in noise_data)
+        noise_data = noise_data[noise_data[column].notna()].to_crs(crs)
+        return cls(noise_data.geometry.to_numpy(), noise_data[column].to_numpy(), crs)
+
+    @classmethod
+    def from_file(cls, path, crs=METRIC_CRS):
+        """Reads the hexagons of a Noise-Planet GeoJSON export."""
+
+        return cls.from_geodataframe(gpd.read_file(path), crs)
+
+    @classmethod
+    def load(cls, data_dir):
+        coords, ring_offsets, polygon_offsets, values = (np.load(path) for path in store_paths(data_dir))
+        polygons = shapely.from_ragged_array(GeometryType.POLYGON, coords, (ring_offsets, polygon_offsets))
+        return cls(polygons, values)
+
+    def save(self, data_dir):
+        _, coords, (ring_offsets, polygon_offsets) = shapely.to_ragged_array(self.polygons, include_z=False)
+        coords_path, rings_path, polygons_path, values_path = store_paths(data_dir)
+        _save_atomic(rings_path, ring_offsets)
+        _save_atomic(polygons_path, polygon_offsets)
+        _save_atomic(values_path, self.values)
+        _save_atomic(coords_path, coords)
+
+    def lines(self, coords_list):
+        """Returns metric LineStrings of (lon, lat) coordinate arrays, projected in one call."""
+
+        coords = np.concatenate(coords_list)
+        indices = np.repeat(np.arange(len(coords_list)), [len(c) for c in coords_list])
+        x, y = self.to_metric.transform(coords[:, 0], coords[:, 1])
+        return shapely.linestrings(np.column_stack((x, y)), indices=indices)
+
+    def exposure(self, lines):
+        """
+        Returns the noise exposure of metric lines.
+
+        Returns:
+            tuple: Arrays of the sum of noise level * meters over the measured
+            parts of each line, the measured meters and the total meters.
+        """
+
+        line_index, polygon_index = self.tree.query(lines, predicate='intersects')
+        pieces = shapely.intersection(lines[line_index], self.polygons[polygon_index])
+        piece_lengths = shapely.length(pieces)
+
+        weighted_sum = np.bincount(line_index, weights=piece_lengths * self.values[polygon_index], minlength=len(lines))
+        covered = np.bincount(line_index, weights=piece_lengths, minlength=len(lines))
+        return weighted_sum, covered, shapely.length(lines)
+
+    def score_path(self, coords):
+        """
+        Scores a path geometry against the noise measurements.
+
+        Args:
+            coords (array_like): (lon, lat) coordinates of the path.
+
+        Returns:
+            dict: Length-weighted 'la50' (None if nothing is measured),
+            'coverage' as the measured share of the length and 'max_gap_m',
+            the longest stretch of the path without a measurement.
+        """
+
+        line = self.lines([np.asarray(coords, dtype=float)])[0]
+        polygon_index = self.tree.query(line, predicate='intersects')
+        pieces = shapely.intersection(line, self.polygons[polygon_index])
+        piece_lengths = shapely.length(pieces)
+
+        total = line.length
+        covered = piece_lengths.sum()
+        la50 = float((piece_lengths * self.values[polygon_index]).sum() / covered) if covered > 0 else None
+
+        return {
+            'la50': la50,
+            'coverage': float(min(covered / total, 1.0)) if total > 0 else 0.0,
+            'max_gap_m': float(self._max_gap(line, pieces)),
+        }
+
+    @staticmethod
+    def _max_gap(line, pieces):
+        # Locate every measured piece along the line and find the longest stretch between them
+        parts = shapely.get_parts(pieces)
+        parts = parts[shapely.get_type_id(parts) == GeometryType.LINESTRING]
+        if not len(parts):
+            return line.length
+
+        starts = shapely.line_locate_point(line, shapely.get_point(parts, 0))
+        ends = shapely.line_locate_point(line, shapely.get_point(parts, -1))
+        order = np.argsort(np.minimum(starts, ends))
+        lo = np.minimum(starts, ends)[order]
+        reach = np.maximum.accumulate(np.maximum(starts, ends)[order])
+
+        return max(lo[0], (lo[1:] - reach[:-1]).max(initial=0.0), line.length - reach[-1])
+
+
+def store_paths(data_dir):
+    return tuple(
+        os.path.join(data_dir, f'{NOISE_STORE}.{part}.npy')
+        for part in ('coords', 'ring_offsets', 'polygon_offsets', 'values')
+    )
+
+
+def ensure_noise_store(data_dir):
+    """Builds the binary store of the noise hexagons if it is missing or older than the GeoJSON."""
+
+    source = os.path.join(data_dir, NOISE_FILE)
+    if not os.path.exists(source):
+        print(f"Noise file not found, store not built: {NOISE_STORE}")
+        return
+
+    paths = store_paths(data_dir)
+    if all(os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source) for path in paths):
+        print(f"Noise store already built: {NOISE_STORE}")
+        return
+
+    NoiseIndex.from_file(source).save(data_dir)
+    print(f"Built noise store: {NOISE_STORE}")
+
+
+_noise_index = None
+
+
+def set_noise_index(noise_index):
+    """Replaces the NoiseIndex used to score paths, e.g. with a reloaded one (see layers.py)."""
+
+    global _noise_index
+    _noise_index = noise_index
+
+
+def get_noise_index():
+    """Returns the NoiseIndex of the data directory, loaded on first use."""
+
+    global _noise_index
+    if _noise_index is None:
+        from .preprocessing import get_data_dir
+
+        data_dir = get_data_dir()
+        ensure_noise_store(data_dir)
+        _noise_index = NoiseIndex.load(data_dir)
+    return _noise_index
+
+
+def add_noise_to_edges(G, noise_index):
+    """
+    Stores length-weighted noise exposure as numeric edge attributes.
+
+    All edge geometries are intersected with the hexagons in one batch.
+    Two attributes are written per edge:
+
+    - ``noise``: length-weighted noise level over the measured part of the
+      edge, NaN if no part of it is measured
+    - ``noise_coverage``: measured share of the edge length
+
+    Args:
+        G (nx.MultiDiGraph | nx.DiGraph): Graph whose edges are annotated in place.
+        noise_index (NoiseIndex): Noise measurements.
+
+    Returns:
+        The annotated graph.
+    """
+
+    edges = [data for *_, data in G.edges(data=True)]
+    if not edges:
+        return G
+
+    lines = noise_index.lines([edge_coordinates(G, u, v, data) for u, v, data in G.edges(data=True)])
+    noise, coverage = edge_noise(noise_index, lines)
+
+    for data, edge_noise_level, edge_coverage in zip(edges, noise, coverage):
+        data['noise'] = float(edge_noise_level)
+        data['noise_coverage'] = float(edge_coverage)
+
+    return G
+
+
+def edge_noise(noise_index, lines):
+    """
+    Returns the length-weighted noise level of metric edge lines and their measured share.
+
+    Returns:
+        tuple: Arrays of the noise level over the measured part of each line
+        (NaN if no part of it is measured) and of the measured share of its length.
+    """
+
+    weighted_sum, covered, total = noise_index.exposure(lines)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        noise = np.where(covered > 0, weighted_sum / covered, np.nan)
+        coverage = np.where(total > 0, np.minimum(covered / total, 1.0), 0.0)
+    return noise, coverage
+
+
+def changed_polygons(old_index, new_index):
+    """Returns the polygons that are in only one of two NoiseIndexes, or whose noise level differs between them."""
+
+    old_keys = list(zip(shapely.to_wkb(old_index.polygons), old_index.values))
+    new_keys = list(zip(shapely.to_wkb(new_index.polygons), new_index.values))
+    old_set, new_set = set(old_keys), set(new_keys)
+
+    removed = np.array([key not in new_set for key in old_keys], dtype=bool)
+    added = np.array([key not in old_set for key in new_keys], dtype=bool)
+    return np.concatenate((old_index.polygons[removed], new_index.polygons[added]))
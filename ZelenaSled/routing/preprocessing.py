@@ -0,0 +1,291 @@
+import os
+
+import networkx as nx
+import numpy as np
+
+from django.conf import settings
+
+from .csr_graph import COST_COLUMNS, CSRGraph
+from .exposure import add_h3_exposure
+from .h3_store import H3_LAYERS, H3LayerStore, ensure_h3_store, ensure_h3_stores, load_h3_stores
+from .landmarks import Landmarks, add_landmarks, get_alt_settings
+from .metrics import stage
+from .multi_criteria import add_criteria_columns, criteria_columns
+from .noise import NOISE_FILE, NoiseIndex, add_noise_to_edges, edge_noise, ensure_noise_store
+from .time_slices import SLICED_COLUMNS, SLICED_LANDMARKS, TimeSlices, slice_files
+
+
+GRAPH_FILES = {
+    'walk': 'ljubljana_walk.graphml',
+    'bike': 'ljubljana_bike.graphml',
+}
+
+# Source file of every data layer in the data directory, {layer: file name}
+LAYER_FILES = {
+    'noise': NOISE_FILE,
+    **{layer: f'{name}.zip' for layer, name in H3_LAYERS.items()},
+}
+
+# Weights of length and noise in the 'combined' edge weight
+COMBINED_ALPHA = 0.6
+COMBINED_BETA = 0.4
+
+# Noise level of unmeasured edges when no edge is measured at all
+DEFAULT_NOISE = 80
+
+
+def get_data_dir():
+    return getattr(settings, 'ROUTING_DATA_DIR', None) or os.path.join(settings.BASE_DIR, 'routing', 'data')
+
+
+def ensure_data_stores(data_dir):
+    """Builds the binary stores of the H3 layers and the noise hexagons that are missing or older than their files."""
+
+    ensure_h3_stores(data_dir)
+    ensure_noise_store(data_dir)
+
+
+def convert_to_digraph(G_multi):
+    '''Convert MultiGraph to DiGraph as the server is inizialized'''
+
+    G_walk = nx.DiGraph()
+    G_walk.graph["crs"] = "EPSG:4326"
+    for u, v, data in G_multi.edges(data=True):
+        w = data.get('length', 1)
+        if G_walk.has_edge(u, v):
+            if G_walk[u][v]['length'] > w:
+                # Replace the existing edge data, so no geometry of the longer edge is left behind
+                G_walk[u][v].clear()
+                G_walk[u][v].update(data)
+        else:
+            # Add the edge with the new data
+            G_walk.add_edge(u, v, **data)
+
+    # Also copy node data from the MultiDiGraph to the DiGraph
+    for node, data in G_multi.nodes(data=True):
+        G_walk.add_node(node, **data)
+    
+    return G_walk
+
+#46.060936 14.528119
+#46.052540 14.532967
+def convert_to_digraph_by_combined_weight(G_multi, alpha=0.5, beta=0.5):
+    G_simple = nx.DiGraph()
+    G_simple.graph["crs"] = "EPSG:4326"
+
+    # Copy all nodes with their attributes
+    for node, attrs in G_multi.nodes(data=True):
+        G_simple.add_node(node, **attrs)
+
+    # Process edges, keeping only the best one (lowest combined weight)
+    for u, v, data in G_multi.edges(data=True):
+        length = data.get("length", 0)
+        noise = data.get("noise", 0)
+        combined = alpha * length + beta * noise
+
+        edge_attrs = data.copy()
+        edge_attrs["combined"] = combined
+
+        if G_simple.has_edge(u, v):
+            if combined < G_simple[u][v]["combined"]:
+                G_simple[u][v].update(edge_attrs)
+        else:
+            G_simple.add_edge(u, v, **edge_attrs)
+
+    return G_simple
+
+def assign_average_noise(G):
+    # Collect all valid noise values that exist in the graph (excluding 'nan' values)
+    noise_values = [d['noise'] for u, v, d in G.edges(data=True) if 'noise' in d]
+
+    # Remove 'nan' values from the list (if there are any)
+    valid_noise_values = [noise for noise in noise_values if not np.isnan(noise)]
+
+    # Check if we have any valid noise values
+    if valid_noise_values:
+        average_noise = np.mean(valid_noise_values)
+    else:
+        average_noise = DEFAULT_NOISE  # Set default noise value if no valid data found
+
+    for u, v, d in G.edges(data=True):
+        if 'noise' not in d or np.isnan(d['noise']):
+            d['noise'] = average_noise
+
+    return G
+
+
+def noise_columns(G, noise_index, edge_ids=None, lines=None):
+    """
+    Returns the 'noise', 'noise_coverage' and 'combined' columns of a CSRGraph for noise measurements.
+
+    Only ``edge_ids`` are intersected with the measurements, the other edges
+    keep their measured noise. Unmeasured edges get the average of the
+    measured ones, like ``assign_average_noise``, and 'combined' is updated
+    where the noise changed.
+
+    Args:
+        G (CSRGraph): Graph with edge geometries and the current columns.
+        noise_index (NoiseIndex): Noise measurements.
+        edge_ids (np.ndarray): Edges to intersect, all edges by default.
+        lines (np.ndarray): Metric lines of all edges, projected here if not given.
+
+    Returns:
+        dict: {column: float32 array}.
+    """
+
+    if lines is None:
+        lines = noise_index.lines(G.edge_geometries())
+    if edge_ids is None:
+        edge_ids = np.arange(G.n_edges)
+
+    noise = np.array(G.weights['noise'], dtype=np.float32)
+    coverage = np.array(G.weights['noise_coverage'], dtype=np.float32)
+    if len(edge_ids):
+        noise[edge_ids], coverage[edge_ids] = edge_noise(noise_index, lines[edge_ids])
+
+    measured = coverage > 0
+    noise[~measured] = noise[measured].mean(dtype=np.float64) if measured.any() else DEFAULT_NOISE
+
+    changed = noise != G.weights['noise']
+    combined = np.array(G.weights['combined'], dtype=np.float32)
+    combined[changed] = COMBINED_ALPHA * G.weights['length'][changed].astype(np.float64) + COMBINED_BETA * noise[changed]
+    return {'noise': noise, 'noise_coverage': coverage, 'combined': combined}
+
+
+def load_time_slices(data_dir):
+    """Returns {layer: [(hour, H3LayerStore or NoiseIndex), ...]} of the time slice files in a data directory."""
+
+    slices = {}
+    for layer, files in slice_files(data_dir, LAYER_FILES).items():
+        for hour, name in files:
+            if layer == 'noise':
+                data = NoiseIndex.from_file(os.path.join(data_dir, name))
+            else:
+                store_name = os.path.splitext(name)[0]
+                ensure_h3_store(data_dir, store_name)
+                data = H3LayerStore.load(data_dir, store_name)
+            slices.setdefault(layer, []).append((hour, data))
+    return slices
+
+
+def add_time_slices(G, slices):
+    """
+    Adds the time-of-day columns of layers with time slices to a CSRGraph.
+
+    The columns of every slice (see ``SLICED_COLUMNS``) are computed like
+    those of the static layer and stored in an edge x slice matrix of
+    ``G.time_slices``, so requests pick an hour without rebuilding the graph.
+
+    Args:
+        G (CSRGraph): Prepared graph with edge geometries and an H3 index.
+        slices (dict): {layer: [(hour, H3LayerStore or NoiseIndex), ...]} sorted by hour.
+
+    Returns:
+        CSRGraph: The graph.
+    """
+
+    lines = None
+    for layer, items in slices.items():
+        columns = {column: np.empty((G.n_edges, len(items)), dtype=np.float32) for column in SLICED_COLUMNS[layer]}
+        for i, (_, data) in enumerate(items):
+            if layer == 'noise':
+                if lines is None:
+                    lines = data.lines(G.edge_geometries())
+                values = noise_columns(G, data, lines=lines)
+            else:
+                values = dict(zip((f'{layer}_sum', f'{layer}_len'), G.h3_index.exposure(data, G.n_edges)))
+            values.update(criteria_columns({**G.weights, **values}))
+            for column, matrix in columns.items():
+                matrix[:, i] = values[column]
+
+        # The lowest cost of every edge over the slices keeps the landmark bounds valid at any hour
+        landmarks = {
+            column: Landmarks.select(
+                G.replace(weights={column: columns[column].min(axis=1)}), column, get_alt_settings()['LANDMARKS'],
+            )
+            for column in SLICED_LANDMARKS.get(layer, ())
+        }
+        G.time_slices[layer] = TimeSlices(np.array([hour for hour, _ in items]), columns, landmarks)
+    return G
+
+
+def prepare_graph(commute_mode, noise_index=None, h3_stores=None, time_slices=None):
+    """
+    Loads a GraphML graph and prepares it for routing, see ``process_graph``.
+
+    Args:
+        commute_mode (str): 'walk' or 'bike'.
+        noise_index (NoiseIndex): Noise measurements, loaded from the data directory if not given.
+        h3_stores (dict): {layer: H3LayerStore}, loaded from the data directory if not given.
+        time_slices (dict): {layer: [(hour, H3LayerStore or NoiseIndex), ...]},
+            loaded from the data directory if not given.
+
+    Returns:
+        CSRGraph: The prepared graph.
+    """
+
+    # osmnx takes about a second to import and is only needed here, so it isn't imported with the views
+    import osmnx as ox
+
+    data_dir = get_data_dir()
+    ensure_data_stores(data_dir)
+    if noise_index is None:
+        noise_index = NoiseIndex.load(data_dir)
+    if h3_stores is None:
+        h3_stores = load_h3_stores(data_dir)
+    if time_slices is None:
+        time_slices = load_time_slices(data_dir)
+
+    G = ox.load_graphml(os.path.join(data_dir, GRAPH_FILES[commute_mode]))
+    return process_graph(G, noise_index, h3_stores, time_slices)
+
+
+def process_graph(G, noise_index, h3_stores, time_slices=None):
+    """
+    Prepares a street graph for routing.
+
+    Adds length-weighted noise and its coverage and the combined weight, keeps
+    the best edge between two nodes, converts the result to a CSRGraph and
+    adds length-weighted NDVI and heat exposure to its edges, the normalized
+    cost columns of multi-criteria searches, the landmarks of A* searches and
+    the time-of-day columns of layers with time slices. Each step is timed as
+    a stage (see metrics.py).
+
+    Args:
+        G (nx.MultiDiGraph): Street graph with 'length' and optional 'geometry' edge attributes.
+        noise_index (NoiseIndex): Noise measurements.
+        h3_stores (dict): {layer: H3LayerStore}.
+        time_slices (dict): {layer: [(hour, H3LayerStore or NoiseIndex), ...]}, see ``load_time_slices``.
+
+    Returns:
+        CSRGraph: The prepared graph.
+    """
+
+    with stage('noise_edges'):
+        G = add_noise_to_edges(G, noise_index)
+    with stage('average_noise'):
+        G = assign_average_noise(G)
+    with stage('combined_digraph'):
+        G = convert_to_digraph_by_combined_weight(G, alpha=COMBINED_ALPHA, beta=COMBINED_BETA)
+
+    #keep only compact array-backed graphs for routing
+    with stage('csr_graph'):
+        G = CSRGraph.from_digraph(G)
+
+    #add length-weighted NDVI and heat exposure to edges, so paths are scored without per-request H3 lookups
+    with stage('h3_exposure'):
+        G = add_h3_exposure(G, h3_stores)
+
+    #normalized cost columns of weighted searches
+    with stage('criteria_columns'):
+        G = add_criteria_columns(G)
+
+    #landmark distance tables for A* searches on the search cost columns
+    with stage('landmarks'):
+        G = add_landmarks(G, COST_COLUMNS)
+
+    #edge x slice matrices of the time-of-day layers, picked per request by departure time
+    if time_slices:
+        with stage('time_slices'):
+            G = add_time_slices(G, time_slices)
+    return G
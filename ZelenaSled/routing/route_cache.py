@@ -0,0 +1,283 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .async_executor import check_deadline, time_left
+from .preprocessing import LAYER_FILES
+
+
+DEFAULTS = {
+    'MAX_ENTRIES': 1024,
+    'TTL': 3600,
+    # Alias of a Django cache shared by all workers, None for in-process caching only
+    'BACKEND': None,
+    # How long a worker waits for another worker computing the same route
+    'LOCK_TIMEOUT': 30,
+}
+
+
+# Data layers the routes of each routing mode depend on, for the cache keys
+ROUTING_MODE_LAYERS = {
+    None: (),
+    'noise': ('noise',),
+    'vegetation': ('ndvi',),
+    'heat': ('heat',),
+}
+
+ALL_LAYERS = tuple(LAYER_FILES)
+
+# Version of the cached path data, changed with what it holds so a shared
+# cache never serves paths of an older layout (2: edge geometries)
+PATH_DATA_VERSION = 2
+
+
+class _Computation:
+    """A value computed by one thread while others wait for it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.finished = False
+        self.value = None
+
+
+class RouteCache:
+    """
+    LRU/TTL cache of computed routes with request coalescing.
+
+    Entries are kept in-process and, if a shared Django cache backend is
+    configured, also there so all workers benefit. Concurrent requests for
+    the same key wait for a single computation instead of each running it:
+    threads of one process wait on an event, other workers poll the shared
+    backend while the first one holds a lock entry.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, backend=None, lock_timeout=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = caches[backend] if backend else None
+        self.lock_timeout = lock_timeout
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'coalesced': 0, 'invalidated': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+        if self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self._set_local(key, value)
+                return value
+
+        return None
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def set(self, key, value):
+        self._set_local(key, value)
+        if self.backend is not None:
+            self.backend.set(key, value, timeout=self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+    def invalidate(self, match):
+        """
+        Removes the in-process entries whose key matches.
+
+        Entries in the shared backend are not removed, keys of routes on
+        changed data layers change (see ``route_cache_key``), so they are
+        never read again and expire with their TTL.
+
+        Args:
+            match (callable): Returns True for the keys to remove.
+
+        Returns:
+            int: Number of removed entries.
+        """
+
+        with self._lock:
+            keys = [key for key in self._entries if match(key)]
+            for key in keys:
+                del self._entries[key]
+            self.stats['invalidated'] += len(keys)
+        return len(keys)
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value of a key, computing it at most once.
+
+        Waiting for a computation of another thread or worker ends at the
+        deadline of the executor job asking (see ``check_deadline``), which
+        then raises DeadlineExceeded.
+
+        Args:
+            key (str): Cache key.
+            compute (callable): Computes the value. None results are not cached,
+                but returned to the threads waiting for the same computation.
+
+        Returns:
+            The cached or computed value.
+        """
+
+        value = self.get(key)
+        if value is not None:
+            self._count('hits')
+            return value
+
+        with self._lock:
+            computation = self._in_flight.get(key)
+            owner = computation is None
+            if owner:
+                computation = self._in_flight[key] = _Computation()
+
+        if not owner:
+            # Another thread of this worker computes the same route, waited for until the request's deadline
+            computation.done.wait(time_left(self.lock_timeout))
+            check_deadline()
+            if computation.finished:
+                # Its result is used even when it is None (no route), which is not cached
+                self._count('coalesced')
+                return computation.value
+            value = self.get(key)
+            if value is not None:
+                self._count('coalesced')
+                return value
+            return self._compute(key, compute)
+
+        try:
+            computation.value = self._compute(key, compute)
+            computation.finished = True
+            return computation.value
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            computation.done.set()
+
+    def _compute(self, key, compute):
+        locked = False
+        try:
+            if self.backend is not None:
+                # Take the shared lock entry, or wait for the worker holding it to store the route
+                locked = self.backend.add(f'{key}:lock', 1, timeout=self.lock_timeout)
+                value = None if locked else self._wait_for_other_worker(key)
+                if value is not None:
+                    self._count('coalesced')
+                    return value
+
+            self._count('misses')
+            value = compute()
+            if value is not None:
+                self.set(key, value)
+            return value
+        finally:
+            # Only the worker that took the lock removes it, never the one of another worker
+            if locked:
+                self.backend.delete(f'{key}:lock')
+
+    def _wait_for_other_worker(self, key):
+        deadline = time.monotonic() + time_left(self.lock_timeout)
+        while time.monotonic() < deadline:
+            time.sleep(min(0.05, max(deadline - time.monotonic(), 0)))
+            check_deadline()
+            value = self.get(key)
+            if value is not None:
+                return value
+            if self.backend.get(f'{key}:lock') is None:
+                break
+        return None
+
+    def info(self):
+        with self._lock:
+            return {**self.stats, 'entries': len(self._entries), 'max_entries': self.max_entries}
+
+
+_route_cache = None
+
+
+def get_route_cache():
+    """Returns the RouteCache configured by ``settings.ROUTING_CACHE``."""
+
+    global _route_cache
+    if _route_cache is None:
+        config = {**DEFAULTS, **getattr(settings, 'ROUTING_CACHE', {})}
+        _route_cache = RouteCache(
+            max_entries=config['MAX_ENTRIES'],
+            ttl=config['TTL'],
+            backend=config['BACKEND'],
+            lock_timeout=config['LOCK_TIMEOUT'],
+        )
+    return _route_cache
+
+
+def routing_mode_layers(routing_mode):
+    """Returns the data layers the routes of a routing mode depend on, weighted searches depend on all of them."""
+
+    if routing_mode in ROUTING_MODE_LAYERS:
+        return ROUTING_MODE_LAYERS[routing_mode]
+    return ALL_LAYERS
+
+
+def layer_token(layer, version):
+    """Returns the part of a cache key identifying a version of a data layer."""
+
+    return f'{layer}={version}'
+
+
+def route_cache_key(G, commute_mode, routing_mode, engine, origin, destination):
+    """
+    Returns the cache key of a route.
+
+    ``origin`` and ``destination`` identify the snapped points: node indices,
+    or EdgeSnaps when snapping onto edges. The key holds the versions of the
+    data layers the routing mode depends on, so reloading a layer (see
+    layers.py) changes the keys of the routes it affects only.
+    """
+
+    def point_key(point):
+        if hasattr(point, 'edge_id'):
+            return f'{point.edge_id}@{point.fraction:.3f}'
+        return str(point)
+
+    layers = ','.join(
+        layer_token(layer, G.layer_versions.get(layer)) for layer in routing_mode_layers(routing_mode)
+    )
+    return ':'.join((
+        f'route{PATH_DATA_VERSION}', str(G.version), str(commute_mode), str(routing_mode), str(engine), layers or '-',
+        point_key(origin), point_key(destination),
+    ))
+
+
+def set_request_coords(path_data, origin_coords, destination_coords):
+    """Returns copies of cached paths with the requested origin and destination in their properties."""
+
+    return [
+        {**path, 'origin_coords': list(origin_coords), 'destination_coords': list(destination_coords)}
+        for path in path_data
+    ]
@@ -0,0 +1,214 @@
+import json
+import math
+
+import numpy as np
+import shapely
+
+from django.conf import settings
+
+
+DEFAULTS = {
+    # Decimals of the coordinates, 6 is about 0.1 m
+    'PRECISION': 6,
+    # 'geojson' for LineString geometries, 'polyline' for encoded polylines
+    'FORMAT': 'geojson',
+    # Douglas-Peucker tolerance in meters the geometries are simplified with, None to keep every point
+    'SIMPLIFY': None,
+}
+
+FORMATS = ('geojson', 'polyline')
+
+# Coordinates can't be more precise than float64 allows
+MAX_PRECISION = 10
+
+# Zoom levels a simplification can be asked for and the tile size in pixels, as in web maps
+MAX_ZOOM = 22
+TILE_SIZE = 256
+
+# Meters per degree of latitude, and of longitude at the equator
+METERS_PER_DEGREE = 111320.0
+
+# No spaces between JSON tokens; keys keep the order they were written in,
+# so responses of the same route are byte-identical and compress well
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, allow_nan=False)
+
+
+def get_serialize_settings():
+    return {**DEFAULTS, **getattr(settings, 'ROUTING_GEOJSON', {})}
+
+
+def parse_output_options(precision=None, geometry_format=None):
+    """
+    Validates the output options of a route request.
+
+    Returns:
+        tuple: (precision, geometry format), defaults from ``ROUTING_GEOJSON``.
+
+    Raises:
+        ValueError: If an option is not valid.
+    """
+
+    config = get_serialize_settings()
+    if precision is None:
+        precision = config['PRECISION']
+    if geometry_format is None:
+        geometry_format = config['FORMAT']
+
+    if isinstance(precision, bool) or not isinstance(precision, int) or not 0 <= precision <= MAX_PRECISION:
+        raise ValueError(f"Precision must be an integer between 0 and {MAX_PRECISION}")
+    if geometry_format not in FORMATS:
+        raise ValueError(f"Unknown format: {geometry_format} (use {', '.join(FORMATS)})")
+    return precision, geometry_format
+
+
+def parse_simplify_options(simplify=None, zoom=None, lat=0.0):
+    """
+    Validates the simplification options of a route request.
+
+    Args:
+        simplify (float): Tolerance in meters, ``ROUTING_GEOJSON['SIMPLIFY']`` by default.
+        zoom (int): Web map zoom level the route is drawn at, instead of a
+            tolerance. Points less than a pixel off the simplified line are dropped.
+        lat (float): Latitude of the route, for the pixel size of a zoom.
+
+    Returns:
+        float: Tolerance in meters, None for no simplification.
+
+    Raises:
+        ValueError: If an option is not valid.
+    """
+
+    if simplify is not None and zoom is not None:
+        raise ValueError("Give either a simplification tolerance or a zoom level, not both")
+
+    if zoom is not None:
+        if isinstance(zoom, bool) or not isinstance(zoom, int) or not 0 <= zoom <= MAX_ZOOM:
+            raise ValueError(f"Zoom must be an integer between 0 and {MAX_ZOOM}")
+        return 360 * METERS_PER_DEGREE * math.cos(math.radians(lat)) / (TILE_SIZE * 2 ** zoom)
+
+    if simplify is None:
+        simplify = get_serialize_settings()['SIMPLIFY']
+    if simplify is not None and (isinstance(simplify, bool) or not isinstance(simplify, (int, float))
+                                 or not 0 <= simplify < math.inf):
+        raise ValueError("Simplification tolerance must be a number of meters, 0 or more")
+    return simplify or None
+
+
+def simplify_coords(coords, tolerance_m):
+    """
+    Simplifies a line of (lon, lat) coordinates with the Douglas-Peucker algorithm.
+
+    The line is scaled to meters around its mean latitude, so the tolerance
+    is the same distance in every direction. The first and last points are
+    always kept.
+
+    Args:
+        coords (np.ndarray): (n, 2) array of (lon, lat) coordinates.
+        tolerance_m (float): Largest distance in meters of a dropped point from the simplified line.
+
+    Returns:
+        np.ndarray: The kept coordinates.
+    """
+
+    coords = np.asarray(coords, dtype=np.float64)
+    if not tolerance_m or len(coords) < 3:
+        return coords
+
+    scale = np.array([math.cos(math.radians(coords[:, 1].mean())), 1.0]) * METERS_PER_DEGREE
+    line = shapely.simplify(shapely.linestrings(coords * scale), tolerance_m, preserve_topology=False)
+    simplified = shapely.get_coordinates(line) / scale
+    return simplified if len(simplified) >= 2 else coords[[0, -1]]
+
+
+def encode_polyline(coords, precision=5):
+    """
+    Encodes (lon, lat) coordinates with the encoded polyline algorithm.
+
+    Points are written in (lat, lon) order as the algorithm expects, so the
+    string decodes with the usual polyline libraries at the same precision.
+
+    Args:
+        coords (np.ndarray): (n, 2) array of (lon, lat) coordinates.
+        precision (int): Decimals kept, 5 for Google's format, 6 for OSRM's.
+
+    Returns:
+        str: The encoded polyline.
+    """
+
+    coords = np.asarray(coords, dtype=np.float64)
+    if not len(coords):
+        return ''
+
+    scaled = np.round(coords[:, ::-1] * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    # Zigzag: the sign goes into the lowest bit
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1).tolist()
+
+    chars = []
+    for value in values:
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+    return ''.join(chars)
+
+
+def feature(index, path, precision, geometry_format, tolerance_m=None):
+    """
+    Returns one path as a GeoJSON Feature dict.
+
+    Args:
+        index (int): Position of the path, used as the feature id.
+        path (dict): Path properties and its (lon, lat) 'coordinates' array.
+        precision (int): Decimals of the coordinates.
+        geometry_format (str): 'geojson' or 'polyline'.
+        tolerance_m (float): Douglas-Peucker tolerance in meters, None to keep every point.
+
+    Returns:
+        dict: The feature. With 'polyline' its geometry is null and the
+        properties carry the encoded 'polyline' and its 'polyline_precision'.
+    """
+
+    # NaN and infinite values aren't valid JSON, they are written as null like GeoPandas did
+    properties = {
+        key: None if isinstance(value, float) and not math.isfinite(value) else value
+        for key, value in path.items() if key != 'coordinates'
+    }
+    coords = simplify_coords(path['coordinates'], tolerance_m)
+
+    if geometry_format == 'polyline':
+        properties['polyline'] = encode_polyline(coords, precision)
+        properties['polyline_precision'] = precision
+        geometry = None
+    else:
+        geometry = {'type': 'LineString', 'coordinates': np.round(coords, precision).tolist()}
+
+    return {'id': str(index), 'type': 'Feature', 'properties': properties, 'geometry': geometry}
+
+
+def feature_collection(paths, precision=None, geometry_format=None, tolerance_m=None):
+    """
+    Returns paths as a GeoJSON FeatureCollection dict.
+
+    Args:
+        paths (list): Dicts of path properties with their (lon, lat) 'coordinates' arrays.
+        precision (int): Decimals of the coordinates, ``ROUTING_GEOJSON['PRECISION']`` by default.
+        geometry_format (str): 'geojson' or 'polyline', ``ROUTING_GEOJSON['FORMAT']`` by default.
+        tolerance_m (float): Douglas-Peucker tolerance in meters (see ``parse_simplify_options``),
+            None to keep every point.
+
+    Returns:
+        dict: The FeatureCollection.
+    """
+
+    precision, geometry_format = parse_output_options(precision, geometry_format)
+    return {
+        'type': 'FeatureCollection',
+        'features': [feature(i, path, precision, geometry_format, tolerance_m) for i, path in enumerate(paths)],
+    }
+
+
+def to_json(data):
+    """Returns a FeatureCollection (or any JSON data) as a compact string."""
+
+    return _encoder.encode(data)
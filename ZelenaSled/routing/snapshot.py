@@ -0,0 +1,290 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+import numpy as np
+
+from django.conf import settings
+
+from .csr_graph import CSRGraph
+from .exposure import H3EdgeIndex
+from .landmarks import Landmarks
+from .time_slices import TimeSlices, slice_files
+from . import preprocessing
+
+
+# Bump when the preprocessing or the snapshot layout changes, so old snapshots are rebuilt
+SNAPSHOT_VERSION = 7
+
+ARRAYS = (
+    'node_ids', 'x', 'y', 'indptr', 'indices', 'rev_indptr', 'rev_indices', 'rev_edges', 'edge_offsets', 'edge_coords',
+)
+
+# Dicts of arrays stored per column, {attribute: file prefix}
+COLUMN_ARRAYS = {'weights': 'w', 'costs': 'c', 'reverse_costs': 'rc'}
+
+
+def get_snapshot_dir():
+    """
+    Returns the directory of the graph snapshots.
+
+    ``settings.ROUTING_SNAPSHOT_DIR`` can point it to shared memory, e.g. a
+    directory in /dev/shm.
+    """
+
+    return getattr(settings, 'ROUTING_SNAPSHOT_DIR', None) or os.path.join(preprocessing.get_data_dir(), 'snapshots')
+
+
+def source_files(commute_mode):
+    """Returns the data files a prepared graph is built from."""
+
+    slices = slice_files(preprocessing.get_data_dir(), preprocessing.LAYER_FILES)
+    return [
+        preprocessing.GRAPH_FILES[commute_mode],
+        *preprocessing.LAYER_FILES.values(),
+        *(name for files in slices.values() for _, name in files),
+    ]
+
+
+def file_checksum(path, known=None):
+    """
+    Returns the sha256 of a file.
+
+    Hashing large files takes a while, so ``known`` can hold checksums from a
+    previous run, which are reused when the size and mtime haven't changed.
+    """
+
+    stat = os.stat(path)
+    if known and known.get('size') == stat.st_size and known.get('mtime') == stat.st_mtime:
+        return known
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return {'sha256': sha256.hexdigest(), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def source_checksums(commute_mode):
+    """Returns {file name: checksum} of the source files of a graph, see ``file_checksum``."""
+
+    data_dir = preprocessing.get_data_dir()
+    cache_path = os.path.join(get_snapshot_dir(), 'checksums.json')
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    checksums = {
+        name: file_checksum(os.path.join(data_dir, name), cache.get(name))
+        for name in source_files(commute_mode)
+    }
+
+    if any(cache.get(name) != checksum for name, checksum in checksums.items()):
+        cache.update(checksums)
+        os.makedirs(get_snapshot_dir(), exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    return checksums
+
+
+def layer_version(checksum):
+    """Returns the version of a data layer, a short prefix of its source file's sha256."""
+
+    return checksum['sha256'][:16]
+
+
+def source_digest(commute_mode, checksums=None):
+    """
+    Returns a digest identifying the snapshot of a graph.
+
+    It changes whenever a source file, the snapshot version or the
+    preprocessing parameters change.
+    """
+
+    if checksums is None:
+        checksums = source_checksums(commute_mode)
+
+    key = {
+        'version': SNAPSHOT_VERSION,
+        'commute_mode': commute_mode,
+        'alpha': preprocessing.COMBINED_ALPHA,
+        'beta': preprocessing.COMBINED_BETA,
+        'sources': {name: checksum['sha256'] for name, checksum in checksums.items()},
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def snapshot_path(commute_mode, digest):
+    return os.path.join(get_snapshot_dir(), f'{commute_mode}-{digest}')
+
+
+def save_snapshot(G, path):
+    """
+    Writes a CSRGraph as a directory of .npy files and a manifest.
+
+    The directory is written under a temporary name and renamed at the end,
+    so a half-written snapshot is never loaded.
+    """
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+
+    G.prepare_search_arrays()
+    for name in ARRAYS:
+        np.save(os.path.join(tmp_path, f'{name}.npy'), getattr(G, name))
+    for attribute, prefix in COLUMN_ARRAYS.items():
+        for column, values in getattr(G, attribute).items():
+            np.save(os.path.join(tmp_path, f'{prefix}_{column}.npy'), values)
+    for weight, landmarks in G.landmarks.items():
+        landmarks.save(tmp_path, weight)
+    if G.h3_index is not None:
+        G.h3_index.save(tmp_path)
+    for layer, time_slices in G.time_slices.items():
+        time_slices.save(tmp_path, layer)
+
+    manifest = {
+        'version': SNAPSHOT_VERSION,
+        'crs': G.crs,
+        'columns': {attribute: list(getattr(G, attribute)) for attribute in COLUMN_ARRAYS},
+        'landmarks': list(G.landmarks),
+        'h3_index': G.h3_index is not None,
+        'layers': G.layer_versions,
+        'time_slices': {
+            layer: {'columns': list(time_slices.columns), 'landmarks': list(time_slices.landmarks)}
+            for layer, time_slices in G.time_slices.items()
+        },
+    }
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process already wrote the same snapshot
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_snapshot(path, mmap_mode=None):
+    """
+    Reads a CSRGraph written by ``save_snapshot``.
+
+    With ``mmap_mode='r'`` the arrays are memory-mapped read-only instead of
+    read into memory: all workers attach to the same pages of the page cache
+    (or of /dev/shm), so each one only adds a small constant to its memory.
+    """
+
+    with open(os.path.join(path, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+
+    arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in ARRAYS}
+    for attribute, prefix in COLUMN_ARRAYS.items():
+        arrays[attribute] = {
+            column: np.load(os.path.join(path, f'{prefix}_{column}.npy'), mmap_mode=mmap_mode)
+            for column in manifest['columns'][attribute]
+        }
+    arrays['landmarks'] = {
+        weight: Landmarks.load(path, weight, mmap_mode=mmap_mode) for weight in manifest.get('landmarks', [])
+    }
+    if manifest.get('h3_index'):
+        arrays['h3_index'] = H3EdgeIndex.load(path, mmap_mode=mmap_mode)
+    arrays['time_slices'] = {
+        layer: TimeSlices.load(path, layer, entry['columns'], entry['landmarks'], mmap_mode=mmap_mode)
+        for layer, entry in manifest.get('time_slices', {}).items()
+    }
+    return CSRGraph(
+        crs=manifest['crs'], version=os.path.basename(path), layer_versions=manifest.get('layers', {}), **arrays,
+    )
+
+
+def remove_old_snapshots(commute_mode, keep):
+    for name in os.listdir(get_snapshot_dir()):
+        path = os.path.join(get_snapshot_dir(), name)
+        if name.startswith(f'{commute_mode}-') and path != keep and not name.endswith('.tmp'):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def build_snapshot(commute_mode, force=False):
+    """
+    Prepares a graph and writes its snapshot, unless an up to date one exists.
+
+    Returns:
+        str: Path of the snapshot.
+    """
+
+    checksums = source_checksums(commute_mode)
+    path = snapshot_path(commute_mode, source_digest(commute_mode, checksums))
+    if os.path.exists(path) and not force:
+        return path
+
+    if force:
+        shutil.rmtree(path, ignore_errors=True)
+
+    G = preprocessing.prepare_graph(commute_mode)
+    G.layer_versions = {
+        layer: layer_version(checksums[name]) for layer, name in preprocessing.LAYER_FILES.items()
+    }
+    save_snapshot(G, path)
+    remove_old_snapshots(commute_mode, keep=path)
+    return path
+
+
+def snapshot_is_current(commute_mode):
+    """Returns True if the snapshot of a commute mode matches its source files."""
+
+    return os.path.exists(snapshot_path(commute_mode, source_digest(commute_mode)))
+
+
+def build_snapshots(commute_modes, workers=1, force=False):
+    """
+    Builds the snapshots of several commute modes, in parallel processes.
+
+    Preparing a graph is mostly Python and holds the GIL, so every commute
+    mode is built in its own process. The processes are spawned rather than
+    forked, as the caller may run other threads (e.g. a server warming up).
+
+    Args:
+        commute_modes (list): Commute modes to build.
+        workers (int): Most processes at once (at most one per CPU), 1 to build one after the other in this process.
+        force (bool): Rebuild snapshots even if they are up to date.
+
+    Returns:
+        dict: {commute mode: path of the snapshot}.
+    """
+
+    commute_modes = list(commute_modes)
+    workers = min(workers, len(commute_modes), os.cpu_count() or 1)
+    if workers <= 1:
+        return {commute_mode: build_snapshot(commute_mode, force) for commute_mode in commute_modes}
+
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+        initializer=django.setup,
+    ) as pool:
+        futures = {commute_mode: pool.submit(build_snapshot, commute_mode, force) for commute_mode in commute_modes}
+        return {commute_mode: future.result() for commute_mode, future in futures.items()}
+
+
+def load_graph(commute_mode):
+    """
+    Returns the prepared graph of a commute mode.
+
+    Loads the snapshot matching the current source files, and builds it first
+    if the source files changed since the last one.
+    """
+
+    path = build_snapshot(commute_mode)
+    shared = getattr(settings, 'ROUTING_SHARED_GRAPHS', False)
+    print(f"Loading graph snapshot{' (shared)' if shared else ''}: {path}")
+    G = load_snapshot(path, mmap_mode='r' if shared else None)
+
+    # Build the spatial index now rather than on the first request
+    G.spatial_index
+    return G
@@ -0,0 +1,337 @@
+from dataclasses import dataclass
+
+import numpy as np
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+
+from .exposure import segment_lengths_m
+
+
+# Slovenia 1996 / Slovene National Grid, a metric CRS for Ljubljana
+METRIC_CRS = "EPSG:3794"
+
+# Longest piece of an edge segment in the edge tree, every point of a segment is at most half of it from a piece centre
+EDGE_PIECE_M = 50
+
+# Side of the cells of the node grid in meters
+GRID_CELL_M = 250
+
+
+@dataclass
+class EdgeSnap:
+    """A point snapped onto the edge (u, v), ``fraction`` of the length of its geometry from u to v."""
+
+    edge_id: int
+    u: int
+    v: int
+    fraction: float
+    lon: float
+    lat: float
+    distance_m: float
+
+
+class SpatialIndex:
+    """
+    KD-trees over the nodes and edges of a CSRGraph in a metric CRS.
+
+    Built once per graph, so snapping a request's origin and destination is
+    a tree query instead of rebuilding a nearest-neighbour structure.
+    """
+
+    def __init__(self, G, crs=METRIC_CRS):
+        self.G = G
+        self.to_metric = Transformer.from_crs(G.crs, crs, always_xy=True)
+        self.to_graph = Transformer.from_crs(crs, G.crs, always_xy=True)
+
+        node_x, node_y = self.to_metric.transform(G.x, G.y)
+        self.node_xy = np.column_stack((node_x, node_y))
+        self.node_tree = cKDTree(self.node_xy)
+
+        self._edge_tree = None
+        self.grid_nodes = None
+
+    def project(self, lon, lat):
+        x, y = self.to_metric.transform(np.atleast_1d(lon), np.atleast_1d(lat))
+        return np.column_stack((x, y))
+
+    def nearest_nodes(self, lon, lat):
+        """
+        Snaps many points to their nearest nodes at once.
+
+        Args:
+            lon (array_like): Longitudes.
+            lat (array_like): Latitudes.
+
+        Returns:
+            tuple: Arrays of node indices and distances in meters.
+        """
+
+        distances, nodes = self.node_tree.query(self.project(lon, lat))
+        return nodes.astype(np.int32), distances
+
+    def nearest_node(self, lon, lat):
+        nodes, _ = self.nearest_nodes(lon, lat)
+        return int(nodes[0])
+
+    def _build_grid(self, cell_m=GRID_CELL_M):
+        # Nodes sorted by cell (column-major), with the offset of every cell in the sorted order
+        self.grid_origin = self.node_xy.min(axis=0)
+        cells = ((self.node_xy - self.grid_origin) // cell_m).astype(np.int64)
+        self.grid_shape = tuple(cells.max(axis=0) + 1)
+        cell_ids = cells[:, 0] * self.grid_shape[1] + cells[:, 1]
+        grid_nodes = np.argsort(cell_ids, kind='stable').astype(np.int32)
+        self.grid_offsets = np.searchsorted(cell_ids[grid_nodes], np.arange(np.prod(self.grid_shape) + 1))
+        self.grid_cell_m = cell_m
+        # Set last, as it marks the grid as built for concurrent requests
+        self.grid_nodes = grid_nodes
+
+    def nodes_in_box(self, xmin, ymin, xmax, ymax):
+        """
+        Returns the nodes in the grid cells overlapping a box in metric coordinates.
+
+        The result can hold nodes up to one cell outside the box; callers
+        filter them by their exact shape.
+        """
+
+        if self.grid_nodes is None:
+            self._build_grid()
+
+        low = np.floor((np.array([xmin, ymin]) - self.grid_origin) / self.grid_cell_m).astype(np.int64)
+        high = np.floor((np.array([xmax, ymax]) - self.grid_origin) / self.grid_cell_m).astype(np.int64)
+        low = np.clip(low, 0, np.array(self.grid_shape) - 1)
+        high = np.clip(high, 0, np.array(self.grid_shape) - 1)
+
+        # Cells of one grid column are contiguous, so every column is a single slice
+        n_rows = self.grid_shape[1]
+        slices = [
+            self.grid_nodes[self.grid_offsets[column * n_rows + low[1]]:self.grid_offsets[column * n_rows + high[1] + 1]]
+            for column in range(low[0], high[0] + 1)
+        ]
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int32)
+
+    def _build_edge_tree(self):
+        G = self.G
+        self.edge_u = np.repeat(np.arange(G.n_nodes, dtype=np.int32), np.diff(G.indptr))
+        self.edge_v = G.indices
+
+        if G.edge_coords is None:
+            # Straight lines between the nodes of graphs without edge geometries
+            offsets = np.arange(0, 2 * G.n_edges + 1, 2)
+            coords = np.column_stack((G.x, G.y))[np.column_stack((self.edge_u, self.edge_v)).ravel()]
+        else:
+            offsets, coords = G.edge_offsets, np.asarray(G.edge_coords)
+        xy = self.project(coords[:, 0], coords[:, 1])
+
+        # Segments of the geometries: consecutive points of the same edge
+        point_edges = np.repeat(np.arange(G.n_edges), np.diff(offsets))
+        starts = np.flatnonzero(point_edges[:-1] == point_edges[1:])
+        self.segment_edge = point_edges[starts]
+        self.segment_start, self.segment_end = xy[starts], xy[starts + 1]
+
+        # Share of the edge's length before every segment and in it, measured like ``_edge_piece`` measures it
+        lengths = segment_lengths_m(coords)[starts]
+        before = np.cumsum(lengths) - lengths
+        before -= before[np.searchsorted(self.segment_edge, self.segment_edge)]
+        edge_lengths = np.maximum(np.bincount(self.segment_edge, lengths, minlength=G.n_edges), 1e-9)
+        self.segment_share_before = before / edge_lengths[self.segment_edge]
+        self.segment_share = lengths / edge_lengths[self.segment_edge]
+
+        # Long segments are split into pieces, so the tree of piece centres finds every segment near a point
+        segment = self.segment_end - self.segment_start
+        n_pieces = np.maximum(np.ceil(np.hypot(*segment.T) / EDGE_PIECE_M), 1).astype(np.int64)
+        self.piece_segment = np.repeat(np.arange(len(starts)), n_pieces)
+        position = np.arange(n_pieces.sum()) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+        share = (position + 0.5) / n_pieces[self.piece_segment]
+        self._edge_tree = cKDTree(self.segment_start[self.piece_segment] + share[:, None] * segment[self.piece_segment])
+
+    def nearest_edges(self, lon, lat):
+        """
+        Snaps many points onto their nearest edges at once.
+
+        Every point is projected onto the segments of the edge geometries
+        whose pieces lie within the distance of its nearest piece centre plus
+        half a piece, which holds every segment that could be nearer, and the
+        fraction is the share of the geometry's length before the projection.
+
+        Args:
+            lon (array_like): Longitudes.
+            lat (array_like): Latitudes.
+
+        Returns:
+            list: An EdgeSnap per point.
+        """
+
+        if self._edge_tree is None:
+            self._build_edge_tree()
+
+        points = self.project(lon, lat)
+        nearest, _ = self._edge_tree.query(points)
+        candidates = self._edge_tree.query_ball_point(points, nearest + EDGE_PIECE_M / 2 + 1e-6)
+        point_ids = np.repeat(np.arange(len(points)), [len(pieces) for pieces in candidates])
+        segments = self.piece_segment[np.concatenate(candidates).astype(np.int64)]
+
+        start, end = self.segment_start[segments], self.segment_end[segments]
+        segment = end - start
+        squared_length = np.maximum((segment ** 2).sum(axis=-1), 1e-12)
+        t = np.clip(((points[point_ids] - start) * segment).sum(axis=-1) / squared_length, 0, 1)
+        projected = start + t[:, None] * segment
+        distances = np.hypot(*(points[point_ids] - projected).T)
+
+        # Nearest segment of every point, ties go to the first edge
+        order = np.lexsort((segments, distances, point_ids))
+        best = order[np.searchsorted(point_ids[order], np.arange(len(points)))]
+        edge_ids = self.segment_edge[segments[best]]
+        fractions = self.segment_share_before[segments[best]] + t[best] * self.segment_share[segments[best]]
+        snap_lon, snap_lat = self.to_graph.transform(projected[best, 0], projected[best, 1])
+
+        return [
+            EdgeSnap(
+                edge_id=int(edge_ids[i]),
+                u=int(self.edge_u[edge_ids[i]]),
+                v=int(self.edge_v[edge_ids[i]]),
+                fraction=float(min(fractions[i], 1.0)),
+                lon=float(snap_lon[i]),
+                lat=float(snap_lat[i]),
+                distance_m=float(distances[best[i]]),
+            )
+            for i in range(len(points))
+        ]
+
+    def nearest_edge(self, lon, lat):
+        return self.nearest_edges(lon, lat)[0]
+
+
+def start_node(G, snap):
+    """Returns the node a path from a point snapped onto an edge starts at."""
+
+    if snap.fraction < 0.5 and G.edge_id(snap.v, snap.u) >= 0:
+        return snap.u
+    return snap.v
+
+
+def end_node(G, snap):
+    """Returns the node a path to a point snapped onto an edge ends at."""
+
+    if snap.fraction > 0.5 and G.edge_id(snap.v, snap.u) >= 0:
+        return snap.v
+    return snap.u
+
+
+def _remaining_length(G, snap, node):
+    # Length between the snapped point and one end of its edge
+    length = float(G.weights['length'][snap.edge_id])
+    return snap.fraction * length if node == snap.u else (1 - snap.fraction) * length
+
+
+def _same_street_fraction(orig_snap, dest_snap):
+    # Where the destination lies on the origin's edge, None if they are on different streets
+    if dest_snap.edge_id == orig_snap.edge_id:
+        return dest_snap.fraction
+    if (dest_snap.u, dest_snap.v) == (orig_snap.v, orig_snap.u):
+        return 1 - dest_snap.fraction
+    return None
+
+
+def snapped_edge_path(G, orig_snap, dest_snap):
+    """
+    Returns the path of a trip between two points snapped onto the same street.
+
+    Both points may be on the same edge or on the two directions of one
+    street; the trip is then the piece of the street between them, without
+    searching the graph.
+
+    Args:
+        G (CSRGraph): Graph the points were snapped in.
+        orig_snap (EdgeSnap): Origin snapped onto an edge.
+        dest_snap (EdgeSnap): Destination snapped onto an edge.
+
+    Returns:
+        np.ndarray: The edge's two nodes in the direction of travel, or None
+        if the points are on different streets or the street is one-way the
+        other way.
+    """
+
+    fraction = _same_street_fraction(orig_snap, dest_snap)
+    if fraction is None:
+        return None
+    if fraction >= orig_snap.fraction:
+        return np.array([orig_snap.u, orig_snap.v], dtype=np.int32)
+    if G.edge_id(orig_snap.v, orig_snap.u) >= 0:
+        return np.array([orig_snap.v, orig_snap.u], dtype=np.int32)
+    return None
+
+
+def split_path_at_snaps(G, path, orig_snap, dest_snap):
+    """
+    Joins a path between two nodes with the points snapped onto edges.
+
+    The snapped edges are split at the snapped points: if the path starts
+    (or ends) by running along the snapped edge, that part is cut off so the
+    path doesn't double back. The path of two points on the same street (see
+    ``snapped_edge_path``) is the piece of the street between them.
+
+    Args:
+        G (CSRGraph): Graph the path was found in.
+        path (np.ndarray): Path as node indices.
+        orig_snap (EdgeSnap): Origin snapped onto an edge.
+        dest_snap (EdgeSnap): Destination snapped onto an edge.
+
+    Returns:
+        tuple: (coordinates as an (n, 2) array, length in meters).
+    """
+
+    path = np.asarray(path)
+    direct = snapped_edge_path(G, orig_snap, dest_snap)
+    if direct is not None and np.array_equal(path, direct):
+        fraction = _same_street_fraction(orig_snap, dest_snap)
+        length = abs(fraction - orig_snap.fraction) * float(G.weights['length'][orig_snap.edge_id])
+        return _edge_piece(G, orig_snap.edge_id, orig_snap.fraction, fraction), length
+
+    if len(path) > 1 and {int(path[0]), int(path[1])} == {orig_snap.u, orig_snap.v}:
+        path = path[1:]
+    if len(path) > 1 and {int(path[-2]), int(path[-1])} == {dest_snap.u, dest_snap.v}:
+        path = path[:-1]
+
+    length = (
+        G.path_weight(path, 'length')
+        + _remaining_length(G, orig_snap, int(path[0]))
+        + _remaining_length(G, dest_snap, int(path[-1]))
+    )
+    coords = np.vstack((
+        _snapped_part(G, orig_snap, int(path[0]))[:-1],
+        G.path_coordinates(path),
+        _snapped_part(G, dest_snap, int(path[-1]))[::-1][1:],
+    ))
+    return coords, length
+
+
+def _snapped_part(G, snap, node):
+    # Geometry of the snapped edge from the snapped point to one of its ends
+    return _edge_piece(G, snap.edge_id, snap.fraction, 1.0 if node == snap.v else 0.0)
+
+
+def _edge_piece(G, edge_id, start, end):
+    # Geometry of an edge between two fractions of its length, from start to end. The points are
+    # put at the same share of the geometry's length as of the edge length, like ``_remaining_length``
+    coords = G.edge_geometry(edge_id)
+    distances = np.concatenate(([0.0], np.cumsum(segment_lengths_m(coords))))
+    low, high = sorted((start, end))
+    inner = (distances > low * distances[-1]) & (distances < high * distances[-1])
+    inner[[0, -1]] = False
+
+    piece = np.vstack((
+        [_point_along(coords, distances, low)], coords[inner], [_point_along(coords, distances, high)],
+    ))
+    return piece if start <= end else piece[::-1]
+
+
+def _point_along(coords, distances, fraction):
+    # Point at a fraction of the length of a polyline, its ends exactly
+    if fraction <= 0:
+        return coords[0]
+    if fraction >= 1:
+        return coords[-1]
+    target = fraction * distances[-1]
+    i = int(np.clip(np.searchsorted(distances, target, side='right') - 1, 0, len(coords) - 2))
+    t = (target - distances[i]) / max(distances[i + 1] - distances[i], 1e-9)
+    return coords[i] + min(max(t, 0.0), 1.0) * (coords[i + 1] - coords[i])
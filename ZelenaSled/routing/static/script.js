@@ -4,6 +4,16 @@ L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
   maxZoom: 19
 }).addTo(map);
 
+const overlays = {};
+[['ndvi', 'Greenery (NDVI)'], ['heat', 'Heat'], ['noise', 'Noise']].forEach(([layer, name]) => {
+  overlays[name] = L.tileLayer(`/api/tiles/${layer}/{z}/{x}/{y}.png`, {
+    minZoom: 10,
+    maxZoom: 18,
+    opacity: 0.7
+  });
+});
+L.control.layers(null, overlays).addTo(map);
+
 let currentLines = [];
 let markers = [];
 let pathLayers = [];
@@ -82,8 +92,7 @@ async function drawRoute(routingMode = "vegetation") {
     if (!res.ok) throw new Error(`Server error: ${res.status}`);
 
     const colors = ['#c01ce6', '#1c51e6', '#e6511c'];
-    const data = await res.json();
-    const parsed = JSON.parse(data);
+    const parsed = await res.json();
 
     clearMarkers();
     clearLines();
@@ -1,3 +1,1023 @@
-from django.test import TestCase
+import asyncio
+import functools
+import gzip
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from itertools import combinations, permutations
+from unittest import mock
 
-# Create your tests here.
+import geopandas as gpd
+import h3
+import networkx as nx
+import numpy as np
+import shapely
+from pyproj import Transformer
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+
+from . import batch, landmarks
+from .alternatives import penalty_alternatives
+from .async_executor import BoundedExecutor, DeadlineExceeded, check_deadline
+from .benchmark import (
+    CITY_SIZES, H3_LAYER_RANGES, synthetic_city, synthetic_h3_layer, synthetic_noise, write_synthetic_data,
+)
+from .corridor import corridor_search, extract_subgraph
+from .csr_graph import CSRGraph
+from .diversity import jaccard_dissimilarity, length_quality, select_diverse
+from .exposure import segment_lengths_m
+from .h3_store import H3_LAYERS, cell_parents, latlng_to_cells
+from .landmarks import bidirectional_astar, point_to_point
+from .layers import GraphRegistry
+from .multi_criteria import (
+    CRITERIA, LENGTH_EPSILON, criteria_cost, parse_weights, pareto_front, pareto_paths, path_criteria, weighted_path,
+)
+from .noise import MAX_UNMEASURED_M, NOISE_FILE, NoiseIndex, add_noise_to_edges
+from .preprocessing import convert_to_digraph, prepare_graph, process_graph
+from .route_cache import RouteCache, route_cache_key
+from .serialize import encode_polyline
+from .snapshot import ARRAYS, load_snapshot, save_snapshot
+from .spatial_index import METRIC_CRS, EdgeSnap, snapped_edge_path, split_path_at_snaps
+from .tiles import ALPHA, TILE_SIZE, LayerTiles, encode_png, tile_version, tiles_in_bbox
+from .time_slices import SLICED_COLUMNS, TimeSlices, graph_at, parse_departure_time
+from .views import get_top_3_quietest_paths
+
+
+@functools.lru_cache(maxsize=None)
+def synthetic_digraph():
+    """Returns the small synthetic city as the DiGraph the CSR graph is built from."""
+
+    return convert_to_digraph(synthetic_city(CITY_SIZES['small']))
+
+
+@functools.lru_cache(maxsize=None)
+def synthetic_graph():
+    """Returns the small synthetic city prepared for routing, built once for all tests."""
+
+    G_multi = synthetic_city(CITY_SIZES['small'])
+    h3_stores = {
+        layer: synthetic_h3_layer(G_multi, *H3_LAYER_RANGES[layer], 10 * i) for i, layer in enumerate(H3_LAYERS)
+    }
+    return process_graph(G_multi, synthetic_noise(G_multi), h3_stores)
+
+
+def echo_task(index):
+    return {'index': index, 'pid': os.getpid()}
+
+
+def crash_task(index):
+    os._exit(1)
+
+
+class CSRGraphTests(SimpleTestCase):
+
+    def setUp(self):
+        self.G_nx = synthetic_digraph()
+        self.G = CSRGraph.from_digraph(self.G_nx)
+
+    def test_layout_matches_digraph(self):
+        self.assertEqual(self.G.n_nodes, self.G_nx.number_of_nodes())
+        self.assertEqual(self.G.n_edges, self.G_nx.number_of_edges())
+        np.testing.assert_array_equal(self.G.node_ids, sorted(self.G_nx.nodes))
+
+        u = np.repeat(np.arange(self.G.n_nodes), np.diff(self.G.indptr))
+        for e in range(0, self.G.n_edges, 97):
+            data = self.G_nx[self.G.node_ids[u[e]]][self.G.node_ids[self.G.indices[e]]]
+            self.assertAlmostEqual(float(self.G.weights['length'][e]), data['length'], places=2)
+
+    def test_search_cost_equals_networkx(self):
+        matrix = self.G.matrix('length')
+        for source in (0, 1234, self.G.n_nodes - 1):
+            dist = dijkstra(matrix, indices=source)
+            expected = nx.single_source_dijkstra_path_length(self.G_nx, self.G.node_ids[source], weight='length')
+
+            self.assertEqual(int(np.isfinite(dist).sum()), len(expected))
+            nodes = np.searchsorted(self.G.node_ids, list(expected))
+            np.testing.assert_allclose(dist[nodes], list(expected.values()), rtol=1e-5)
+
+    def test_shortest_path_follows_edges(self):
+        source, target = 0, self.G.n_nodes - 1
+        cost, path = self.G.shortest_path(source, target, 'length')
+        expected = nx.dijkstra_path_length(self.G_nx, self.G.node_ids[source], self.G.node_ids[target], weight='length')
+
+        self.assertAlmostEqual(cost, expected, delta=expected * 1e-5)
+        self.assertEqual((path[0], path[-1]), (source, target))
+
+        edge_ids = self.G.edge_ids(path)
+        np.testing.assert_array_equal(self.G.indices[edge_ids], path[1:])
+        self.assertAlmostEqual(self.G.path_weight(path, 'length'), cost, delta=cost * 1e-5)
+
+    def test_edge_id(self):
+        u, v = 0, int(self.G.indices[self.G.indptr[0]])
+        self.assertEqual(self.G.edge_id(u, v), int(self.G.indptr[0]))
+        self.assertEqual(self.G.edge_id(u, u), -1)
+
+
+class SnapshotTests(SimpleTestCase):
+
+    def test_memory_mapped_round_trip(self):
+        G = synthetic_graph()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'walk-test')
+            save_snapshot(G, path)
+            loaded = load_snapshot(path, mmap_mode='r')
+
+            for name in ARRAYS:
+                np.testing.assert_array_equal(getattr(loaded, name), getattr(G, name), err_msg=name)
+            self.assertIsInstance(loaded.indices, np.memmap)
+            self.assertEqual(set(loaded.weights), set(G.weights))
+            for column, values in G.weights.items():
+                np.testing.assert_array_equal(loaded.weights[column], values, err_msg=column)
+            self.assertEqual(set(loaded.landmarks), set(G.landmarks))
+            np.testing.assert_array_equal(loaded.landmarks['length'].from_dist, G.landmarks['length'].from_dist)
+            self.assertEqual(loaded.layer_versions, G.layer_versions)
+
+            cost, path = G.shortest_path(0, G.n_nodes - 1, 'combined')
+            loaded_cost, loaded_path = loaded.shortest_path(0, G.n_nodes - 1, 'combined')
+            self.assertEqual(cost, loaded_cost)
+            np.testing.assert_array_equal(path, loaded_path)
+
+
+class SnapTests(SimpleTestCase):
+
+    def setUp(self):
+        self.G = synthetic_graph()
+
+    def two_way_edge(self):
+        # A long straight edge whose street can be travelled both ways
+        u = np.repeat(np.arange(self.G.n_nodes), np.diff(self.G.indptr))
+        for e in np.argsort(-self.G.weights['length']):
+            if len(self.G.edge_geometry(e)) == 2 and self.G.edge_id(self.G.indices[e], u[e]) >= 0:
+                return int(e)
+
+    def points_along(self, edge_id, fractions):
+        coords = self.G.edge_geometry(edge_id)
+        points = [coords[0] + fraction * (coords[1] - coords[0]) for fraction in fractions]
+        return [point[0] for point in points], [point[1] for point in points]
+
+    def test_points_on_the_same_street(self):
+        e = self.two_way_edge()
+        length = float(self.G.weights['length'][e])
+
+        for fractions in ((0.2, 0.8), (0.8, 0.2)):
+            orig_snap, dest_snap = self.G.spatial_index.nearest_edges(*self.points_along(e, fractions))
+            path = snapped_edge_path(self.G, orig_snap, dest_snap)
+            self.assertIsNotNone(path)
+            self.assertEqual(len(path), 2)
+
+            coords, path_length = split_path_at_snaps(self.G, path, orig_snap, dest_snap)
+            self.assertAlmostEqual(path_length, 0.6 * length, delta=0.01 * length)
+            self.assertEqual(len(coords), 2)
+            np.testing.assert_allclose(coords[0], (orig_snap.lon, orig_snap.lat), atol=1e-6)
+            np.testing.assert_allclose(coords[-1], (dest_snap.lon, dest_snap.lat), atol=1e-6)
+
+    def test_points_on_both_directions_of_a_street(self):
+        e = self.two_way_edge()
+        u, v = int(np.searchsorted(self.G.indptr, e, side='right') - 1), int(self.G.indices[e])
+        reverse = self.G.edge_id(v, u)
+        orig_snap = EdgeSnap(e, u, v, 0.2, 0, 0, 0)
+        dest_snap = EdgeSnap(reverse, v, u, 0.2, 0, 0, 0)
+
+        path = snapped_edge_path(self.G, orig_snap, dest_snap)
+        np.testing.assert_array_equal(path, [u, v])
+        _, path_length = split_path_at_snaps(self.G, path, orig_snap, dest_snap)
+        self.assertAlmostEqual(path_length, 0.6 * float(self.G.weights['length'][e]), places=3)
+
+    def curved_edge(self):
+        # A long edge whose geometry bends away from the straight line between its nodes
+        for e in np.argsort(-self.G.weights['length']):
+            coords = self.G.edge_geometry(e)
+            if len(coords) >= 3:
+                return int(e), coords
+
+    def test_points_next_to_a_curve(self):
+        e, coords = self.curved_edge()
+        distances = np.concatenate(([0.0], np.cumsum(segment_lengths_m(coords))))
+        bend = len(coords) // 2
+
+        snap, = self.G.spatial_index.nearest_edges([coords[bend][0] + 1e-5], [coords[bend][1]])
+        self.assertIn(e, (snap.edge_id, self.G.edge_id(snap.v, snap.u)))
+        self.assertLess(snap.distance_m, 1.0)
+        np.testing.assert_allclose((snap.lon, snap.lat), coords[bend], atol=1e-5)
+
+        fraction = distances[bend] / distances[-1]
+        self.assertAlmostEqual(snap.fraction if snap.edge_id == e else 1 - snap.fraction, fraction, delta=0.01)
+
+    def test_nearest_segment_of_all_edges(self):
+        index = self.G.spatial_index
+        rng = np.random.default_rng(6)
+        lon = rng.uniform(self.G.x.min(), self.G.x.max(), 50)
+        lat = rng.uniform(self.G.y.min(), self.G.y.max(), 50)
+        snaps = index.nearest_edges(lon, lat)
+
+        # Distance to every segment of every edge geometry
+        points = index.project(lon, lat)[:, None, :]
+        start, segment = index.segment_start, index.segment_end - index.segment_start
+        t = np.clip(((points - start) * segment).sum(axis=-1) / np.maximum((segment ** 2).sum(axis=-1), 1e-12), 0, 1)
+        expected = np.hypot(*(points - start - t[..., None] * segment).transpose(2, 0, 1)).min(axis=1)
+        np.testing.assert_allclose([snap.distance_m for snap in snaps], expected, atol=1e-6)
+
+    def test_path_along_a_curved_edge(self):
+        e, coords = self.curved_edge()
+        u, v = int(np.searchsorted(self.G.indptr, e, side='right') - 1), int(self.G.indices[e])
+        snaps = [EdgeSnap(e, u, v, 0.1, 0, 0, 0), EdgeSnap(e, u, v, 0.9, 0, 0, 0)]
+        path = snapped_edge_path(self.G, *snaps)
+
+        piece, length = split_path_at_snaps(self.G, path, *snaps)
+        self.assertAlmostEqual(length, 0.8 * float(self.G.weights['length'][e]), places=3)
+        # The piece follows the geometry through its bends
+        self.assertGreater(len(piece), 2)
+        inner = [point for point in coords[1:-1] if not np.isclose(piece, point).all(axis=1).any()]
+        self.assertLessEqual(len(inner), 2)
+        self.assertAlmostEqual(segment_lengths_m(piece).sum(), 0.8 * segment_lengths_m(coords).sum(), delta=0.5)
+
+        # Snapping the ends of the piece gives back their fractions
+        for snap, point in zip(snaps, piece[[0, -1]]):
+            snapped, = self.G.spatial_index.nearest_edges([point[0]], [point[1]])
+            fraction = snapped.fraction if snapped.edge_id == e else 1 - snapped.fraction
+            self.assertAlmostEqual(fraction, snap.fraction, places=3)
+
+    def test_points_on_different_streets(self):
+        lon, lat = self.G.x[[0, self.G.n_nodes - 1]] + 1e-5, self.G.y[[0, self.G.n_nodes - 1]]
+        self.assertIsNone(snapped_edge_path(self.G, *self.G.spatial_index.nearest_edges(lon, lat)))
+
+
+class LandmarkTests(SimpleTestCase):
+
+    def setUp(self):
+        self.G = synthetic_graph()
+        rng = np.random.default_rng(1)
+        self.pairs = rng.integers(0, self.G.n_nodes, size=(10, 2)).tolist()
+        # Penalised costs like the ones the penalty alternatives search with
+        self.factors = rng.choice([1.0, 1.4, 1.96], size=self.G.n_edges)
+
+    def assert_same_cost_as_dijkstra(self, weight, data=None):
+        matrix = self.G.matrix(weight) if data is None else self.G.weighted_matrix(data)
+        for source, target in self.pairs:
+            expected = dijkstra(matrix, indices=source)[target]
+            cost, path, settled = bidirectional_astar(self.G, source, target, weight, data)
+
+            self.assertAlmostEqual(cost, expected, delta=expected * 1e-6)
+            self.assertEqual((path[0], path[-1]), (source, target))
+            edge_costs = matrix.data[self.G.edge_ids(path)]
+            self.assertAlmostEqual(edge_costs.sum(), expected, delta=expected * 1e-6)
+            self.assertLess(settled, self.G.n_nodes)
+
+    def test_astar_cost_equals_dijkstra(self):
+        for weight in ('length', 'combined'):
+            with self.subTest(weight=weight):
+                self.assert_same_cost_as_dijkstra(weight)
+
+    def test_astar_cost_equals_dijkstra_with_penalties(self):
+        for weight in ('length', 'combined'):
+            with self.subTest(weight=weight):
+                self.assert_same_cost_as_dijkstra(weight, self.G.cost(weight) * self.factors)
+
+    @override_settings(ROUTING_ALT={'ENABLED': False})
+    def test_point_to_point_without_landmarks(self):
+        source, target = self.pairs[0]
+        cost, _, settled = point_to_point(self.G, source, target, 'combined')
+        astar_cost, _, astar_settled = bidirectional_astar(self.G, source, target, 'combined')
+        self.assertAlmostEqual(cost, astar_cost, delta=cost * 1e-6)
+        self.assertGreater(settled, astar_settled)
+
+
+class CorridorTests(SimpleTestCase):
+
+    def setUp(self):
+        self.G = synthetic_graph()
+
+    def test_corridor_is_searched_with_astar(self):
+        G, searched = self.G, []
+
+        def search(sub, orig_node, dest_node):
+            cost, path, settled = point_to_point(sub, orig_node, dest_node, 'combined')
+            searched.append(sub)
+            return [path]
+
+        xy = G.spatial_index.node_xy
+        rng = np.random.default_rng(3)
+        for orig_node in rng.integers(0, G.n_nodes, size=5).tolist():
+            # A destination about 1 km away
+            dest_node = int(np.argmin(np.abs(np.hypot(*(xy - xy[orig_node]).T) - 1000)))
+            with mock.patch('routing.landmarks.bidirectional_astar', wraps=bidirectional_astar) as astar:
+                path, = corridor_search(G, orig_node, dest_node, search)
+
+            sub = searched[-1]
+            self.assertLess(sub.n_nodes, G.n_nodes)
+            self.assertIs(astar.call_args.args[0], sub)
+            np.testing.assert_array_equal(path[[0, -1]], [orig_node, dest_node])
+
+            cost, _ = G.shortest_path(orig_node, dest_node, 'combined')
+            self.assertAlmostEqual(G.path_weight(path, 'combined'), cost, delta=cost * 1e-5)
+
+    def test_subgraph_landmarks_are_sliced(self):
+        nodes = np.arange(0, self.G.n_nodes, 3)
+        sub = extract_subgraph(self.G, nodes)
+        for column, landmarks in self.G.landmarks.items():
+            np.testing.assert_array_equal(sub.landmarks[column].from_dist, landmarks.from_dist[:, nodes])
+            np.testing.assert_array_equal(sub.landmarks[column].to_dist, landmarks.to_dist[:, nodes])
+        np.testing.assert_array_equal(sub.cost('combined'), sub.weighted_matrix(sub.weights['combined']).data)
+
+
+class H3Tests(SimpleTestCase):
+
+    def test_cell_parents_match_h3(self):
+        G_multi = synthetic_city(CITY_SIZES['small'])
+        city_cells = synthetic_h3_layer(G_multi, *H3_LAYER_RANGES['ndvi']).cells[::50]
+        # Cells all over the globe, including the pentagons
+        rng = np.random.default_rng(5)
+        world_cells = latlng_to_cells(rng.uniform(-90, 90, 200), rng.uniform(-180, 180, 200), 15)
+        pentagons = [h3.str_to_int(h3.cell_to_center_child(cell, 15)) for cell in h3.get_pentagons(0)]
+
+        for cells in (city_cells, world_cells, np.array(pentagons, dtype=np.uint64)):
+            finest = h3.get_resolution(h3.int_to_str(int(cells[0])))
+            for resolution in range(finest + 1):
+                expected = [h3.str_to_int(h3.cell_to_parent(h3.int_to_str(int(cell)), resolution)) for cell in cells]
+                np.testing.assert_array_equal(cell_parents(cells, resolution), expected, err_msg=str(resolution))
+
+
+def hexagon(x, y, radius):
+    angles = np.radians(np.arange(30, 390, 60))
+    return shapely.Polygon(np.column_stack((x + radius * np.cos(angles), y + radius * np.sin(angles))))
+
+
+class NoiseTests(SimpleTestCase):
+
+    def setUp(self):
+        # Two hexagons side by side in the metric CRS, 100 m across, measured at 50 and 70 dB
+        self.x, self.y = Transformer.from_crs("EPSG:4326", METRIC_CRS, always_xy=True).transform(14.5, 46.05)
+        self.to_lonlat = Transformer.from_crs(METRIC_CRS, "EPSG:4326", always_xy=True)
+        radius = 100 / np.sqrt(3)
+        self.noise_index = NoiseIndex([hexagon(self.x, self.y, radius), hexagon(self.x + 100, self.y, radius)], [50, 70])
+
+    def line(self, *offsets):
+        """(lon, lat) coordinates of a line through the hexagon centers, at offsets in meters from the first one."""
+
+        x = self.x + np.array(offsets, dtype=float)
+        return np.column_stack(self.to_lonlat.transform(x, np.full(len(x), self.y)))
+
+    def test_score_path(self):
+        # 50 m in the first hexagon, 100 m in the second and 100 m past it
+        score = self.noise_index.score_path(self.line(0, 250))
+        self.assertAlmostEqual(score['la50'], (50 * 50 + 70 * 100) / 150, places=6)
+        self.assertAlmostEqual(score['coverage'], 150 / 250, places=6)
+        self.assertAlmostEqual(score['max_gap_m'], 100, places=3)
+
+        score = self.noise_index.score_path(self.line(300, 400))
+        self.assertIsNone(score['la50'])
+        self.assertEqual(score['coverage'], 0.0)
+        self.assertAlmostEqual(score['max_gap_m'], 100, places=3)
+
+    def test_edge_noise(self):
+        coords = self.line(0, 250, 400)
+        G = nx.DiGraph()
+        G.add_nodes_from((i, {'x': lon, 'y': lat}) for i, (lon, lat) in enumerate(coords))
+        G.add_edges_from([(0, 1), (1, 2)])
+
+        add_noise_to_edges(G, self.noise_index)
+
+        self.assertAlmostEqual(G.edges[0, 1]['noise'], (50 * 50 + 70 * 100) / 150, places=6)
+        self.assertAlmostEqual(G.edges[0, 1]['noise_coverage'], 150 / 250, places=6)
+        self.assertTrue(np.isnan(G.edges[1, 2]['noise']))
+        self.assertEqual(G.edges[1, 2]['noise_coverage'], 0.0)
+
+    def test_paths_with_long_gaps_are_rejected(self):
+        # The quieter path runs 50 m through the first hexagon, then 550 m without a measurement
+        gapped = {'coordinates': self.line(0, -600), 'length_m': 600}
+        measured = {'coordinates': self.line(0, 250), 'length_m': 250}
+        self.assertGreater(self.noise_index.score_path(gapped['coordinates'])['max_gap_m'], MAX_UNMEASURED_M)
+
+        quietest = get_top_3_quietest_paths([gapped, measured], [[0, 1], [0, 2]], self.noise_index)
+
+        self.assertEqual(quietest, [measured])
+        self.assertAlmostEqual(measured['la50'], (50 * 50 + 70 * 100) / 150, places=6)
+        self.assertAlmostEqual(measured['noise_coverage'], 150 / 250, places=6)
+        self.assertNotIn('la50', gapped)
+
+        self.assertIsNone(get_top_3_quietest_paths([gapped], [[0, 1]], self.noise_index))
+
+
+class MultiCriteriaTests(SimpleTestCase):
+
+    def setUp(self):
+        self.G = synthetic_graph()
+        self.pairs = np.random.default_rng(7).integers(0, self.G.n_nodes, size=(4, 2)).tolist()
+
+    def test_parse_weights(self):
+        self.assertEqual(parse_weights({'noise': 2, 'length': '1'}),
+                         {'length': 1.0, 'noise': 2.0, 'vegetation': 0.0, 'heat': 0.0})
+        for weights in (
+            [1, 2], {'speed': 1}, {'noise': 'loud'}, {'noise': None}, {'noise': -1},
+            {'noise': float('nan')}, {'noise': float('inf')}, {'noise': 0}, {},
+        ):
+            with self.subTest(weights=weights), self.assertRaises(ValueError):
+                parse_weights(weights)
+
+    def test_criteria_cost(self):
+        weights = parse_weights({'length': 1, 'noise': 2, 'heat': 0.5})
+        expected = (
+            (1 + LENGTH_EPSILON) * self.G.weights['length'].astype(np.float64)
+            + 2 * self.G.weights['noise_cost'] + 0.5 * self.G.weights['heat_cost']
+        )
+        np.testing.assert_allclose(criteria_cost(self.G, weights), expected, rtol=1e-6)
+
+    def test_weighted_path_has_the_minimum_cost(self):
+        weights = parse_weights({'noise': 1, 'vegetation': 2})
+        cost = criteria_cost(self.G, weights)
+        matrix = csr_matrix((cost, self.G.indices, self.G.indptr), shape=(self.G.n_nodes,) * 2)
+        for source, target in self.pairs:
+            path = weighted_path(self.G, source, target, weights)
+            self.assertEqual((path[0], path[-1]), (source, target))
+            expected = dijkstra(matrix, indices=source)[target]
+            self.assertAlmostEqual(cost[self.G.edge_ids(path)].sum(), expected, delta=expected * 1e-6)
+
+    def test_pareto_front(self):
+        objectives = [[1, 5], [2, 2], [3, 3], [5, 1], [1, 5], [2, 4]]
+        np.testing.assert_array_equal(pareto_front(objectives), [True, True, False, True, True, False])
+
+    def test_pareto_paths_are_not_dominated(self):
+        weights = parse_weights({'noise': 1, 'heat': 1})
+        columns = [list(CRITERIA).index(criterion) for criterion in ('length', 'noise', 'heat')]
+        for source, target in self.pairs:
+            paths = pareto_paths(self.G, source, target, weights, max_paths=10)
+            self.assertTrue(paths)
+            objectives = np.array([path_criteria(self.G, path)[columns] for path in paths])
+            for i, j in permutations(range(len(paths)), 2):
+                dominated = (objectives[j] <= objectives[i]).all() and (objectives[j] < objectives[i]).any()
+                self.assertFalse(dominated, f"path {i} is dominated by path {j}")
+            self.assertTrue((np.diff(objectives[:, 0]) >= 0).all())
+
+
+class DiversityTests(SimpleTestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.paths = [rng.choice(40, size=rng.integers(5, 20), replace=False) for _ in range(12)]
+
+    def jaccard(self, a, b):
+        a, b = set(a), set(b)
+        return 1 - len(a & b) / len(a | b)
+
+    def test_jaccard_dissimilarity(self):
+        dissimilarity = jaccard_dissimilarity(self.paths)
+        for i, j in combinations(range(len(self.paths)), 2):
+            self.assertAlmostEqual(dissimilarity[i, j], self.jaccard(self.paths[i], self.paths[j]))
+        np.testing.assert_allclose(np.diag(dissimilarity), 0)
+
+    def test_selects_the_most_diverse_subset(self):
+        def score(subset):
+            return sum(self.jaccard(self.paths[i], self.paths[j]) for i, j in combinations(subset, 2))
+
+        best = max(combinations(range(len(self.paths)), 3), key=score)
+        self.assertEqual(select_diverse(self.paths, 3), list(best))
+
+        # The greedy method used for many candidates picks a subset almost as diverse
+        with mock.patch('routing.diversity.EXACT_LIMIT', 0):
+            greedy = select_diverse(self.paths, 3)
+        self.assertEqual(len(set(greedy)), 3)
+        self.assertGreater(score(greedy), 0.9 * score(best))
+
+    def test_low_quality_paths_are_skipped(self):
+        lengths = np.arange(100, 100 + 10 * len(self.paths), 10)
+        quality = length_quality(lengths)
+        selected = select_diverse(self.paths, 3, quality, min_quality=0.8)
+        self.assertTrue(all(quality[i] >= 0.8 for i in selected))
+        self.assertEqual(select_diverse(self.paths[:2], 3), [0, 1])
+
+    def test_alternatives_of_the_synthetic_city(self):
+        G = synthetic_graph()
+        paths = penalty_alternatives(G, 0, G.n_nodes - 1, 'combined', 6)
+        selected = select_diverse(paths, 3)
+        self.assertEqual(len(selected), min(3, len(paths)))
+        self.assertEqual(selected, sorted(selected))
+
+
+def decode_polyline(polyline, precision=5):
+    values, value, shift = [], 0, 0
+    for char in polyline:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    return np.cumsum(np.reshape(values, (-1, 2)), axis=0)[:, ::-1] / 10 ** precision
+
+
+class PolylineTests(SimpleTestCase):
+
+    def test_reference_polyline(self):
+        # Example of the encoded polyline algorithm format documentation, as (lon, lat)
+        coords = [(-120.2, 38.5), (-120.95, 40.7), (-126.453, 43.252)]
+        self.assertEqual(encode_polyline(coords), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+        self.assertEqual(encode_polyline([]), '')
+
+    def test_path_round_trip(self):
+        G = synthetic_graph()
+        _, path = G.shortest_path(0, G.n_nodes - 1, 'length')
+        coords = G.path_coordinates(path)
+        for precision in (5, 6):
+            decoded = decode_polyline(encode_polyline(coords, precision), precision)
+            np.testing.assert_allclose(decoded, np.round(coords, precision), atol=10 ** -precision / 2)
+
+
+@override_settings(ROUTING_SNAP_TO_EDGES=True)
+class GetPathsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.G = synthetic_graph()
+        registry = GraphRegistry()
+        registry.watch_enabled = False
+        registry._graphs['walk'] = self.G
+        registry._states['walk'] = 'ready'
+        for patch in (mock.patch('routing.layers._graph_registry', registry),
+                      mock.patch('routing.route_cache._route_cache', None)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        # Two points about 1.5 km apart, a few meters off the streets
+        xy = self.G.spatial_index.node_xy
+        orig_node = self.G.n_nodes // 3
+        dest_node = int(np.argmin(np.abs(np.hypot(*(xy - xy[orig_node]).T) - 1500)))
+        self.origin = [self.G.y[orig_node] + 2e-5, self.G.x[orig_node] + 3e-5]
+        self.destination = [self.G.y[dest_node] - 2e-5, self.G.x[dest_node] + 3e-5]
+
+    def post(self, headers=None, **data):
+        data = {'origin_coords': self.origin, 'destination_coords': self.destination, 'commute_mode': 'walk', **data}
+        return self.client.post('/api/get_paths/', json.dumps(data), content_type='application/json', **(headers or {}))
+
+    def test_feature_collection(self):
+        for routing_mode in (None, 'vegetation', 'heat'):
+            with self.subTest(routing_mode=routing_mode):
+                response = self.post(routing_mode=routing_mode)
+                self.assertEqual(response.status_code, 200, response.content)
+                self.assertEqual(response['Content-Type'], 'application/json')
+
+                collection = response.json()
+                self.assertEqual(collection['type'], 'FeatureCollection')
+                self.assertTrue(1 <= len(collection['features']) <= 3)
+                for feature in collection['features']:
+                    self.assertEqual(feature['type'], 'Feature')
+                    self.assertEqual(feature['geometry']['type'], 'LineString')
+                    coords = np.array(feature['geometry']['coordinates'])
+                    self.assertGreaterEqual(len(coords), 2)
+                    # Paths start and end where the points were snapped to the streets, a few meters away
+                    np.testing.assert_allclose(coords[0], self.origin[::-1], atol=1e-4)
+                    np.testing.assert_allclose(coords[-1], self.destination[::-1], atol=1e-4)
+                    self.assertGreater(feature['properties']['length_m'], 1000)
+
+    def test_polyline_format(self):
+        geojson = self.post().json()['features'][0]
+        polyline = self.post(format='polyline', precision=6).json()['features'][0]
+        self.assertIsNone(polyline['geometry'])
+        self.assertEqual(polyline['properties']['polyline_precision'], 6)
+        np.testing.assert_allclose(
+            decode_polyline(polyline['properties']['polyline'], 6), geojson['geometry']['coordinates'], atol=1e-5,
+        )
+
+    def test_compressed_response(self):
+        response = self.post({'HTTP_ACCEPT_ENCODING': 'gzip'})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content))['type'], 'FeatureCollection')
+
+    def test_batch_lines_are_streamed_uncompressed(self):
+        results = ({'index': i, 'type': 'FeatureCollection'} for i in range(3))
+        with mock.patch('routing.views.run_batch', return_value=results):
+            response = self.client.post(
+                '/api/get_paths/batch/', json.dumps({'pairs': [{}] * 3}), content_type='application/json',
+                HTTP_ACCEPT_ENCODING='gzip',
+            )
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual([json.loads(line)['index'] for line in response.streaming_content], [0, 1, 2])
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.post(commute_mode='car').status_code, 400)
+        self.assertEqual(self.post(origin_coords=[0, 0]).status_code, 400)
+        self.assertEqual(self.client.get('/api/get_paths/').status_code, 405)
+
+
+class DepartureTimeTests(SimpleTestCase):
+
+    def test_departure_times(self):
+        for value, hour in (
+            (None, None),
+            ('17:30', 17.5),
+            ('17:37', 17.5),
+            ('23:55', 0.0),
+            ('2026-07-01T08:00:00', 8.0),
+            # Summer and winter time of Ljubljana
+            ('2026-07-01T15:30:00+00:00', 17.5),
+            ('2026-01-15T15:30:00Z', 16.5),
+            (7.2, 7.25),
+            (0, 0.0),
+        ):
+            with self.subTest(value=value):
+                self.assertEqual(parse_departure_time(value), hour)
+
+    @override_settings(ROUTING_TIME_SLICES={'ROUND_MINUTES': 0})
+    def test_departure_times_without_rounding(self):
+        self.assertAlmostEqual(parse_departure_time('17:37'), 17 + 37 / 60)
+
+    def test_invalid_departure_times(self):
+        for value in ('noon', '25:00', 24, -1, True, ['17:30']):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                parse_departure_time(value)
+
+
+class TimeSliceTests(SimpleTestCase):
+
+    def test_interpolation_wraps_past_midnight(self):
+        time_slices = TimeSlices(np.array([6.0, 14.0]), {'heat_cost': np.array([[10, 30]], dtype=np.float32)})
+        for hour, expected, value in (
+            (6, (0, 1, 0.0), 10),
+            (10, (0, 1, 0.5), 20),
+            (14, (1, 0, 0.0), 30),
+            # 14:00 to 06:00 is a 16 hour span over midnight
+            (22, (1, 0, 0.5), 20),
+            (2, (1, 0, 0.75), 15),
+        ):
+            with self.subTest(hour=hour):
+                self.assertEqual(time_slices.interpolation(hour), expected)
+                np.testing.assert_allclose(time_slices.columns_at(hour)['heat_cost'], [value])
+
+    def test_single_slice(self):
+        time_slices = TimeSlices(np.array([14.0]), {'heat_cost': np.array([[10], [20]], dtype=np.float32)})
+        for hour in (0, 2, 14, 22):
+            with self.subTest(hour=hour):
+                self.assertEqual(time_slices.interpolation(hour), (0, 0, 0.0))
+                np.testing.assert_array_equal(time_slices.columns_at(hour)['heat_cost'], [10, 20])
+
+    @override_settings(ROUTING_TIME_SLICES={'CACHED_VIEWS': 2})
+    def test_graph_views_are_evicted(self):
+        G = synthetic_graph().replace()
+        G.time_slices = {'heat': TimeSlices(np.array([6.0, 14.0]), {
+            column: np.column_stack((G.weights[column], 2 * G.weights[column])) for column in SLICED_COLUMNS['heat']
+        })}
+
+        self.assertIs(graph_at(G, None, ('heat',)), G)
+        self.assertIs(graph_at(G, 10, ('noise',)), G)
+
+        view = graph_at(G, 10, ('heat', 'noise'))
+        self.assertIs(graph_at(G, 10, ('heat',)), view)
+        np.testing.assert_allclose(view.weights['heat_cost'], 1.5 * G.weights['heat_cost'], rtol=1e-6)
+        self.assertEqual(view.version, f'{G.version}@1000')
+
+        evicted = graph_at(G, 11, ('heat',))
+        # The view at 10:00 was used last, so the one at 11:00 goes first
+        self.assertIs(graph_at(G, 10, ('heat',)), view)
+        graph_at(G, 12, ('heat',))
+        self.assertEqual(list(G._time_views), [(10, ('heat',)), (12, ('heat',))])
+        self.assertIs(graph_at(G, 10, ('heat',)), view)
+        self.assertIsNot(graph_at(G, 11, ('heat',)), evicted)
+
+
+class ReloadTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.data_dir = directory.name
+        write_synthetic_data(self.data_dir, 'small')
+
+        settings = override_settings(ROUTING_DATA_DIR=self.data_dir, ROUTING_GRAPHS={'COMMUTE_MODES': ('walk',)})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.cache = RouteCache()
+        for patch in (mock.patch('routing.layers.get_route_cache', return_value=self.cache),
+                      mock.patch('routing.noise._noise_index', None)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.registry = GraphRegistry()
+        self.registry.watch_enabled = False
+
+    def change_layers(self):
+        # Heat: warmer cells in the west, some cells removed
+        path = os.path.join(self.data_dir, f"{H3_LAYERS['heat']}.zip")
+        with zipfile.ZipFile(path) as zip_ref:
+            cells = json.loads(zip_ref.read(f"{H3_LAYERS['heat']}.json"))
+        lon = {cell: h3.cell_to_latlng(cell)[1] for cell in cells}
+        middle = np.median(list(lon.values()))
+        cells = {cell: value + 5 for cell, value in cells.items() if lon[cell] < middle and hash(cell) % 10}
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+            zip_ref.writestr(f"{H3_LAYERS['heat']}.json", json.dumps(cells))
+
+        # Noise: some hexagons louder, some removed
+        path = os.path.join(self.data_dir, NOISE_FILE)
+        noise = gpd.read_file(path)
+        noise.loc[noise.index % 3 == 0, 'la50'] += 10
+        noise[noise.index % 7 != 0].to_file(path, driver='GeoJSON')
+
+    def test_reload_matches_a_fresh_graph(self):
+        G = self.registry.get('walk')
+        keys = {
+            routing_mode: route_cache_key(G, 'walk', routing_mode, 'penalty', 0, 1)
+            for routing_mode in (None, 'vegetation', 'heat', 'noise')
+        }
+        for key in keys.values():
+            self.cache.set(key, ['route'])
+        self.assertEqual(self.registry.reload(), {})
+        # The layers the graph was prepared from are kept, so only the edges of changed cells and hexagons are recomputed
+        self.assertEqual(set(self.registry._layers), {'noise', 'ndvi', 'heat'})
+
+        self.change_layers()
+        self.assertEqual(set(self.registry.reload()), {'heat', 'noise'})
+        G_new = self.registry.get('walk')
+        self.assertIsNot(G_new, G)
+
+        fresh = prepare_graph('walk')
+        self.assertEqual(set(G_new.weights), set(fresh.weights))
+        for column, values in fresh.weights.items():
+            if column in ('noise', 'noise_coverage', 'combined', 'noise_cost'):
+                # Noise of the recomputed edges is summed in another order, it differs by less than 1e-3 dB
+                tolerance = {'rtol': 1e-3, 'atol': 1e-3}
+            else:
+                tolerance = {'rtol': 1e-5, 'atol': 1e-5}
+            np.testing.assert_allclose(G_new.weights[column], values, err_msg=column, **tolerance)
+        np.testing.assert_allclose(G_new.weights['noise'], fresh.weights['noise'], rtol=0, atol=1e-3)
+        # The old graph still holds the old layers for the requests running on it
+        self.assertFalse(np.allclose(G.weights['heat_sum'], G_new.weights['heat_sum']))
+
+        # Only routes on the changed layers are dropped
+        self.assertEqual(self.cache.get(keys[None]), ['route'])
+        self.assertEqual(self.cache.get(keys['vegetation']), ['route'])
+        self.assertIsNone(self.cache.get(keys['heat']))
+        self.assertIsNone(self.cache.get(keys['noise']))
+        self.assertEqual(self.registry.last_reload['invalidated_routes'], 2)
+
+
+def png_chunks(png):
+    chunks, position = {}, 8
+    while position < len(png):
+        length, = struct.unpack('>I', png[position:position + 4])
+        kind, data = png[position + 4:position + 8], png[position + 8:position + 8 + length]
+        crc, = struct.unpack('>I', png[position + 8 + length:position + 12 + length])
+        assert crc == zlib.crc32(kind + data)
+        chunks[kind] = data
+        position += length + 12
+    return chunks
+
+
+class TileTests(SimpleTestCase):
+
+    def setUp(self):
+        G_multi = synthetic_city(CITY_SIZES['small'])
+        self.store = synthetic_h3_layer(G_multi, *H3_LAYER_RANGES['heat'])
+        self.center = (np.mean([x for _, x in G_multi.nodes(data='x')]), np.mean([y for _, y in G_multi.nodes(data='y')]))
+
+    def center_tile(self, z):
+        return (z, *tiles_in_bbox((*self.center, *self.center), z)[0])
+
+    def test_png_encoding(self):
+        rgba = np.random.default_rng(8).integers(0, 256, size=(3, 5, 4), dtype=np.uint8)
+        png = encode_png(rgba)
+        self.assertEqual(png[:8], b'\x89PNG\r\n\x1a\n')
+
+        chunks = png_chunks(png)
+        self.assertEqual(list(chunks), [b'IHDR', b'IDAT', b'IEND'])
+        # 5 x 3 pixels, 8 bits per channel, RGBA
+        self.assertEqual(struct.unpack('>IIBBBBB', chunks[b'IHDR']), (5, 3, 8, 6, 0, 0, 0))
+        rows = np.frombuffer(zlib.decompress(chunks[b'IDAT']), dtype=np.uint8).reshape(3, 5 * 4 + 1)
+        np.testing.assert_array_equal(rows[:, 0], 0)
+        np.testing.assert_array_equal(rows[:, 1:].reshape(rgba.shape), rgba)
+
+    def test_rendered_tile(self):
+        tiles = LayerTiles('heat', 'test', self.store)
+        image = tiles.render(*self.center_tile(15))
+        self.assertEqual(image.shape, (TILE_SIZE, TILE_SIZE, 4))
+        self.assertTrue(set(np.unique(image[..., 3])) <= {0, ALPHA})
+        self.assertGreater((image[..., 3] == ALPHA).mean(), 0.5)
+
+        chunks = png_chunks(encode_png(image))
+        self.assertEqual(struct.unpack('>II', chunks[b'IHDR'][:8]), (TILE_SIZE, TILE_SIZE))
+        self.assertEqual(len(zlib.decompress(chunks[b'IDAT'])), TILE_SIZE * (TILE_SIZE * 4 + 1))
+
+        # Tiles far from the data are empty
+        self.assertFalse(tiles.render(15, 0, 0).any())
+
+    def test_tile_versions(self):
+        with tempfile.TemporaryDirectory() as data_dir, override_settings(ROUTING_DATA_DIR=data_dir), \
+                mock.patch('routing.layers._graph_registry', GraphRegistry()), \
+                mock.patch.dict('routing.tiles._layer_tiles', clear=True):
+            def write_layer(offset):
+                values = {h3.int_to_str(cell): value + offset for cell, value in
+                          zip(self.store.cells.tolist(), self.store.values.tolist())}
+                path = os.path.join(data_dir, f"{H3_LAYERS['heat']}.zip")
+                with zipfile.ZipFile(path, 'w') as zip_ref:
+                    zip_ref.writestr(f"{H3_LAYERS['heat']}.json", json.dumps(values))
+                # A new modification time, so the file is hashed again
+                os.utime(path, (time.time() + offset, time.time() + offset))
+
+            url = '/api/tiles/heat/{}/{}/{}.png'.format(*self.center_tile(14))
+            write_layer(0)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'image/png')
+            self.assertFalse(response.has_header('Content-Encoding'))
+            etag = response['ETag']
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+            write_layer(5)
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            # Only the tiles of the new version are kept
+            self.assertEqual(os.listdir(os.path.join(data_dir, 'tiles', 'heat')), [tile_version('heat')])
+
+
+@override_settings(CACHES={'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RouteCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        caches['shared'].clear()
+
+    def test_concurrent_requests_compute_once(self):
+        cache = RouteCache()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return ['route']
+
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('key', compute)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['route']] * 8)
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(cache.stats['coalesced'], 7)
+
+    def test_waiters_get_a_none_result_without_computing(self):
+        cache = RouteCache()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return None
+
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('key', compute)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [None] * 8)
+        self.assertEqual(cache.stats['coalesced'], 7)
+
+    def test_entries_expire_and_are_evicted(self):
+        cache = RouteCache(max_entries=2, ttl=0.05)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), 3)
+
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('c'))
+
+    def test_none_is_not_cached(self):
+        cache = RouteCache()
+        self.assertIsNone(cache.get_or_compute('key', lambda: None))
+        self.assertEqual(cache.get_or_compute('key', lambda: 1), 1)
+        self.assertEqual(cache.stats['misses'], 2)
+
+    def test_shared_backend(self):
+        cache, other_worker = RouteCache(backend='shared'), RouteCache(backend='shared')
+        self.assertEqual(cache.get_or_compute('key', lambda: 1), 1)
+        self.assertEqual(other_worker.get_or_compute('key', lambda: 2), 1)
+        self.assertIsNone(caches['shared'].get('key:lock'))
+
+    def test_lock_of_another_worker_is_kept(self):
+        caches['shared'].add('key:lock', 1, timeout=60)
+        cache = RouteCache(backend='shared', lock_timeout=0.2)
+
+        # The other worker stores nothing in time, so the route is computed here
+        self.assertEqual(cache.get_or_compute('key', lambda: 1), 1)
+        self.assertEqual(caches['shared'].get('key:lock'), 1)
+
+
+@override_settings(ROUTING_BATCH_WORKERS=1)
+class BatchPoolTests(SimpleTestCase):
+
+    def tearDown(self):
+        if batch._pool is not None:
+            batch._pool.shutdown()
+            batch._pool = None
+
+    def test_tasks_run_in_spawned_workers(self):
+        results = list(batch.run_batch([(echo_task, (i,)) for i in range(3)]))
+        self.assertEqual(sorted(result['index'] for result in results), [0, 1, 2])
+        self.assertNotIn(os.getpid(), {result['pid'] for result in results})
+
+    @override_settings(ROUTING_BATCH_MAX_PAIRS=10)
+    def test_batch_size_limits(self):
+        origins = [[46.05, 14.5]] * 10
+        self.assertEqual(len(batch.batch_tasks({'mode': 'matrix', 'origins': origins, 'destinations': origins * 10})), 10)
+        for data in (
+            {'mode': 'matrix', 'origins': origins + origins[:1], 'destinations': origins[:1]},
+            {'mode': 'matrix', 'origins': origins, 'destinations': origins * 10 + origins[:1]},
+            {'pairs': [{}] * 11},
+        ):
+            with self.assertRaises(ValueError):
+                batch.batch_tasks(data)
+
+    def test_broken_pool_reports_every_task_and_is_replaced(self):
+        results = list(batch.run_batch([(crash_task, (0,)), (echo_task, (1,))]))
+        self.assertEqual(sorted(result['index'] for result in results), [0, 1])
+        self.assertEqual(results[0]['status'], 500)
+
+        # The next batch gets a new pool
+        self.assertEqual(list(batch.run_batch([(echo_task, (2,))]))[0]['index'], 2)
+
+
+class DeadlineTests(SimpleTestCase):
+
+    def test_running_job_frees_its_slot_after_the_deadline(self):
+        executor = BoundedExecutor(workers=1, max_queue=1)
+
+        def search():
+            # Stands in for a search that would run long past the deadline
+            for _ in range(300):
+                check_deadline()
+                time.sleep(0.01)
+            return 'finished'
+
+        with self.assertRaises(DeadlineExceeded):
+            asyncio.run(executor.run(search, timeout=0.05))
+
+        # The job stops at its next check instead of running for 3 s, so the slot is free again
+        time.sleep(0.1)
+        self.assertEqual(executor.queue_depth, 0)
+        self.assertEqual(executor.stats['abandoned'], 1)
+        self.assertEqual(asyncio.run(executor.run(lambda: 'next', timeout=1)), 'next')
+
+    def test_searches_stop_at_the_deadline(self):
+        G = synthetic_graph()
+        searches = (
+            lambda: penalty_alternatives(G, 0, G.n_nodes - 1, 'combined', 3),
+            lambda: bidirectional_astar(G, 0, G.n_nodes - 1, 'combined'),
+        )
+        executor = BoundedExecutor(workers=1, max_queue=1)
+        # The small city is searched in fewer pops than a check is made after
+        with mock.patch.object(landmarks, 'DEADLINE_CHECK_POPS', 1):
+            for search in searches:
+                with self.assertRaises(DeadlineExceeded):
+                    asyncio.run(executor.run(lambda: (time.sleep(0.05), search()), timeout=0.01))
+                time.sleep(0.1)
+        self.assertEqual(executor.queue_depth, 0)
+        self.assertEqual(executor.stats['abandoned'], 2)
+
+    @override_settings(CACHES={'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_route_cache_waits_end_at_the_deadline(self):
+        executor = BoundedExecutor(workers=2, max_queue=2)
+        cache = RouteCache()
+        started, release = threading.Event(), threading.Event()
+
+        def slow_compute():
+            started.set()
+            release.wait(5)
+            return ['route']
+
+        # Another thread of this worker computes the route
+        leader = threading.Thread(target=cache.get_or_compute, args=('key', slow_compute))
+        leader.start()
+        started.wait(1)
+        # Another worker holds the shared lock of the route
+        shared = RouteCache(backend='shared')
+        caches['shared'].add('other:lock', 1, timeout=60)
+
+        try:
+            for waiter in (lambda: cache.get_or_compute('key', list), lambda: shared.get_or_compute('other', list)):
+                start = time.monotonic()
+                with self.assertRaises(DeadlineExceeded):
+                    asyncio.run(executor.run(waiter, timeout=0.1))
+                time.sleep(0.2)
+                # The waiting job gave its slot back long before the 30 s lock timeout
+                self.assertEqual(executor.queue_depth, 0)
+                self.assertLess(time.monotonic() - start, 1)
+            self.assertEqual(executor.stats['abandoned'], 2)
+        finally:
+            release.set()
+            leader.join()
+            caches['shared'].clear()
+
+    def test_no_deadline_outside_the_executor(self):
+        check_deadline()
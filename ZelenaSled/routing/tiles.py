@@ -0,0 +1,340 @@
+import math
+import os
+import shutil
+import struct
+import threading
+import zlib
+
+import h3
+import numpy as np
+import shapely
+from pyproj import Transformer
+
+from django.conf import settings
+
+from .h3_store import H3LayerStore, cell_parents, latlng_to_cells
+from .layers import get_graph_registry, load_layer
+from .preprocessing import get_data_dir
+
+
+DEFAULTS = {
+    # Directory of the rendered tiles, <data dir>/tiles by default
+    'CACHE_DIR': None,
+    # Zoom levels served
+    'MIN_ZOOM': 10,
+    'MAX_ZOOM': 18,
+    # Highest zoom rendered ahead by the seed_tiles command
+    'SEED_MAX_ZOOM': 15,
+    # Seconds browsers use a tile before asking again with its ETag
+    'MAX_AGE': 3600,
+    # Noise is drawn from its hexagons from this zoom on, below from H3 cells of the hexagon centres
+    'NOISE_POLYGON_ZOOM': 14,
+}
+
+TILE_SIZE = 256
+
+# Bump when the rendering or the colors change, so cached tiles and their ETags change too
+TILE_STYLE_VERSION = 1
+
+# Colors of the layers: values in the range are interpolated between the color stops, from low to high
+LAYER_STYLES = {
+    'ndvi': {'range': (0.0, 0.8), 'colors': ((140, 81, 10), (223, 194, 125), (128, 205, 193), (1, 102, 94))},
+    'heat': {'range': (25.0, 45.0), 'colors': ((255, 255, 178), (254, 204, 92), (253, 141, 60), (227, 26, 28))},
+    'noise': {'range': (40.0, 80.0), 'colors': ((26, 150, 65), (166, 217, 106), (253, 174, 97), (215, 25, 28))},
+}
+
+# Opacity of the colored pixels, pixels without data are transparent
+ALPHA = 170
+
+# H3 resolution the noise hexagon centres are binned into for lower zooms, about two hexagons per cell
+NOISE_H3_RESOLUTION = 11
+
+# Resolution of the cells whose outlines bound the data of an H3 layer
+BOUNDS_RESOLUTION = 5
+
+EARTH_CIRCUMFERENCE_M = 2 * math.pi * 6378137
+
+
+def get_tile_settings():
+    return {**DEFAULTS, **getattr(settings, 'ROUTING_TILES', {})}
+
+
+def get_tile_cache_dir():
+    return get_tile_settings()['CACHE_DIR'] or os.path.join(get_data_dir(), 'tiles')
+
+
+def _tile_lon(t):
+    return np.asarray(t) * 360 - 180
+
+
+def _tile_lat(t):
+    return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(t)))))
+
+
+def tile_bounds(z, x, y):
+    """Returns (min_lon, min_lat, max_lon, max_lat) of a Web Mercator tile."""
+
+    n = 2 ** z
+    return (float(_tile_lon(x / n)), float(_tile_lat((y + 1) / n)), float(_tile_lon((x + 1) / n)),
+            float(_tile_lat(y / n)))
+
+
+def tiles_in_bbox(bbox, z):
+    """Returns the (x, y) of the tiles at a zoom covering a (min_lon, min_lat, max_lon, max_lat) box."""
+
+    min_lon, min_lat, max_lon, max_lat = bbox
+    n = 2 ** z
+
+    def tile_x(lon):
+        return min(max(int((lon + 180) / 360 * n), 0), n - 1)
+
+    def tile_y(lat):
+        lat = math.radians(lat)
+        return min(max(int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n), 0), n - 1)
+
+    return [
+        (x, y)
+        for x in range(tile_x(min_lon), tile_x(max_lon) + 1)
+        for y in range(tile_y(max_lat), tile_y(min_lat) + 1)
+    ]
+
+
+def tile_pixels(z, x, y, step=1):
+    """Returns (lon, lat) grids of the centres of the step x step pixel blocks of a tile, one row per block row."""
+
+    n = 2 ** z * TILE_SIZE
+    offsets = np.arange(step / 2, TILE_SIZE, step)
+    return np.meshgrid(_tile_lon((x * TILE_SIZE + offsets) / n), _tile_lat((y * TILE_SIZE + offsets) / n))
+
+
+def pixel_size_m(z, lat):
+    return EARTH_CIRCUMFERENCE_M * math.cos(math.radians(lat)) / (TILE_SIZE * 2 ** z)
+
+
+def tile_resolution(z, lat, finest):
+    """
+    Returns the H3 resolution drawn at a zoom and the size of the pixel blocks sampled.
+
+    The finest resolution whose cells are at least two pixels wide is used,
+    so lower zooms show coarser parent cells instead of unreadable specks.
+    Where cells are many pixels wide, blocks of pixels share one lookup.
+
+    Returns:
+        tuple: (resolution, block size in pixels: 1, 2 or 4).
+    """
+
+    pixel = pixel_size_m(z, lat)
+    resolution = next(
+        (r for r in range(finest, -1, -1) if h3.average_hexagon_edge_length(r, 'm') >= 2 * pixel), 0,
+    )
+    edge_px = h3.average_hexagon_edge_length(resolution, 'm') / pixel
+    step = next(step for step in (4, 2, 1) if edge_px >= 4 * step or step == 1)
+    return resolution, step
+
+
+def aggregate_cells(cells, values, resolution):
+    """Returns an H3LayerStore with the mean value of the cells under every parent cell at a coarser resolution."""
+
+    values = np.asarray(values, dtype=np.float64)
+    measured = ~np.isnan(values)
+    parents, groups = np.unique(cell_parents(np.asarray(cells)[measured], resolution), return_inverse=True)
+    sums = np.bincount(groups, values[measured], len(parents))
+    counts = np.bincount(groups, minlength=len(parents))
+    return H3LayerStore(parents, (sums / counts).astype(np.float32), resolution)
+
+
+def colorize(values, style):
+    """Returns an RGBA uint8 image of values, transparent where they are NaN."""
+
+    low, high = style['range']
+    colors = np.asarray(style['colors'], dtype=np.float64)
+    missing = np.isnan(values)
+    t = np.clip((np.where(missing, low, values) - low) / (high - low), 0, 1) * (len(colors) - 1)
+
+    rgba = np.zeros((*values.shape, 4), dtype=np.uint8)
+    stops = np.arange(len(colors))
+    for channel in range(3):
+        rgba[..., channel] = np.round(np.interp(t, stops, colors[:, channel]))
+    rgba[..., 3] = np.where(missing, 0, ALPHA)
+    return rgba
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def encode_png(rgba):
+    """Encodes an RGBA uint8 image as a PNG file."""
+
+    height, width, _ = rgba.shape
+    # Every row starts with its filter type, 0 for none
+    rows = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgba.reshape(height, width * 4)
+    return b''.join((
+        b'\x89PNG\r\n\x1a\n',
+        _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        _png_chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)),
+        _png_chunk(b'IEND', b''),
+    ))
+
+
+class LayerTiles:
+    """
+    Renders the map tiles of one version of a data layer.
+
+    Every pixel is looked up in the H3 store of the resolution fitting the
+    zoom (see ``tile_resolution``). Stores of coarser resolutions hold the
+    mean of the layer's cells under every parent cell and are built on first
+    use. Noise is drawn from its hexagons at high zooms and from H3 cells
+    binning the hexagon centres below.
+    """
+
+    def __init__(self, layer, version, data):
+        self.layer = layer
+        self.version = version
+        self.data = data
+        self._stores = {}
+        self._bounds = None
+        self._lock = threading.Lock()
+
+    @property
+    def finest_resolution(self):
+        return NOISE_H3_RESOLUTION if self.layer == 'noise' else self.data.resolution
+
+    def store(self, resolution):
+        """Returns the H3LayerStore of the layer at a resolution, building it on first use."""
+
+        with self._lock:
+            if resolution not in self._stores:
+                self._stores[resolution] = self._build_store(resolution)
+            return self._stores[resolution]
+
+    def _build_store(self, resolution):
+        if self.layer != 'noise':
+            base = self.data
+        else:
+            base = self._stores.get(NOISE_H3_RESOLUTION)
+            if base is None:
+                base = self._stores[NOISE_H3_RESOLUTION] = self._noise_cells()
+
+        if resolution == base.resolution:
+            return base
+        return aggregate_cells(base.cells, base.values, resolution)
+
+    def _noise_cells(self):
+        # Noise levels binned by the H3 cell of every hexagon centre
+        centres = shapely.centroid(self.data.polygons)
+        to_lonlat = Transformer.from_crs(self.data.crs, "EPSG:4326", always_xy=True)
+        lon, lat = to_lonlat.transform(shapely.get_x(centres), shapely.get_y(centres))
+        return aggregate_cells(latlng_to_cells(lat, lon, NOISE_H3_RESOLUTION), self.data.values, NOISE_H3_RESOLUTION)
+
+    @property
+    def bounds(self):
+        """(min_lon, min_lat, max_lon, max_lat) around the data, tiles outside are empty."""
+
+        if self._bounds is None:
+            if self.layer == 'noise':
+                to_lonlat = Transformer.from_crs(self.data.crs, "EPSG:4326", always_xy=True)
+                min_x, min_y, max_x, max_y = shapely.total_bounds(self.data.polygons)
+                self._bounds = to_lonlat.transform_bounds(min_x, min_y, max_x, max_y)
+            else:
+                lat_lon = np.array([
+                    point for cell in np.unique(cell_parents(self.data.cells, BOUNDS_RESOLUTION))
+                    for point in h3.cell_to_boundary(h3.int_to_str(int(cell)))
+                ]).reshape(-1, 2)
+                if not len(lat_lon):
+                    lat_lon = np.zeros((1, 2))
+                self._bounds = (*lat_lon.min(axis=0)[::-1], *lat_lon.max(axis=0)[::-1])
+        return self._bounds
+
+    def render(self, z, x, y):
+        """Returns the RGBA image of a tile."""
+
+        min_lon, min_lat, max_lon, max_lat = tile_bounds(z, x, y)
+        b_min_lon, b_min_lat, b_max_lon, b_max_lat = self.bounds
+        if min_lon > b_max_lon or max_lon < b_min_lon or min_lat > b_max_lat or max_lat < b_min_lat:
+            return np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+
+        if self.layer == 'noise' and z >= get_tile_settings()['NOISE_POLYGON_ZOOM']:
+            values = self._polygon_values(*tile_pixels(z, x, y))
+        else:
+            resolution, step = tile_resolution(z, (min_lat + max_lat) / 2, self.finest_resolution)
+            lon, lat = tile_pixels(z, x, y, step)
+            values = self.store(resolution).lookup_latlng(lat.ravel(), lon.ravel()).reshape(lat.shape)
+            values = np.repeat(np.repeat(values, step, axis=0), step, axis=1)
+        return colorize(values, LAYER_STYLES[self.layer])
+
+    def _polygon_values(self, lon, lat):
+        # Mean level of the hexagons every pixel centre lies in
+        x, y = self.data.to_metric.transform(lon.ravel(), lat.ravel())
+        point_index, polygon_index = self.data.tree.query(shapely.points(x, y), predicate='within')
+        sums = np.bincount(point_index, self.data.values[polygon_index], lon.size)
+        counts = np.bincount(point_index, minlength=lon.size)
+        with np.errstate(invalid='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan).reshape(lon.shape)
+
+
+_layer_tiles = {}
+_layer_tiles_lock = threading.Lock()
+
+
+def tile_version(layer):
+    """Returns the version of a layer's tiles, from the layer file and the style, or None without the file."""
+
+    version = get_graph_registry().file_versions(get_data_dir(), [layer]).get(layer)
+    return f'{version}-{TILE_STYLE_VERSION}' if version is not None else None
+
+
+def get_layer_tiles(layer, version):
+    """Returns the LayerTiles of a version of a layer, loading the layer when its file changed."""
+
+    source = _layer_tiles.get(layer)
+    if source is None or source.version != version:
+        with _layer_tiles_lock:
+            source = _layer_tiles.get(layer)
+            if source is None or source.version != version:
+                source = _layer_tiles[layer] = LayerTiles(layer, version, load_layer(get_data_dir(), layer))
+                remove_old_tiles(layer, version)
+    return source
+
+
+def tile_path(layer, version, z, x, y):
+    return os.path.join(get_tile_cache_dir(), layer, version, str(z), str(x), f'{y}.png')
+
+
+def remove_old_tiles(layer, version):
+    layer_dir = os.path.join(get_tile_cache_dir(), layer)
+    if os.path.isdir(layer_dir):
+        for name in os.listdir(layer_dir):
+            if name != version:
+                shutil.rmtree(os.path.join(layer_dir, name), ignore_errors=True)
+
+
+def get_tile(layer, version, z, x, y, refresh=False):
+    """
+    Returns a PNG tile of a data layer, rendered on first request and then read from the disk cache.
+
+    Args:
+        layer (str): 'ndvi', 'heat' or 'noise'.
+        version (str): Version of the layer's tiles, see ``tile_version``.
+        z, x, y (int): Tile coordinates.
+        refresh (bool): Render the tile again even if it is cached.
+
+    Returns:
+        bytes: The PNG file.
+    """
+
+    path = tile_path(layer, version, z, x, y)
+    if not refresh and os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    png = encode_png(get_layer_tiles(layer, version).render(z, x, y))
+
+    # Written next to the target and renamed, so other workers never read half a tile
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(png)
+    os.replace(tmp_path, path)
+    return png
@@ -0,0 +1,233 @@
+import os
+import re
+import threading
+from datetime import datetime, time
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from django.conf import settings
+
+from .csr_graph import search_cost
+from .landmarks import Landmarks
+
+
+DEFAULTS = {
+    # Time zone of the slice hours and of departure times given without an offset
+    'TIME_ZONE': 'Europe/Ljubljana',
+    # Departure times are rounded to this many minutes, so nearby requests share a graph view and cached routes
+    'ROUND_MINUTES': 15,
+    # Graph views of different departure times kept per graph and process
+    'CACHED_VIEWS': 4,
+}
+
+# Layers with time slices and the weight columns computed for every slice
+SLICED_COLUMNS = {
+    'heat': ('heat_sum', 'heat_len', 'heat_cost'),
+    'noise': ('noise', 'noise_coverage', 'combined', 'noise_cost'),
+}
+
+# Search cost columns of sliced layers that get their own landmarks
+SLICED_LANDMARKS = {
+    'noise': ('combined',),
+}
+
+# Slice files are named like the layer file with the hour (and minutes)
+# before the extension, e.g. heat_h3.h14.zip or ....areas.h0730.geojson
+SLICE_HOUR = re.compile(r'h(\d{2})(\d{2})?')
+
+
+def get_time_slice_settings():
+    return {**DEFAULTS, **getattr(settings, 'ROUTING_TIME_SLICES', {})}
+
+
+class TimeSlices:
+    """
+    Time-of-day values of the weight columns of one layer.
+
+    Every column is an edge x slice float32 matrix, so the values of a
+    path's edges at all hours are a single row gather. Between two slices
+    values are interpolated linearly, wrapping around midnight. Landmarks of
+    sliced cost columns are selected on the lowest cost of every edge over
+    all slices, so their bounds hold at any hour.
+    """
+
+    def __init__(self, hours, columns, landmarks=None):
+        self.hours = hours
+        self.columns = columns
+        self.landmarks = landmarks if landmarks is not None else {}
+
+    def __len__(self):
+        return len(self.hours)
+
+    def interpolation(self, hour):
+        """
+        Returns the slices around an hour of the day and the weight of the later one.
+
+        Returns:
+            tuple: (earlier slice, later slice, weight of the later slice between 0 and 1).
+        """
+
+        n_slices = len(self.hours)
+        if n_slices == 1:
+            return 0, 0, 0.0
+
+        later = int(np.searchsorted(self.hours, hour, side='right')) % n_slices
+        earlier = (later - 1) % n_slices
+        span = (self.hours[later] - self.hours[earlier]) % 24 or 24
+        return earlier, later, float((hour - self.hours[earlier]) % 24 / span)
+
+    def columns_at(self, hour):
+        """Returns {column: float32 array} of every sliced column at an hour of the day."""
+
+        earlier, later, weight = self.interpolation(hour)
+        if weight == 0:
+            return {column: np.ascontiguousarray(values[:, earlier]) for column, values in self.columns.items()}
+        return {
+            column: ((1 - weight) * values[:, earlier] + weight * values[:, later]).astype(np.float32)
+            for column, values in self.columns.items()
+        }
+
+    @staticmethod
+    def paths(directory, layer, columns):
+        return (
+            os.path.join(directory, f'ts_{layer}_hours.npy'),
+            {column: os.path.join(directory, f'ts_{layer}_{column}.npy') for column in columns},
+        )
+
+    def save(self, directory, layer):
+        hours_path, column_paths = self.paths(directory, layer, self.columns)
+        np.save(hours_path, self.hours)
+        for column, path in column_paths.items():
+            np.save(path, self.columns[column])
+        for column, landmarks in self.landmarks.items():
+            landmarks.save(directory, f'ts_{layer}_{column}')
+
+    @classmethod
+    def load(cls, directory, layer, columns, landmarks=(), mmap_mode=None):
+        hours_path, column_paths = cls.paths(directory, layer, columns)
+        return cls(
+            np.load(hours_path),
+            {column: np.load(path, mmap_mode=mmap_mode) for column, path in column_paths.items()},
+            {column: Landmarks.load(directory, f'ts_{layer}_{column}', mmap_mode=mmap_mode) for column in landmarks},
+        )
+
+
+def slice_files(data_dir, layer_files):
+    """
+    Finds the time slice files of layers in a data directory.
+
+    Args:
+        data_dir (str): Data directory.
+        layer_files (dict): {layer: file name} of the layers that can have slices.
+
+    Returns:
+        dict: {layer: [(hour, file name), ...]} sorted by hour, layers without slices are left out.
+    """
+
+    names = os.listdir(data_dir) if os.path.isdir(data_dir) else []
+    slices = {}
+    for layer, file_name in layer_files.items():
+        if layer not in SLICED_COLUMNS:
+            continue
+        stem, extension = os.path.splitext(file_name)
+        for name in names:
+            if not (name.startswith(f'{stem}.') and name.endswith(extension)):
+                continue
+            match = SLICE_HOUR.fullmatch(name[len(stem) + 1:len(name) - len(extension)])
+            if match and int(match.group(1)) < 24 and int(match.group(2) or 0) < 60:
+                hour = int(match.group(1)) + int(match.group(2) or 0) / 60
+                slices.setdefault(layer, []).append((hour, name))
+    return {layer: sorted(files) for layer, files in slices.items()}
+
+
+def parse_departure_time(value):
+    """
+    Returns the hour of the day of a departure time, rounded to ``ROUTING_TIME_SLICES['ROUND_MINUTES']``.
+
+    Args:
+        value: 'HH:MM', an ISO 8601 date and time (converted to
+            ``ROUTING_TIME_SLICES['TIME_ZONE']`` if it has an offset) or an
+            hour between 0 and 24 as a number. None for no departure time.
+
+    Returns:
+        float: Hour between 0 and 24, or None.
+
+    Raises:
+        ValueError: If the departure time is not valid.
+    """
+
+    if value is None:
+        return None
+
+    config = get_time_slice_settings()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if not 0 <= value < 24:
+            raise ValueError("Departure hour must be between 0 and 24")
+        hour = float(value)
+    elif isinstance(value, str):
+        try:
+            moment = datetime.fromisoformat(value)
+            if moment.tzinfo is not None:
+                moment = moment.astimezone(ZoneInfo(config['TIME_ZONE']))
+            moment = moment.time()
+        except ValueError:
+            try:
+                moment = time.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f"Unknown departure time: {value} (use HH:MM or an ISO 8601 date and time)")
+        hour = moment.hour + moment.minute / 60 + moment.second / 3600
+    else:
+        raise ValueError("Departure time must be a string or an hour")
+
+    step = config['ROUND_MINUTES'] / 60
+    return round(hour / step) * step % 24 if step > 0 else hour
+
+
+_views_lock = threading.Lock()
+
+
+def graph_at(G, hour, layers):
+    """
+    Returns a view of a graph with the time slices of some layers at an hour of the day.
+
+    The view shares every array of the graph except the interpolated
+    columns, and gets the landmarks of the slices, so searches on it are
+    as fast as on the graph. Views are cached per graph.
+
+    Args:
+        G (CSRGraph): Graph with ``time_slices``.
+        hour (float): Hour of the day, None for the graph itself.
+        layers (tuple): Layers the request depends on, e.g. ('noise',).
+
+    Returns:
+        CSRGraph: The view, or the graph itself if none of the layers has time slices.
+    """
+
+    layers = tuple(layer for layer in layers if layer in G.time_slices)
+    if hour is None or not layers:
+        return G
+
+    key = (hour, layers)
+    with _views_lock:
+        view = G._time_views.get(key)
+        if view is not None:
+            G._time_views.move_to_end(key)
+            return view
+
+    weights, landmarks = {}, {}
+    for layer in layers:
+        weights.update(G.time_slices[layer].columns_at(hour))
+        landmarks.update(G.time_slices[layer].landmarks)
+    costs = {'combined': search_cost(weights['combined'])} if 'combined' in weights else {}
+
+    view = G.replace(weights=weights, costs=costs, landmarks=landmarks)
+    view.version = f'{G.version}@{int(hour):02d}{round(hour % 1 * 60):02d}'
+    view.time_of_day = hour
+    view.sliced_layers = layers
+
+    with _views_lock:
+        G._time_views[key] = view
+        while len(G._time_views) > get_time_slice_settings()['CACHED_VIEWS']:
+            G._time_views.popitem(last=False)
+    return view
@@ -1,431 +1,671 @@
 import json
-from itertools import islice
-import os
-from itertools import combinations
 import traceback
 
-import geopandas as gpd
-import h3
-import networkx as nx
-import numpy as np
-import osmnx as ox
-from shapely.geometry import LineString
-
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.cache import patch_cache_control
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
 from django.conf import settings
 
 from django.shortcuts import render
 
+from .alternatives import alternative_paths, get_engine_name
+from .async_executor import DeadlineExceeded, ExecutorSaturated, get_deadline, get_routing_executor
+from .batch import batch_tasks, run_batch
+from .corridor import corridor_search
+from .diversity import get_diversity_settings, length_quality, select_diverse
+from .exposure import path_average, path_exposure, path_measured_average
+from .isochrone import isochrone_cache_key, isochrone_geojson, parse_isochrone_options, reachable_region
+from .layers import enabled_commute_modes, get_graph_registry, get_graph_settings
+from .metrics import count, describe, get_metrics_settings, instrument, registry, set_labels, stage
+from .multi_criteria import parse_weights, pareto_paths, weighted_path, weights_key
+from .noise import MAX_UNMEASURED_M, get_noise_index
+from .route_cache import ALL_LAYERS, get_route_cache, route_cache_key, routing_mode_layers, set_request_coords
+from .serialize import feature_collection, parse_output_options, parse_simplify_options, to_json
+from .preprocessing import GRAPH_FILES
+from .spatial_index import end_node, snapped_edge_path, split_path_at_snaps, start_node
+from .tiles import LAYER_STYLES, get_tile, get_tile_settings, tile_version
+from .time_slices import graph_at, parse_departure_time
+
 def home(request):
     return render(request, 'index.html') 
 
 
-def convert_to_digraph(G_multi):
-    '''Convert MultiGraph to DiGraph as the server is inizialized'''
+# Routing modes of the preference buttons, None for the shortest paths
+ROUTING_MODES = (None, 'noise', 'vegetation', 'heat')
 
-    G_walk = nx.DiGraph()
-    G_walk.graph["crs"] = "EPSG:4326"
-    for u, v, data in G_multi.edges(data=True):
-        w = data.get('length', 1)
-        if G_walk.has_edge(u, v):
-            if G_walk[u][v]['length'] > w:
-                # Update the existing edge with the new edge data
-                G_walk[u][v].update(data)
-        else:
-            # Add the edge with the new data
-            G_walk.add_edge(u, v, **data)
+# Ljubljana as defined by OpenStreetMaps, (min_lon, min_lat, max_lon, max_lat)
+LJUBLJANA_BBOX = (14.408617, 45.974064, 14.755332, 46.145997)
 
-    # Also copy node data from the MultiDiGraph to the DiGraph
-    for node, data in G_multi.nodes(data=True):
-        G_walk.add_node(node, **data)
-    
-    return G_walk
 
-def add_noise_to_edges(G_digraph, noise_data):
+def is_within_bbox(coords):
+    """Check if the coordinates are within the bounding box where our models work."""
+
+    lat, lon = coords
+    min_lon, min_lat, max_lon, max_lat = LJUBLJANA_BBOX
+    return min_lon <= lon <= max_lon and min_lat <= lat <= max_lat
+
+
+def build_path_data(G_graph, paths, origin_coords, destination_coords, snaps=None):
     """
-    Adds noise data to the edges of a directed graph.
-    
+    Returns the properties and (lon, lat) coordinates of each path.
+
     Args:
-        G_digraph (nx.DiGraph): The directed graph to which noise data will be added.
-        noise_data (gpd.GeoDataFrame): GeoDataFrame containing noise data with 'geometry' and 'noise_level'.
+        G_graph (CSRGraph): Graph the paths were found in.
+        paths (list): Paths as arrays of node indices.
+        origin_coords (tuple): Requested (lat, lon) of the origin.
+        destination_coords (tuple): Requested (lat, lon) of the destination.
+        snaps (list): Origin and destination EdgeSnap, if they were snapped onto edges.
+
+    Returns:
+        list: List of dicts, one per path.
     """
 
-    edges_gdf = ox.graph_to_gdfs(G_digraph, nodes=False, edges=True)
-    edges_with_noise = gpd.sjoin(edges_gdf, noise_data[['laeq', 'geometry']], how='left', predicate='intersects')
-    noise_per_edge = edges_with_noise.groupby(['u', 'v', 'key'])['laeq'].mean().reset_index()
-
-    # Attach averaged noise back to the graph
-    for _, row in noise_per_edge.iterrows():
-        u, v, key = row['u'], row['v'], row['key']
-        G_digraph[u][v][key]['noise'] = row['laeq']
-
-    return G_digraph
-#46.060936 14.528119
-#46.052540 14.532967
-def convert_to_digraph_by_combined_weight(G_multi, alpha=0.5, beta=0.5):
-    G_simple = nx.DiGraph()
-    G_simple.graph["crs"] = "EPSG:4326"
-
-    # Copy all nodes with their attributes
-    for node, attrs in G_multi.nodes(data=True):
-        G_simple.add_node(node, **attrs)
-
-    # Process edges, keeping only the best one (lowest combined weight)
-    for u, v, data in G_multi.edges(data=True):
-        length = data.get("length", 0)
-        noise = data.get("noise", 0)
-        combined = alpha * length + beta * noise
-
-        edge_attrs = data.copy()
-        edge_attrs["combined"] = combined
-
-        if G_simple.has_edge(u, v):
-            if combined < G_simple[u][v]["combined"]:
-                G_simple[u][v].update(edge_attrs)
+    path_data = []
+    for i, path in enumerate(paths):
+        if snaps:
+            coords, length = split_path_at_snaps(G_graph, path, *snaps)
         else:
-            G_simple.add_edge(u, v, **edge_attrs)
+            coords = G_graph.path_coordinates(path)
+            length = G_graph.path_weight(path, 'length')
+        path_data.append({
+            'path_num': i + 1,
+            'origin_coords': origin_coords,
+            'destination_coords': destination_coords,
+            'length_m': length,
+            'coordinates': coords,
+        })
+    return path_data
+
+
+def compute_paths(G_graph, orig_node, dest_node, snaps, commute_mode, routing_mode, origin_coords, destination_coords,
+                  weights=None, pareto=False, noise_index=None):
+    """
+    Computes the best 3 paths between two snapped points.
 
-    return G_simple
+    With ``weights`` the path minimising the weighted sum of length, noise,
+    vegetation and heat costs is searched directly, or with ``pareto`` the
+    paths that no other path beats on all the weighted criteria. Noise paths
+    are scored against ``noise_index``, the shipped measurements by default.
 
-def assign_average_noise(G):
-    # Collect all valid noise values that exist in the graph (excluding 'nan' values)
-    noise_values = [d['noise'] for u, v, d in G.edges(data=True) if 'noise' in d]
+    Returns:
+        list: Properties and coordinates of the paths (see ``build_path_data``),
+        or None if there is not enough noise data to pick them.
+    """
 
-    # Remove 'nan' values from the list (if there are any)
-    valid_noise_values = [noise for noise in noise_values if not np.isnan(noise)]
+    direct = snapped_edge_path(G_graph, *snaps) if snaps else None
+
+    def find_paths(search):
+        # Origin and destination on the same street: the piece between them is the only path
+        if direct is not None:
+            return [direct]
+        return corridor_search(G_graph, orig_node, dest_node, search)
+
+    if weights is not None:
+        def search(G, o, d):
+            if pareto:
+                return pareto_paths(G, o, d, weights)
+            path = weighted_path(G, o, d, weights)
+            return [path] if path is not None else []
+
+        with stage('search'):
+            paths = find_paths(search)
+        count('candidate_paths', len(paths))
+        if not paths:
+            raise RouteRequestError("No path found between chosen locations", status=404)
+
+        with stage('geometry'):
+            path_data = build_path_data(G_graph, paths, origin_coords, destination_coords, snaps)
+        with stage('score'):
+            for path, path_info in zip(paths, path_data):
+                path_info['average_ndvi'] = path_exposure(G_graph, path, 'ndvi')
+                path_info['average_heat'] = path_exposure(G_graph, path, 'heat')
+                path_info['average_noise'] = path_average(G_graph, path, 'noise')
+
+    elif routing_mode == "noise":
+        with stage('search'):
+            candidate_paths = find_paths(lambda G, o, d: alternative_paths(
+                G, o, d, 'combined', commute_mode, routing_mode
+            ))
+        count('candidate_paths', len(candidate_paths))
+        with stage('geometry'):
+            path_data = build_path_data(G_graph, candidate_paths, origin_coords, destination_coords, snaps)
+
+        # keep the quietest paths whose geometry is measured densely enough
+        with stage('score'):
+            if noise_index is None:
+                noise_index = get_noise_index()
+            path_data = get_top_3_quietest_paths(
+                path_data, candidate_paths, noise_index,
+                G_graph if 'noise' in G_graph.sliced_layers else None,
+            )
+        if not path_data:
+            return None
 
-    # Check if we have any valid noise values
-    if valid_noise_values:
-        average_noise = np.mean(valid_noise_values)
     else:
-        average_noise = 80  # Set default noise value if no valid data found
+        # Get candidate paths in a corridor around the trip with the alternative routes engine configured for this mode
+        with stage('search'):
+            paths = find_paths(lambda G, o, d: alternative_paths(
+                G, o, d, 'length', commute_mode, routing_mode
+            ))
+        count('candidate_paths', len(paths))
 
-    for u, v, d in G.edges(data=True):
-        if 'noise' not in d or np.isnan(d['noise']):
-            d['noise'] = average_noise
+        # Coordinates and lengths of the paths
+        with stage('geometry'):
+            path_data = build_path_data(G_graph, paths, origin_coords, destination_coords, snaps)
 
-    return G
+        # get top 3 paths based on routing mode
+        with stage('score'):
+            if routing_mode == "vegetation":
+                for path, path_info in zip(paths, path_data):
+                    path_info['average_ndvi'] = path_exposure(G_graph, path, 'ndvi')
 
+                path_data = get_top_3_ndvi(path_data, paths)
 
-# # Load the graph once when the server starts
-# G_multi_walk = convert_to_digraph(ox.load_graphml(os.path.join(settings.BASE_DIR, 'routing', 'data','ljubljana_walk.graphml')))
-# G_multi_bike= convert_to_digraph(ox.load_graphml(os.path.join(settings.BASE_DIR, 'routing', 'data','ljubljana_bike.graphml')))
+            elif routing_mode == "heat":
+                for path, path_info in zip(paths, path_data):
+                    path_info['average_ndvi'] = path_exposure(G_graph, path, 'heat')
 
-G_multi_walk = ox.load_graphml(os.path.join(settings.BASE_DIR, 'routing', 'data','ljubljana_walk.graphml'))
-G_multi_bike= ox.load_graphml(os.path.join(settings.BASE_DIR, 'routing', 'data','ljubljana_bike.graphml'))
+                # cooler paths are better
+                path_data = get_top_3_ndvi(path_data, paths, highest=False)
 
-#add noise data
-noise_data = gpd.read_file(os.path.join(settings.BASE_DIR, 'routing', 'data','Slovenia_Osrednjeslovenska_Ljubljana.areas.geojson'))
+            elif routing_mode is None:
 
-G_multi_walk = add_noise_to_edges(G_multi_walk, noise_data)
-G_multi_bike = add_noise_to_edges(G_multi_bike, noise_data)
+                # Get the indexes of the 3 shortest paths based on length
+                sorted_indexes = sorted(range(len(path_data)), key=lambda i: path_data[i]['length_m'])
 
-G_multi_walk = assign_average_noise(G_multi_walk)
-G_multi_bike = assign_average_noise(G_multi_bike)
+                # Select the top 3 shortest paths by using the sorted indexes
+                path_data = [path_data[i] for i in sorted_indexes[:get_diversity_settings()['K']]]
 
-G_multi_walk = convert_to_digraph_by_combined_weight(G_multi_walk, alpha=0.6, beta=0.4)
-G_multi_bike = convert_to_digraph_by_combined_weight(G_multi_bike, alpha=0.6, beta=0.4)
+    return path_data
 
 
-def is_within_bbox(coords):
-    """Check if the coordinates are within the bounding box where our models work."""
+class RouteRequestError(Exception):
+    """Invalid route request, reported to the client with the given HTTP status."""
 
-    lat, lon = coords
-    min_lon, min_lat, max_lon, max_lat = (14.408617, 45.974064, 14.755332, 46.145997) # Ljubljana as defined by OpenStreetMaps
-    return min_lon <= lon <= max_lon and min_lat <= lat <= max_lat
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def get_graph(commute_mode):
+    """Returns the routing graph of a commute mode, loading it on first use (see layers.py)."""
+
+    if commute_mode not in GRAPH_FILES:
+        raise RouteRequestError("Commute mode is required (walk or bike)")
+
+    if commute_mode not in enabled_commute_modes():
+        raise RouteRequestError(
+            f"Commute mode {commute_mode} is not served here (use {' or '.join(enabled_commute_modes())})", status=404,
+        )
+
+    return get_graph_registry().get(commute_mode)
+
+
+def load_graphs():
+    """Starts loading the graphs of the enabled commute modes, called when the server starts (``ROUTING_GRAPHS``)."""
+
+    config = get_graph_settings()
+    if config['WARM_UP']:
+        get_graph_registry().warm_up(wait=config['WAIT'])
+
+
+def plan_route(origin_coords, destination_coords, commute_mode, routing_mode, weights=None, pareto=False,
+               precision=None, geometry_format=None, departure_time=None, simplify=None, zoom=None):
+    """
+    Validates a route request and returns the best 3 paths.
+
+    Args:
+        origin_coords (list): (lat, lon) of the origin.
+        destination_coords (list): (lat, lon) of the destination.
+        commute_mode (str): 'walk' or 'bike'.
+        routing_mode (str): 'noise', 'vegetation', 'heat' or None.
+        weights (dict): Weights of 'length', 'noise', 'vegetation' and 'heat'
+            for a multi-criteria search, which replaces the routing mode.
+        pareto (bool): Return the Pareto-optimal paths of the weighted criteria.
+        precision (int): Decimals of the coordinates, ``ROUTING_GEOJSON['PRECISION']`` by default.
+        geometry_format (str): 'geojson' for LineString geometries or 'polyline'
+            for encoded polylines, ``ROUTING_GEOJSON['FORMAT']`` by default.
+        departure_time (str): 'HH:MM' or an ISO 8601 date and time. Heat and
+            noise are then taken from their time slices at that hour, if the
+            data has any (see time_slices.py).
+        simplify (float): Douglas-Peucker tolerance in meters of the geometries,
+            ``ROUTING_GEOJSON['SIMPLIFY']`` by default.
+        zoom (int): Map zoom level the paths are drawn at, for a tolerance of a pixel instead.
+
+    Returns:
+        dict: GeoJSON FeatureCollection of the paths.
+
+    Raises:
+        RouteRequestError: If the request is invalid or can't be answered.
+    """
+
+    if not origin_coords or not destination_coords:
+        raise RouteRequestError("Origin and destination coordinates are required")
+    
+    if not is_within_bbox(destination_coords):
+        raise RouteRequestError("Destination coordinates are outside the allowed area (Ljubljana)")
+
+    if not is_within_bbox(origin_coords):
+        raise RouteRequestError("Starting coordinates are outside the allowed area (Ljubljana)")
+
+
+    if weights is not None:
+        try:
+            weights = parse_weights(weights)
+        except ValueError as e:
+            raise RouteRequestError(str(e))
+        routing_mode = f'weighted:{weights_key(weights, bool(pareto))}'
+
+    try:
+        precision, geometry_format = parse_output_options(precision, geometry_format)
+        tolerance_m = parse_simplify_options(simplify, zoom, origin_coords[0])
+        hour = parse_departure_time(departure_time)
+    except ValueError as e:
+        raise RouteRequestError(str(e))
+
+    # Ensure the coordinates are in the correct format
+    origin_coords = tuple(origin_coords)
+    destination_coords = tuple(destination_coords)
+
+    # Prepare graph and compute the paths, with the layers at the departure hour
+    G_graph = graph_at(get_graph(commute_mode), hour, routing_mode_layers(routing_mode))
+
+    # Label the request metrics, unknown modes share one label so clients can't add labels
+    if weights is not None:
+        set_labels(commute_mode=commute_mode, routing_mode='pareto' if pareto else 'weighted')
+    else:
+        set_labels(commute_mode=commute_mode, routing_mode=routing_mode if routing_mode in ROUTING_MODES else 'other')
+
+    # Snap origin and destination to the graph
+    with stage('snap'):
+        if getattr(settings, 'ROUTING_SNAP_TO_EDGES', False):
+            snaps = G_graph.spatial_index.nearest_edges(
+                [origin_coords[1], destination_coords[1]], [origin_coords[0], destination_coords[0]]
+            )
+            orig_node = start_node(G_graph, snaps[0])
+            dest_node = end_node(G_graph, snaps[1])
+        else:
+            snaps = None
+            orig_node, dest_node = G_graph.spatial_index.nearest_nodes(
+                [origin_coords[1], destination_coords[1]], [origin_coords[0], destination_coords[0]]
+            )[0].tolist()
+
+
+    # Reuse the route if it was computed before for the same snapped points
+    engine = get_engine_name(commute_mode, routing_mode)
+    cache_key = route_cache_key(
+        G_graph, commute_mode, routing_mode, engine,
+        snaps[0] if snaps else orig_node, snaps[1] if snaps else dest_node,
+    )
+    def compute():
+        describe('cache', 'miss')
+        return compute_paths(
+            G_graph, orig_node, dest_node, snaps, commute_mode, routing_mode, origin_coords, destination_coords,
+            weights, bool(pareto),
+        )
+
+    describe('cache', 'hit')
+    path_data = get_route_cache().get_or_compute(cache_key, compute)
+    if path_data is None:
+        raise RouteRequestError("Not enough noise data between chosen locations to estimate the best path")
+
+    with stage('geojson'):
+        return feature_collection(
+            set_request_coords(path_data, origin_coords, destination_coords), precision, geometry_format, tolerance_m,
+        )
+
+
+def plan_isochrone(origin_coords, commute_mode, minutes, resolution=None, region_format=None, precision=None,
+                   departure_time=None):
+    """
+    Validates an isochrone request and returns the region reachable from the origin.
+
+    A single search from the snapped origin, stopped at the distance covered
+    in ``minutes`` at the speed of the commute mode, settles every reachable
+    node; the reached edges are then aggregated into H3 cells with their mean
+    NDVI, heat and noise (see isochrone.py).
+
+    Args:
+        origin_coords (list): (lat, lon) of the origin.
+        commute_mode (str): 'walk' or 'bike'.
+        minutes (float): Travel time, at most ``ROUTING_ISOCHRONE['MAX_MINUTES']``.
+        resolution (int): H3 resolution of the cells, ``ROUTING_ISOCHRONE['RESOLUTION']`` by default.
+        region_format (str): 'h3' or 'polygon', ``ROUTING_ISOCHRONE['FORMAT']`` by default.
+        precision (int): Decimals of the coordinates, ``ROUTING_GEOJSON['PRECISION']`` by default.
+        departure_time (str): 'HH:MM' or an ISO 8601 date and time for the
+            heat and noise time slices, as in ``plan_route``.
+
+    Returns:
+        dict: GeoJSON FeatureCollection of the region.
+
+    Raises:
+        RouteRequestError: If the request is invalid.
+    """
+
+    if not origin_coords:
+        raise RouteRequestError("Origin coordinates are required")
+
+    if not is_within_bbox(origin_coords):
+        raise RouteRequestError("Starting coordinates are outside the allowed area (Ljubljana)")
+
+    G = get_graph(commute_mode)
+    try:
+        cutoff_m, resolution, region_format = parse_isochrone_options(commute_mode, minutes, resolution, region_format)
+        precision, _ = parse_output_options(precision)
+        hour = parse_departure_time(departure_time)
+    except ValueError as e:
+        raise RouteRequestError(str(e))
+
+    origin_coords = tuple(origin_coords)
+    G_graph = graph_at(G, hour, ALL_LAYERS)
+    set_labels(commute_mode=commute_mode, routing_mode='isochrone')
+
+    with stage('snap'):
+        if getattr(settings, 'ROUTING_SNAP_TO_EDGES', False):
+            snap = G_graph.spatial_index.nearest_edges([origin_coords[1]], [origin_coords[0]])[0]
+            orig_node = start_node(G_graph, snap)
+        else:
+            orig_node = int(G_graph.spatial_index.nearest_nodes([origin_coords[1]], [origin_coords[0]])[0][0])
+
+    def compute():
+        describe('cache', 'miss')
+        with stage('search'):
+            return reachable_region(G_graph, orig_node, cutoff_m, minutes, resolution)
+
+    describe('cache', 'hit')
+    region = get_route_cache().get_or_compute(
+        isochrone_cache_key(G_graph, commute_mode, orig_node, cutoff_m, resolution), compute,
+    )
+
+    with stage('geojson'):
+        return isochrone_geojson(
+            region, origin_coords,
+            {'commute_mode': commute_mode, 'minutes': minutes, 'resolution': resolution},
+            region_format, precision,
+        )
 
 
 @csrf_exempt
+@gzip_page
+@instrument
 def get_paths(request):
     if request.method == 'POST':
         try:
             # Parse input JSON data from frontend
             data = json.loads(request.body)
-            origin_coords = data.get('origin_coords')
-            destination_coords = data.get('destination_coords')
-            commute_mode = data.get('commute_mode')
-            routing_mode = data.get('routing_mode')
-
-            if not origin_coords or not destination_coords:
-                return JsonResponse({"error": "Origin and destination coordinates are required"}, status=400)
-            
-            if not is_within_bbox(destination_coords):
-                return JsonResponse({"error": "Destination coordinates are outside the allowed area (Ljubljana)"}, status=400)
-
-            if not is_within_bbox(origin_coords):
-                return JsonResponse({"error": "Starting coordinates are outside the allowed area (Ljubljana)"}, status=400)
-
-
-            # Ensure the coordinates are in the correct format
-            origin_coords = tuple(origin_coords)
-            destination_coords = tuple(destination_coords)
-
-            # Prepare graph and compute the paths
-            if commute_mode == "walk":
-                G_graph = G_multi_walk
-            elif commute_mode == "bike":
-                G_graph = G_multi_bike
-            else:
-                return JsonResponse({"error": "Commute mode is required (walk or bike)"}, status=400)
-
-            # Get nearest nodes
-            orig_node = ox.distance.nearest_nodes(G_graph, X=origin_coords[1], Y=origin_coords[0])
-            dest_node = ox.distance.nearest_nodes(G_graph, X=destination_coords[1], Y=destination_coords[0])
-
-
-
-            if routing_mode == "noise":
-                paths_generator = nx.shortest_simple_paths(G_graph, orig_node, dest_node, weight='combined')
-                candidate_paths = list(islice(paths_generator, 25))
-                best_3_paths = get_different_paths(candidate_paths)
-                if not best_3_paths:
-                    return JsonResponse({"error": "Not enough noise data between chosen locations to estimate the best path"}, status=400)
-                
-                path_data = []
-                for i, path in enumerate(best_3_paths):
-                    coords = [(G_graph.nodes[n]['x'], G_graph.nodes[n]['y']) for n in path]
-                    length = nx.path_weight(G_graph, path, weight='length')
-                    path_data.append({
-                        'path_num': i + 1,
-                        'origin_coords': origin_coords,
-                        'destination_coords': destination_coords,
-                        'geometry': LineString(coords),
-                        'length_m': length,
-                        'coordinates': coords
-                    })
-                gdf_paths = gpd.GeoDataFrame(path_data, crs="EPSG:4326")
+            geojson = plan_route(
+                data.get('origin_coords'),
+                data.get('destination_coords'),
+                data.get('commute_mode'),
+                data.get('routing_mode'),
+                data.get('weights'),
+                data.get('pareto', False),
+                data.get('precision'),
+                data.get('format'),
+                data.get('departure_time'),
+                data.get('simplify'),
+                data.get('zoom'),
+            )
+
+            with stage('serialize'):
+                return HttpResponse(to_json(geojson), content_type='application/json')
+
+        except RouteRequestError as e:
+            return JsonResponse({"error": str(e)}, status=e.status)
         
+        except Exception as e:
+            traceback.print_exc()
+            return JsonResponse({"error": str(e)}, status=500)
 
+    return JsonResponse({"error": "Invalid request method"}, status=405)
 
-            else:
-                # Get 25 shortests paths (takes about 1s)
-                paths = list(islice(nx.shortest_simple_paths(G_graph, orig_node, dest_node, weight='length'), 25))
 
-                # Convert to GeoDataFrame
-                path_data = []
-                for i, path in enumerate(paths):
-                    coords = [(G_graph.nodes[n]['x'], G_graph.nodes[n]['y']) for n in path]
-                    length = nx.path_weight(G_graph, path, weight='length')
-                    path_data.append({
-                        'path_num': i + 1,
-                        'origin_coords': origin_coords,
-                        'destination_coords': destination_coords,
-                        'geometry': LineString(coords),
-                        'length_m': length,
-                        'coordinates': coords
-                    })
+@csrf_exempt
+@gzip_page
+@instrument
+async def get_paths_async(request):
+    """
+    Asynchronous variant of ``get_paths`` for ASGI servers.
 
-                # get top 3 paths based on routing mode
+    The search runs in a bounded executor: requests beyond its queue cap are
+    rejected with 503 right away and requests without a result before the
+    deadline get 504, so bursts don't pile up behind slow searches.
+    """
 
-                if routing_mode == "vegetation":
-                    with open(os.path.join(settings.BASE_DIR, 'routing', 'data','avg_ndvi_h3_13.json'), 'r') as f:
-                        ndvi_h3 = json.load(f)
+    if request.method != 'POST':
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+
+    try:
+        data = json.loads(request.body)
+        geojson = await get_routing_executor().run(
+            plan_route,
+            data.get('origin_coords'),
+            data.get('destination_coords'),
+            data.get('commute_mode'),
+            data.get('routing_mode'),
+            data.get('weights'),
+            data.get('pareto', False),
+            data.get('precision'),
+            data.get('format'),
+            data.get('departure_time'),
+            data.get('simplify'),
+            data.get('zoom'),
+            timeout=get_deadline(),
+        )
+
+        with stage('serialize'):
+            return HttpResponse(to_json(geojson), content_type='application/json')
+
+    except ExecutorSaturated as e:
+        response = JsonResponse({"error": f"Server is busy, try again later ({e})"}, status=503)
+        response['Retry-After'] = '1'
+        return response
+
+    except DeadlineExceeded as e:
+        return JsonResponse({"error": f"Route search took too long ({e})"}, status=504)
+
+    except RouteRequestError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+
+    except Exception as e:
+        traceback.print_exc()
+        return JsonResponse({"error": str(e)}, status=500)
 
-                    path_data = get_top_3_ndvi(path_data, ndvi_h3)
 
-                elif routing_mode == "heat":
-                    with open(os.path.join(settings.BASE_DIR, 'routing', 'data','heat_h3.json'), 'r') as f:
-                        ndvi_h3 = json.load(f)
+@csrf_exempt
+@gzip_page
+@instrument
+def get_isochrone(request):
+    """
+    Returns the area reachable from a point within some minutes on foot or by bike.
 
-                    path_data = get_top_3_ndvi(path_data, ndvi_h3)
+    The request holds 'origin_coords', 'commute_mode' and 'minutes', and
+    optionally the H3 'resolution' of the cells, 'format' ('h3' for a
+    feature per cell with its travel time, NDVI, heat and noise, 'polygon'
+    for the outline), 'precision' and 'departure_time'.
+    """
 
-                # elif routing_mode == "noise":
-                #     noise_data = gpd.read_file(os.path.join(settings.BASE_DIR, 'routing', 'data','Slovenia_Osrednjeslovenska_Ljubljana.areas.geojson'))
+    if request.method != 'POST':
+        return JsonResponse({"error": "Invalid request method"}, status=405)
 
-                #     path_data = get_top_3_quietest_paths(path_data, noise_data)
+    try:
+        data = json.loads(request.body)
+        geojson = plan_isochrone(
+            data.get('origin_coords'),
+            data.get('commute_mode'),
+            data.get('minutes'),
+            data.get('resolution'),
+            data.get('format'),
+            data.get('precision'),
+            data.get('departure_time'),
+        )
 
-                #     if not path_data:
-                #         return JsonResponse({"error": "Not enough noise data between chosen locations to estimate the best path"}, status=400)
+        with stage('serialize'):
+            return HttpResponse(to_json(geojson), content_type='application/json')
 
-                elif routing_mode is None:
+    except RouteRequestError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
 
-                    # Get the indexes of the 3 shortest paths based on length
-                    sorted_indexes = sorted(range(len(path_data)), key=lambda i: path_data[i]['length_m'])
+    except Exception as e:
+        traceback.print_exc()
+        return JsonResponse({"error": str(e)}, status=500)
 
-                    # Select the top 3 shortest paths by using the sorted indexes
-                    path_data = [path_data[i] for i in sorted_indexes[:3]]
 
-                gdf_paths = gpd.GeoDataFrame(path_data, crs="EPSG:4326")
+@csrf_exempt
+def get_paths_batch(request):
+    """
+    Routes many origin-destination pairs, or a one-to-many matrix, in one request.
 
-            # Convert GeoDataFrame to GeoJSON
-            geojson = gdf_paths.to_json()
+    The work is spread over a process pool and results are streamed back as
+    newline-delimited JSON, one line per pair (or matrix row) as soon as it
+    completes. Each line carries the index of its pair, so errors of single
+    pairs are reported without failing the whole batch.
+    """
 
-            return JsonResponse(geojson, safe=False)
-        
-        except Exception as e:
-            traceback.print_exc()
-            return JsonResponse({"error": str(e)}, status=500)
+    if request.method != 'POST':
+        return JsonResponse({"error": "Invalid request method"}, status=405)
 
-    return JsonResponse({"error": "Invalid request method"}, status=405)
+    try:
+        tasks = batch_tasks(json.loads(request.body))
+    except (ValueError, AttributeError) as e:
+        return JsonResponse({"error": str(e)}, status=400)
 
+    lines = (to_json(result) + '\n' for result in run_batch(tasks))
+    return StreamingHttpResponse(lines, content_type='application/x-ndjson')
 
-def get_different_paths(path_data):
 
+def metrics(request):
+    """
+    Returns request latency histograms by commute and routing mode, stage
+    timings and counters of requests, candidate paths and settled nodes in
+    the Prometheus text format. Only local clients may read them.
     """
-    Returns shortest paths that are the most different
 
-    Args:
-        path_data (dict): List of 15 paths.
+    if request.META.get('REMOTE_ADDR') not in get_metrics_settings()['ALLOWED_IPS']:
+        return JsonResponse({"error": "Forbidden"}, status=403)
 
-    Returns:
-        list: List of path numbers that are the most different.
-    """
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4')
 
-    def dissimilarity(path1, path2):
-        set1, set2 = set(path1), set(path2)
-        return 1 - len(set1 & set2) / len(set1 | set2)
-    
-    dissimilarity_scores = []
 
-    for combo in combinations(path_data, 3):
-        # Calculate dissimilarities for the three paths
-        d1 = dissimilarity(combo[0], combo[1])
-        d2 = dissimilarity(combo[0], combo[2])
-        d3 = dissimilarity(combo[1], combo[2])
-        
-        # Total dissimilarity score for the combination
-        total_dissimilarity = d1 + d2 + d3
-        
-        # Store the combination and its dissimilarity score
-        dissimilarity_scores.append((combo, total_dissimilarity))
+def route_cache_stats(request):
+    """Returns hit, miss and eviction counters of the route cache."""
 
-    # Find the combination with the highest dissimilarity
-    best_combo, best_score = max(dissimilarity_scores, key=lambda x: x[1])
-    
-    return best_combo
+    return JsonResponse(get_route_cache().info())
+
+
+def layer_status(request):
+    """Returns the data layer versions of the loaded graphs and the last reload of changed layers."""
+
+    return JsonResponse(get_graph_registry().info())
 
 
+def readiness(request):
+    """Returns 200 once the graphs of all enabled commute modes are loaded and 503 before, for readiness probes."""
 
+    status = get_graph_registry().readiness()
+    return JsonResponse(status, status=200 if status['ready'] else 503)
 
-def get_top_3_ndvi(path_data, ndvi_h3):
+
+def _tile_etag(request, layer, z, x, y):
+    return tile_version(layer) if layer in LAYER_STYLES else None
+
+
+@condition(etag_func=_tile_etag)
+def layer_tile(request, layer, z, x, y):
     """
-    Returns the top 3 paths with the highest average NDVI.
-    
-    Args:
-        path_data (dict): GeoJSON-like dict with 25 paths.
-        ndvi_h3 (dict): Dict with H3 indexes as keys and NDVI values as floats.
-    
-    Returns:
-        list: List of path numbers with the highest average NDVI.
+    Returns a PNG map tile of the NDVI, heat or noise layer for overlays.
+
+    Tiles are rendered on first request and kept on disk (see tiles.py).
+    Their ETag is the version of the layer file, so browsers revalidate
+    cached tiles with a 304 until the layer changes.
     """
-    
-    def get_h3_index(lat, lon):
-        return h3.latlng_to_cell(lat, lon, res=13)
 
-    def calculate_average_ndvi(path):
-        # Extract coordinates of the path
-        coords = path['coordinates']
-        
-        # Convert coordinates to H3 indexes
-        h3_indexes = [
-            get_h3_index(coord[1], coord[0])  # (lat, lon)
-            for coord in coords
-        ]
-        
-        # Get the NDVI values for the H3 indexes
-        ndvi_values = [
-            ndvi_h3[h3_index]
-            for h3_index in h3_indexes if h3_index in ndvi_h3
-        ]
-        
-        # Return the average NDVI, or None if no valid NDVI values
-        return np.mean(ndvi_values) if ndvi_values else None
-    
-    def get_most_different_paths(path_data):
-        
-        def dissimilarity(path1, path2):
-            set1, set2 = set(path1), set(path2)
-            return 1 - len(set1 & set2) / len(set1 | set2)
-
-        # Calculate dissimilarity scores for all combinations of paths
-        dissimilarity_scores = []
-        for combo in combinations(path_data, 3):
-            d1 = dissimilarity(combo[0]['coordinates'], combo[1]['coordinates'])
-            d2 = dissimilarity(combo[0]['coordinates'], combo[2]['coordinates'])
-            d3 = dissimilarity(combo[1]['coordinates'], combo[2]['coordinates'])
-            total_dissimilarity = d1 + d2 + d3
-            dissimilarity_scores.append((combo, total_dissimilarity))
-
-        # Find the combination with the highest dissimilarity
-        best_combo, best_score = max(dissimilarity_scores, key=lambda x: x[1])
-        
-        return best_combo
+    config = get_tile_settings()
+    if layer not in LAYER_STYLES or not config['MIN_ZOOM'] <= z <= config['MAX_ZOOM'] or max(x, y) >= 2 ** z:
+        return JsonResponse({"error": "Tile not found"}, status=404)
 
-    # Calculate NDVI for each path
-    for path in path_data:
-        avg_ndvi = calculate_average_ndvi(path)
-        path['average_ndvi'] = avg_ndvi   # Add average NDVI to path data
+    version = tile_version(layer)
+    if version is None:
+        return JsonResponse({"error": f"Layer data not found: {layer}"}, status=404)
 
-    #get most different paths
+    response = HttpResponse(get_tile(layer, version, z, x, y), content_type='image/png')
+    patch_cache_control(response, public=True, max_age=config['MAX_AGE'])
+    return response
 
-    # Sort the paths by average NDVI in descending order
-    sorted_paths = sorted(path_data, key=lambda x: x.get('average_ndvi', float('-inf')), reverse=True)
-    
-    #get most different out of top 10
 
-    most_different_paths = get_most_different_paths(sorted_paths[:10])
+def get_top_3_ndvi(path_data, paths, highest=True):
+    """
+    Returns the top 3 paths with the highest (or lowest) average NDVI.
+    
+    Args:
+        path_data (dict): GeoJSON-like dict with 25 paths, each with an 'average_ndvi' score
+            precomputed from the edge exposure attributes.
+        paths (list): The same paths as arrays of node indices.
+        highest (bool): Prefer paths with high values (vegetation) or low values (heat).
+    
+    Returns:
+        list: List of path numbers with the highest average NDVI.
+    """
 
-    #get most different paths:
-    #get the list of paths
+    config = get_diversity_settings()
 
+    # Sort the paths by average NDVI, paths without data go last
+    def sort_key(i):
+        value = path_data[i].get('average_ndvi')
+        if value is None:
+            return float('inf')
+        return -value if highest else value
 
-    # Get the top 3 paths
-    #top_3_paths = sorted_paths[:3]
+    sorted_indexes = sorted(range(len(path_data)), key=sort_key)
 
+    #get most different out of the top ones
+    top = sorted_indexes[:config['TOP']]
+    quality = length_quality([path['length_m'] for path in path_data])
+    selected = select_diverse([paths[i] for i in top], config['K'], quality[top], config['MIN_QUALITY'])
 
-    #return top_3_paths
-    return most_different_paths
+    return [path_data[top[i]] for i in selected]
 
-def get_top_3_quietest_paths(path_data, noise_data):
+def get_top_3_quietest_paths(path_data, paths, noise_index, G_graph=None):
     """
     Returns the top 3 paths with the lowest average noise levels.
 
+    Every path geometry is scored against the noise measurements. Paths with
+    a stretch longer than MAX_UNMEASURED_M without a measurement are skipped,
+    as their average would rest on too little data.
+
     Args:
-        path_data (dict): Dictionary containing paths with geometry and other metadata.
-        noise_data (list): List of dictionaries with 'geometry' (Polygon) and 'noise_level'.
+        path_data (dict): GeoJSON-like dict with the candidate paths and their 'coordinates'.
+        paths (list): The same paths as arrays of node indices.
+        noise_index (NoiseIndex): Noise measurements.
+        G_graph (CSRGraph): Graph view with a noise time slice (see ``graph_at``),
+            whose edge noise replaces the measured level of the paths.
 
     Returns:
-        list: List of path numbers with the lowest average noise levels.
+        list: The quietest of the most different paths, each with its 'la50'
+        and 'noise_coverage', or None if no path has enough noise data.
     """
 
-    def check_noise_data_for_path(path_data, noise_data, path_length):
-        total_noise = 0
-        count = 0
-
-        for index, row in noise_data.iterrows():
-            noise_polygon = row['geometry']
-            if path_data.intersects(noise_polygon):
-                total_noise += row['noise_level']
-                count += 1
+    config = get_diversity_settings()
 
-        if count > 0 and path_length / count < 500:
-            return total_noise / count
-        else:
-            return None
+    valid_indexes = []
+    for i, path in enumerate(path_data):
+        score = noise_index.score_path(path['coordinates'])
+        if G_graph is not None and score['la50'] is not None:
+            score['la50'] = path_measured_average(G_graph, paths[i], 'noise', 'noise_coverage')
+        if score['la50'] is not None and score['max_gap_m'] <= MAX_UNMEASURED_M:
+            path['la50'] = score['la50']
+            path['noise_coverage'] = score['coverage']
+            valid_indexes.append(i)
 
-    def calculate_average_noise(path):
-        path_geom = path['geometry']
-        path_length = path['length_m']
-        return check_noise_data_for_path(path_geom, noise_data, path_length)
-
-    # Process each path
-    valid_paths = []
-    for path in path_data:
-        avg_noise = calculate_average_noise(path)
-        if avg_noise is not None:
-            path['la50'] = avg_noise
-            valid_paths.append(path)
-
-    # Sort paths by average noise (ascending order)
-    sorted_paths = sorted(valid_paths, key=lambda x: x.get('la50', float('inf')))
-
-    # Check if top 3 paths exist
-    if sorted_paths:
-        top_3_paths = sorted_paths[:3]
-        return top_3_paths
-    else:
+    if not valid_indexes:
         return None
-   
-    return sorted_paths
+
+    # Sort paths by average noise (ascending order) and get most different out of the top ones
+    top = sorted(valid_indexes, key=lambda i: path_data[i]['la50'])[:config['TOP']]
+    quality = length_quality([path['length_m'] for path in path_data])
+    selected = select_diverse([paths[i] for i in top], config['K'], quality[top], config['MIN_QUALITY'])
+
+    return [path_data[top[i]] for i in selected]